@@ -0,0 +1,80 @@
+import os
+import re
+import json
+
+AGENTS_CONFIG = os.getenv("AGENTS_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "agents.json"))
+
+
+def trie_pattern(words) -> str:
+    """One regex alternation for ``words``, factored into a character trie.
+
+    ``code|coding|compare`` becomes ``co(?:d(?:e|ing)|mpare)``, so at each
+    position the regex engine follows a single branch instead of trying
+    every keyword in turn. Spaces in phrases match any run of whitespace.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        end = "" in node
+        branches = [(r"\s+" if char == " " else re.escape(char)) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if end:
+            body = "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """Score every agent in one pass over the query.
+
+    All keywords are compiled into a single word-bounded trie regex, so
+    "error" no longer matches inside "terrorism". Each match adds the
+    keyword's weight to its agent; the highest score wins, ties go to
+    the higher priority, and a query with no match gets ``default``.
+    """
+
+    def __init__(self, agents, default="General Assistant"):
+        self.default = default
+        self.priorities = {agent["name"]: agent.get("priority", 0) for agent in agents}
+        self.keywords = {}             # keyword -> [(agent, weight)]
+        for agent in agents:
+            keywords = agent["keywords"]
+            if not isinstance(keywords, dict):
+                keywords = {keyword: 1.0 for keyword in keywords}
+            for keyword, weight in keywords.items():
+                keyword = " ".join(keyword.lower().split())
+                self.keywords.setdefault(keyword, []).append((agent["name"], float(weight)))
+        self.pattern = re.compile(r"\b" + trie_pattern(self.keywords) + r"\b") if self.keywords else None
+
+    def scores(self, text: str) -> dict:
+        scores = {}
+        if self.pattern is None:
+            return scores
+        for match in self.pattern.finditer(text.lower()):
+            keyword = match.group()
+            matches = self.keywords.get(keyword) or self.keywords[" ".join(keyword.split())]
+            for agent, weight in matches:
+                scores[agent] = scores.get(agent, 0.0) + weight
+        return scores
+
+    def detect(self, text: str) -> str:
+        scores = self.scores(text)
+        if not scores:
+            return self.default
+        return max(scores, key=lambda agent: (scores[agent], self.priorities.get(agent, 0)))
+
+
+def load_matcher(path=AGENTS_CONFIG) -> KeywordMatcher:
+    """Build the matcher from the agents config file"""
+    with open(path) as f:
+        config = json.load(f)
+    return KeywordMatcher(config["agents"], config.get("default", "General Assistant"))
@@ -1,31 +1,65 @@
 import os
 import time
 import json
+import io
+import csv
 import asyncio
-from typing import Optional
-from datetime import datetime
+import secrets
+from typing import List, Optional
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, contextmanager
 
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-import google.generativeai as genai
-import requests
 from sse_starlette.sse import EventSourceResponse
-from db import init_db, save_chat, get_recent, create_user, authenticate_user, create_session_token, verify_session_token, get_user_analytics
+from db import HISTORY_FIELDS, init_db, close_connections, explain_query_plan, chat_row, save_chats, create_job, get_job, cancel_job, iter_job_task_pages, job_queue_stats, get_recent, iter_history_pages, search_available, search_chats, lock_wait_stats, open_connection_count, create_user, authenticate_user, create_session_token, verify_session_token, revoke_session_token, token_cache_stats, get_user_analytics, get_user_analytics_range
+from providers import GEMINI_API_KEY, DEEPSEEKER_API_KEY, close_client, history_text, provider_for
+from resilience import guards, guard_for, guard_status
+from routing import ModelRouter, call_with_fallback, stream_with_fallback, decision_fields, stats_for
+from agent_matcher import load_matcher
+from usage import account
+from guardrails import PromptTooLarge, preflight
+from memory import ConversationMemory
+from chat_log import ChatLogWriter
+from jobs import JobWorkerPool
+from metrics import CHAT_REQUESTS, CONTENT_TYPE, STAGE_SECONDS, Collected, lap, render
+from tracing import TracingMiddleware, close_tracing, current_trace_id, span, trace_stats
+from profiler import PROFILE_INTERVAL_MS, ProfilerBusy, SlowRequestMiddleware, folded, sample_stacks, slow_requests
+from response_cache import ResponseCache
+from singleflight import SingleFlight
 
 init_db()
 
 load_dotenv()
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-DEEPSEEKER_API_KEY = os.getenv("DEEPSEEKER_API_KEY")
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+chat_log = ChatLogWriter()
+response_cache = ResponseCache()
+flights = SingleFlight()
+memory = ConversationMemory()
 
-app = FastAPI(title="Xtarz AI Agents Task")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await chat_log.start()
+    await job_pool.start()
+    yield
+    # Flush pending chat rows before releasing pooled provider and database connections
+    await job_pool.stop()
+    await memory.close()
+    await chat_log.stop()
+    # Rows of batches whose client disconnected are still being saved
+    await asyncio.gather(*batch_saves, return_exceptions=True)
+    await close_client()
+    close_connections()
+    close_tracing()
+
+
+app = FastAPI(title="Xtarz AI Agents Task", lifespan=lifespan)
 
 # Enable CORS for frontend integration
 app.add_middleware(
@@ -35,25 +69,21 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# One server span per request; X-Trace-Id in every response
+app.add_middleware(TracingMiddleware)
+# Outside the tracing middleware, so the server span is part of the capture
+app.add_middleware(SlowRequestMiddleware, explain=explain_query_plan)
 
 
 
 
 
 
-CODE_KEYWORDS = ["code", "function", "debug", "programming", "python", "javascript", "error", "bug", "syntax"]
-RESEARCH_KEYWORDS = ["research", "analyze", "compare", "find", "study", "investigate"]
-TASK_KEYWORDS = ["how to", "steps", "guide", "tutorial", "process", "setup", "help me"]
+# Agents, keywords, priorities and weights come from agents.json
+agent_matcher = load_matcher()
 
 def detect_agent(user_text: str) -> str:
-    lower_text = user_text.lower()
-    if any(w in lower_text for w in CODE_KEYWORDS):
-        return "Code Assistant"
-    if any(w in lower_text for w in RESEARCH_KEYWORDS):
-        return "Research Assistant"
-    if any(w in lower_text for w in TASK_KEYWORDS):
-        return "Task Helper"
-    return "General Assistant"
+    return agent_matcher.detect(user_text)
 
 
 def choose_model(user_text: str) -> str:
@@ -72,6 +102,15 @@ def choose_model(user_text: str) -> str:
             return "gemini-1.5-flash"
 
 
+# Live latency/cost router; choose_model() is its cold-start fallback
+router = ModelRouter(choose_model)
+
+
+def plan_query(user_text: str):
+    """(agent, routing decision) for a query"""
+    return detect_agent(user_text), router.choose(user_text)
+
+
 def agent_prefix(agent: str) -> str:
     if agent == "Code Assistant":
         return "You are a Code Assistant.\n\n"
@@ -83,123 +122,86 @@ def agent_prefix(agent: str) -> str:
         return "You are a helpful assistant.\n\n"
 
 
+def prompt_prefix(agent: str, context: str = "", history=()) -> str:
+    """Everything sent ahead of the query, as text: the cache key prefix and what pre-flight counts"""
+    return history_text(history) + agent_prefix(agent) + context
 
-def call_gemini(prompt: str, model_name: str) -> dict:
-    if not GEMINI_API_KEY:
-        return {
-            "ok": False,
-            "error": "Gemini API key missing",
-            "text": "",
-            "time": 0.0,
-            "tokens": 0
-        }
 
-    start = time.time()
-    try:
-        model = genai.GenerativeModel(model_name)
-        response = model.generate_content(prompt)
+async def cached_response(agent: str, model_name: str, user_text: str, context: str = "", history=()):
+    """Cached answer for ``user_text`` as the user sent it to the routed ``model_name``, or None.
 
-        
-        if response.text:
-            text = response.text
-        else:
-            text = "(No text from Gemini)"
+    Every endpoint keys the cache this way, before pre-flight, so a hit
+    skips pre-flight (and any summarization) altogether.
+    """
+    with span("response_cache.get", model=model_name) as lookup:
+        cached = await response_cache.get(agent, prompt_prefix(agent, context, history), model_name, user_text)
+        lookup.set_attribute("hit", cached is not None)
+    return cached
 
-        end = time.time()
-        return {
-            "ok": True,
-            "text": text,
-            "time": end - start,
-            "tokens": len(text.split())
-        }
-    except Exception as e:
-        end = time.time()
-        return {
-            "ok": False,
-            "error": str(e),
-            "text": "",
-            "time": end - start,
-            "tokens": 0
-        }
 
-def call_deepseeker(prompt: str) -> dict:
-    if not DEEPSEEKER_API_KEY:
-        return {
-            "ok": False,
-            "error": "DeepSeeker API key missing",
-            "text": "",
-            "time": 0.0,
-            "tokens": 0,
-            "input_tokens": 0,
-            "output_tokens": 0
-        }
+async def call_and_cache(agent: str, model_name: str, user_text: str, context: str, plan: dict,
+                         history=()) -> dict:
+    """Call the pre-flight ``plan`` through single-flight and cache the result under the routed model and query"""
+    prompt = agent_prefix(agent) + context + plan["text"]
 
-    start = time.time()
-    try:
-        url = "https://api.deepseek.com/v1/chat/completions"  # Fixed URL
-        headers = {
-            "Authorization": f"Bearer {DEEPSEEKER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "model": "deepseek-chat",  # Fixed model name
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 600,
-            "stream": False
-        }
+    async def call():
+        with span("call_model", model=plan["model"]) as current:
+            result = await call_with_fallback(agent, plan["model"], prompt, history=history,
+                                              prompt_tokens=plan["prompt_tokens"])
+            current.set_attribute("attempts", result.get("attempts", []))
+            current.set_attribute("hedged", bool(result.get("hedged")))
+        await response_cache.set(agent, prompt_prefix(agent, context, history), model_name, user_text, result)
+        return result
 
-        
-        response = requests.post(url, headers=headers, json=data, timeout=(3, 5))
-        response.raise_for_status()
-        json_output = response.json()
+    # Concurrent identical requests share one upstream call
+    return await flights.do((plan["model"], history, prompt), call)
 
-        
-        message_obj = json_output.get("choices", [{}])[0].get("message", {})
-        if "content" in message_obj and message_obj["content"]:
-            text = message_obj["content"]
-        else:
-            text = "(No text from DeepSeeker)"
 
-        # Get token usage
-        usage = json_output.get("usage", {})
-        input_tokens = usage.get("prompt_tokens", len(prompt.split()))
-        output_tokens = usage.get("completion_tokens", len(text.split()))
-        total_tokens = usage.get("total_tokens", input_tokens + output_tokens)
+async def shared_preflight(model_name: str, prefix: str, user_text: str) -> dict:
+    """preflight(), shared by concurrent identical requests so an oversized query is summarized once"""
+    return await flights.do(("preflight", model_name, prefix, user_text),
+                            lambda: preflight(model_name, prefix, user_text))
 
-        end = time.time()
-        return {
-            "ok": True,
-            "text": text,
-            "time": end - start,
-            "tokens": total_tokens,
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens
-        }
 
-    except Exception as e:
-        end = time.time()
-        return {
-            "ok": False,
-            "error": str(e),
-            "text": "",
-            "time": end - start,
-            "tokens": 0
-        }
+async def cached_call_model(agent: str, model_name: str, user_text: str, context: str = ""):
+    """Cache lookup, pre-flight and call_model(); returns (result, cache_hit). Raises PromptTooLarge"""
+    start = time.time()
+    cached = await cached_response(agent, model_name, user_text, context)
+    if cached is not None:
+        return dict(cached, time=time.time() - start), True
+    plan = await shared_preflight(model_name, prompt_prefix(agent, context), user_text)
+    return await call_and_cache(agent, model_name, user_text, context, plan), False
 
 
-def call_model(model_name: str, prompt: str) -> dict:
-    if model_name.startswith("gemini"):
-        result = call_gemini(prompt, model_name)
-        return result
-    else:
-        result = call_deepseeker(prompt)
-        return result
+@contextmanager
+def stage(endpoint: str, name: str, **attributes):
+    """Time a pipeline stage into chat_stage_seconds and trace it as a span"""
+    start = time.perf_counter()
+    with span(name, **attributes) as current:
+        yield current
+    lap(endpoint, name, start)
+
+
+async def checked_preflight(model_name: str, agent: str, user_text: str, context: str = "", history=()) -> dict:
+    """Context-window pre-flight; oversized queries that cannot be handled get a 413"""
+    try:
+        return await shared_preflight(model_name, prompt_prefix(agent, context, history), user_text)
+    except PromptTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
 
 class ChatRequest(BaseModel):
     query: str
     session_id: Optional[str] = None
 
+class BatchChatRequest(BaseModel):
+    queries: List[str]
+    session_id: Optional[str] = None
+
+class JobRequest(BaseModel):
+    queries: List[str]
+    session_id: Optional[str] = None
+
 class ChatResponse(BaseModel):
     agent_used: str
     model: str
@@ -210,6 +212,7 @@ class ChatResponse(BaseModel):
     input_tokens: Optional[int] = 0
     output_tokens: Optional[int] = 0
     cost_estimate: Optional[float] = 0.0
+    cache_hit: Optional[bool] = False
 
 class UserRegister(BaseModel):
     username: str
@@ -228,33 +231,72 @@ class UserResponse(BaseModel):
 
 # chat endpoint
 @app.post("/chat", response_model=ChatResponse)
-def chat(request: ChatRequest):
+async def chat(request: ChatRequest):
     if not request.query:
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
 
     text = request.query
-    agent = detect_agent(text)
-    model = choose_model(text)
-    prompt = agent_prefix(agent) + text
-    res = call_model(model, prompt)
+    started = time.perf_counter()
+    with stage("chat", "detect_agent") as current:
+        agent = detect_agent(text)
+        current.set_attribute("agent", agent)
+    with stage("chat", "route") as current:
+        decision = router.choose(text)
+        current.set_attribute("model", decision["model"])
+        current.set_attribute("reason", decision["reason"])
+    with stage("chat", "memory"):
+        context, history = await memory.context(request.session_id)
+    model = decision["model"]
+    t = time.perf_counter()
+    res = await cached_response(agent, model, text, context, history)
+    lap("chat", "cache", t)
+    cache_hit = res is not None
+    sent_text = text
+    if cache_hit:
+        res = dict(res, time=time.perf_counter() - t)
+    else:
+        with stage("chat", "preflight") as current:
+            plan = await checked_preflight(model, agent, text, context, history)
+            current.set_attribute("action", plan["action"])
+        sent_text = plan["text"]
+        t = time.perf_counter()
+        res = await call_and_cache(agent, model, text, context, plan, history)
+        lap("chat", "provider", t)
+    # The fallback chain (or pre-flight) may have answered with a different model
+    model = res.get("model", model)
 
     response_text = res.get("text") or res.get("error") or "(No response)"
     confidence = 0.85 if res.get("ok") else 0.0
     time_taken = float(res.get("time", 1.2))
     tokens = int(res.get("tokens", 150))
-
-    
-    save_chat(
-        session_id=request.session_id or "anon",
-        agent_used=agent,
-        model=model,
-        query=text,
-        response=response_text,
-        confidence=confidence,
-        processing_time=time_taken,
-        token_count=tokens,
-        created_at=datetime.now().isoformat()
-    )
+    input_tokens = int(res.get("input_tokens", 0))
+    output_tokens = int(res.get("output_tokens", 0))
+    # A cached answer costs nothing upstream
+    cost = 0.0 if cache_hit else float(res.get("cost_estimate", 0.0))
+    if res.get("ok"):
+        with stage("chat", "memory_append"):
+            await memory.append(request.session_id, sent_text, response_text)
+
+    with stage("chat", "log"):
+        await chat_log.log(
+            session_id=request.session_id or "anon",
+            agent_used=agent,
+            model=model,
+            query=text,
+            response=response_text,
+            confidence=confidence,
+            processing_time=time_taken,
+            token_count=tokens,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            cost_estimate=cost,
+            created_at=datetime.now().isoformat(),
+            cache_hit=cache_hit,
+            trace_id=current_trace_id(),
+            **decision_fields(decision)
+        )
+    lap("chat", "total", started)
+    CHAT_REQUESTS.labels("chat", "cache_hit" if cache_hit else "ok" if res.get("ok") else "error").inc()
 
     return ChatResponse(
         agent_used=agent,
@@ -263,6 +305,10 @@ def chat(request: ChatRequest):
         confidence=confidence,
         processing_time=time_taken,
         token_count=tokens,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        cost_estimate=cost,
+        cache_hit=cache_hit,
     )
 
 # models status endpoint
@@ -272,32 +318,95 @@ def models_status():
 
     
     if GEMINI_API_KEY:
-        models.append({
-            "model": "gemini-1.5-flash",
-            "status": "available",
-            "provider": "google"
-        })
-        models.append({
-            "model": "gemini-1.5-flash-8b",
-            "status": "available",
-            "provider": "google"
-        })
+        models.append(model_status("gemini-1.5-flash", "google"))
+        models.append(model_status("gemini-1.5-flash-8b", "google"))
    
     if DEEPSEEKER_API_KEY:
-        models.append({
-            "model": "deepseeker-1.0",
-            "status": "available",
-            "provider": "deepseek"
-        })   
+        models.append(model_status("deepseeker-1.0", "deepseek"))
     result = {
         "models": models,
         "count": len(models),
+        "providers": guard_status(),
+        "router_policy": router.policy,
         "time": datetime.now().isoformat()
     }
 
     return result
 
 
+def model_status(model_name: str, provider: str):
+    """Status entry for one model, with its provider's breaker and concurrency state"""
+    guard = guard_for(provider_for(model_name)).status()
+    state = guard["circuit"]["state"]
+    return {
+        "model": model_name,
+        "status": {"closed": "available", "half_open": "degraded"}.get(state, "unavailable"),
+        "provider": provider,
+        "circuit": guard["circuit"],
+        "concurrency": guard["concurrency"],
+        "stats": stats_for(model_name).snapshot()
+    }
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    """Response cache and request coalescing counters"""
+    return dict(response_cache.stats(), single_flight=flights.stats())
+
+
+@app.get("/db/stats")
+def db_stats():
+    """SQLite write-lock waits, open connections, and chat log queue depth and dropped rows"""
+    return {"lock_waits": lock_wait_stats(), "connections": open_connection_count(),
+            "chat_log_pending": chat_log.pending(), "chat_log_dropped": chat_log.dropped}
+
+
+@app.get("/memory/stats")
+def memory_stats():
+    """Conversation memory counters"""
+    return memory.stats()
+
+
+# Scrape-time metrics, read from the components' own counters
+def cache_samples(key):
+    def collect():
+        yield ("response",), response_cache.stats()[key]
+        yield ("token",), token_cache_stats()[key]
+        yield ("memory",), memory.stats()[key]
+    return collect
+
+
+def guard_samples(read):
+    return lambda: (((name,), read(guard)) for name, guard in list(guards.items()))
+
+
+Collected("cache_hits_total", "Cache hits", ("cache",), cache_samples("hits"), kind="counter")
+Collected("cache_misses_total", "Cache misses", ("cache",), cache_samples("misses"), kind="counter")
+Collected("cache_hit_ratio", "Cache hits over lookups since start", ("cache",), cache_samples("hit_ratio"))
+Collected("provider_in_flight", "Provider calls in flight", ("provider",),
+          guard_samples(lambda guard: guard.limiter.in_flight))
+Collected("provider_concurrency_limit", "Adaptive concurrency limit per provider", ("provider",),
+          guard_samples(lambda guard: int(guard.limiter.limit)))
+Collected("provider_circuit_open", "1 while the provider's circuit breaker refuses calls", ("provider",),
+          guard_samples(lambda guard: int(guard.breaker.is_open())))
+Collected("chat_log_pending", "Chat rows waiting for the batch writer", (),
+          lambda: [((), chat_log.pending())])
+Collected("chat_log_dropped_total", "Chat rows dropped after repeated failed writes", (),
+          lambda: [((), chat_log.dropped)], kind="counter")
+Collected("trace_spans_exported_total", "Spans handed to the trace exporter", (),
+          lambda: [((), trace_stats()["exported"])], kind="counter")
+Collected("trace_spans_dropped_total", "Spans dropped because the exporter failed or fell behind", (),
+          lambda: [((), trace_stats()["dropped"])], kind="counter")
+Collected("db_lock_wait_seconds_total", "Time spent waiting for the SQLite write lock", (),
+          lambda: [((), lock_wait_stats()["total"])], kind="counter")
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition of the app's metrics"""
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
 # chat stream endpoint
 @app.post("/chat/stream")
 async def chat_stream(request: ChatRequest):
@@ -306,61 +415,518 @@ async def chat_stream(request: ChatRequest):
         raise HTTPException(status_code=400, detail="Query cannot be empty.")
 
     user_text = request.query
-    agent = detect_agent(user_text)
-    model_name = choose_model(user_text)
-    prompt = agent_prefix(agent) + user_text
+    started = time.perf_counter()
+    with stage("stream", "detect_agent") as current:
+        agent = detect_agent(user_text)
+        current.set_attribute("agent", agent)
+    with stage("stream", "route") as current:
+        decision = router.choose(user_text)
+        current.set_attribute("model", decision["model"])
+        current.set_attribute("reason", decision["reason"])
+    with stage("stream", "memory"):
+        context, history = await memory.context(request.session_id)
+    # Same cache key as /chat (routed model, query as sent), checked before pre-flight
+    routed_model = decision["model"]
+    t = time.perf_counter()
+    cached = await cached_response(agent, routed_model, user_text, context, history)
+    lap("stream", "cache", t)
+    if cached is None:
+        with stage("stream", "preflight") as current:
+            plan = await checked_preflight(routed_model, agent, user_text, context, history)
+            current.set_attribute("action", plan["action"])
+    else:
+        plan = {"model": cached.get("model", routed_model), "text": user_text, "action": "cached"}
+    model_name = plan["model"]
+    prefix = prompt_prefix(agent, context, history)
+    prompt = agent_prefix(agent) + context + plan["text"]
 
     async def generate_events():
         
         start_event = {"event": "start", "agent": agent, "model": model_name}
-        yield f"data: {json.dumps(start_event)}\n\n"
+        yield {"data": json.dumps(start_event)}
+
+        # Deltas are relayed as the provider produces them. Concurrent
+        # identical requests subscribe to one upstream stream; if every
+        # subscriber disconnects, EventSourceResponse cancels the generators
+        # and the shared stream cancels the upstream request.
+        ok = False
+        chunks = []
+        route = {}
+        start = time.time()
+        t = time.perf_counter()
+        emitting = 0.0
+
+        async def cache_stream_result(text):
+            used = route.get("model", model_name)
+            await response_cache.set(agent, prefix, routed_model, user_text, dict(
+                account(used, prefix + plan["text"], text, **route.get("usage", {})),
+                ok=True, text=text, model=used, time=time.time() - start))
 
         try:
-            loop = asyncio.get_running_loop()
-            result = await loop.run_in_executor(None, call_model, model_name, prompt)
-
-            
-            if result.get("text"):
-                text = result["text"]
-            elif result.get("error"):
-                text = result["error"]
+            if cached is not None:
+                route["model"] = cached.get("model", model_name)
+                chunks.append(cached["text"])
+                yield {"data": json.dumps({"event": "delta", "content": cached["text"]})}
             else:
-                text = "(No response)"
-
-            
-            words = text.split()
-            for i in range(0, len(words), 10):
-                chunk = " ".join(words[i:i+10])
-                delta_event = {"event": "delta", "content": chunk}
-                yield f"data: {json.dumps(delta_event)}\n\n"
-                await asyncio.sleep(0.05)
-
-            
-            complete_event = {"event": "complete", "ok": result.get("ok", False)}
-            yield f"data: {json.dumps(complete_event)}\n\n"
+                upstream, route = flights.stream(
+                    (model_name, history, prompt),
+                    lambda meta: stream_with_fallback(agent, model_name, prompt, route=meta, history=history,
+                                                      prompt_tokens=plan.get("prompt_tokens")),
+                    on_complete=cache_stream_result)
+                try:
+                    async for chunk in upstream:
+                        if not chunks:
+                            lap("stream", "first_token", t)
+                        chunks.append(chunk)
+                        delta_event = {"event": "delta", "content": chunk}
+                        # Time suspended here is time spent sending the event to the client
+                        sent = time.perf_counter()
+                        yield {"data": json.dumps(delta_event)}
+                        emitting += time.perf_counter() - sent
+                finally:
+                    await upstream.aclose()
+                lap("stream", "provider", t)
+                STAGE_SECONDS.labels("stream", "sse_emit").observe(emitting)
+            ok = True
+            response_text = "".join(chunks)
+            with stage("stream", "memory_append"):
+                await memory.append(request.session_id, plan["text"], response_text)
 
         except Exception as e:
+            lap("stream", "error", t)
+            response_text = "".join(chunks) or str(e)
             error_event = {"event": "error", "message": str(e)}
-            yield f"data: {json.dumps(error_event)}\n\n"
+            yield {"data": json.dumps(error_event)}
+
+        time_taken = time.time() - start
+        used_model = route.get("model", model_name)
+        if cached is not None:
+            usage = dict(cached, cost_estimate=0.0)
+        else:
+            usage = account(used_model, prefix + plan["text"], "".join(chunks), **route.get("usage", {}))
+        with stage("stream", "log"):
+            await chat_log.log(
+                session_id=request.session_id or "anon",
+                agent_used=agent,
+                model=used_model,
+                query=user_text,
+                response=response_text,
+                confidence=0.85 if ok else 0.0,
+                processing_time=time_taken,
+                token_count=usage.get("tokens", 0),
+                input_tokens=usage.get("input_tokens", 0),
+                output_tokens=usage.get("output_tokens", 0),
+                cost_estimate=usage.get("cost_estimate", 0.0),
+                created_at=datetime.now().isoformat(),
+                cache_hit=cached is not None,
+                trace_id=current_trace_id(),
+                **decision_fields(decision)
+            )
+        lap("stream", "total", started)
+        CHAT_REQUESTS.labels("stream", "cache_hit" if cached is not None else "ok" if ok else "error").inc()
+
+        complete_event = {"event": "complete", "ok": ok, "model": used_model, "cache_hit": cached is not None,
+                          "trace_id": current_trace_id()}
+        yield {"data": json.dumps(complete_event)}
 
     return EventSourceResponse(generate_events())
 
 
-# Chat history endpoint
+# Batch chat
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+# In-flight batch items per provider, shared by every running batch; keep it
+# below PROVIDER_LIMIT_INITIAL so batches queue here instead of being shed
+BATCH_PROVIDER_CONCURRENCY = int(os.getenv("BATCH_PROVIDER_CONCURRENCY", "8"))
+BATCH_HEADROOM_WAIT = 30.0     # after this long a call goes ahead anyway (and may fall back)
+BATCH_HEADROOM_POLL = 0.05
+batch_limits = {}
+batch_active = {}              # provider -> batch calls admitted past the adaptive-limit check
+batch_saves = set()
+
+
+def batch_limit(provider: str) -> asyncio.Semaphore:
+    limit = batch_limits.get(provider)
+    if limit is None:
+        limit = batch_limits[provider] = asyncio.Semaphore(BATCH_PROVIDER_CONCURRENCY)
+    return limit
+
+
+@asynccontextmanager
+async def batch_slot(provider: str):
+    """Hold a batch call slot for ``provider``.
+
+    At most BATCH_PROVIDER_CONCURRENCY, and no more than the provider's
+    adaptive limit currently allows, so when the limit drops batch calls
+    queue here instead of being shed as "concurrency limit reached".
+    """
+    guard = guard_for(provider)
+    async with batch_limit(provider):
+        deadline = time.monotonic() + BATCH_HEADROOM_WAIT
+        while ((batch_active.get(provider, 0) >= max(1, int(guard.limiter.limit)) or not guard.has_headroom())
+               and time.monotonic() < deadline):
+            await asyncio.sleep(BATCH_HEADROOM_POLL)
+        batch_active[provider] = batch_active.get(provider, 0) + 1
+        try:
+            yield
+        finally:
+            batch_active[provider] -= 1
+
+
+async def run_batch_item(index: int, text: str, agent: str, decision: dict, session_id: str,
+                         user_id: Optional[int] = None):
+    """Answer one batch query; returns (result event, chat_sessions row or None)"""
+    if not text.strip():
+        return {"event": "result", "index": index, "ok": False, "error": "Query cannot be empty."}, None
+    with span("batch_item", index=index, agent=agent):
+        try:
+            async with batch_slot(provider_for(decision["model"])):
+                res, cache_hit = await cached_call_model(agent, decision["model"], text)
+        except Exception as e:
+            # One failed item (oversized prompt, unexpected error) must not end the batch
+            return {"event": "result", "index": index, "ok": False, "error": str(e)}, None
+
+    ok = bool(res.get("ok"))
+    model = res.get("model", decision["model"])
+    response_text = res.get("text") or res.get("error") or "(No response)"
+    fields = dict(
+        session_id=session_id,
+        agent_used=agent,
+        model=model,
+        query=text,
+        response=response_text,
+        confidence=0.85 if ok else 0.0,
+        processing_time=float(res.get("time", 0.0)),
+        token_count=int(res.get("tokens", 0)),
+        input_tokens=int(res.get("input_tokens", 0)),
+        output_tokens=int(res.get("output_tokens", 0)),
+        cost_estimate=0.0 if cache_hit else float(res.get("cost_estimate", 0.0)),
+        cache_hit=cache_hit,
+    )
+    CHAT_REQUESTS.labels("batch", "cache_hit" if cache_hit else "ok" if ok else "error").inc()
+    row = chat_row(created_at=datetime.now().isoformat(), trace_id=current_trace_id(), user_id=user_id,
+                   **fields, **decision_fields(decision))
+    event = {"event": "result", "index": index, "ok": ok}
+    event.update((key, value) for key, value in fields.items() if key not in ("session_id", "query"))
+    return event, row
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: BatchChatRequest):
+    """Answer many queries at once, streaming NDJSON results as they complete.
+
+    Agents and models are chosen for every query up front; calls then run
+    concurrently, at most BATCH_PROVIDER_CONCURRENCY per provider. Each line
+    is ``{"event": "result", "index": ...}`` for the query at that position,
+    in completion order, and the last is ``{"event": "complete", ...}``. All
+    rows are saved in one transaction once the batch is done.
+    """
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries cannot be empty.")
+    if len(request.queries) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} queries per batch.")
+
+    session_id = request.session_id or "batch"
+    with span("batch_plan", items=len(request.queries)):
+        agents = [detect_agent(text) for text in request.queries]
+        decisions = [router.choose(text) for text in request.queries]
+
+    async def generate_results():
+        start = time.perf_counter()
+        rows = []
+        errors = 0
+        pending = {asyncio.create_task(run_batch_item(index, text, agent, decision, session_id))
+                   for index, (text, agent, decision) in enumerate(zip(request.queries, agents, decisions))}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                lines = []
+                for task in done:
+                    event, row = task.result()
+                    if row is not None:
+                        rows.append(row)
+                    if not event["ok"]:
+                        errors += 1
+                    lines.append(json.dumps(event) + "\n")
+                yield "".join(lines)
+
+            saved, rows = rows, []
+            await asyncio.to_thread(save_chats, saved)
+            lap("batch", "total", start)
+            yield json.dumps({"event": "complete", "count": len(request.queries), "errors": errors,
+                              "saved": len(saved), "time": time.perf_counter() - start,
+                              "trace_id": current_trace_id()}) + "\n"
+        finally:
+            # Client went away: stop outstanding calls, still keep the answers already paid for
+            for task in pending:
+                task.cancel()
+            if rows:
+                save = asyncio.create_task(asyncio.to_thread(save_chats, rows))
+                batch_saves.add(save)
+                save.add_done_callback(batch_saves.discard)
+
+    return StreamingResponse(generate_results(), media_type="application/x-ndjson")
+
+
+# Chat history endpoints
+HISTORY_MAX_LIMIT = 500
+EXPORT_CHUNK_SIZE = 1000
+
+
+def check_user_token(user_id: Optional[int], token: Optional[str]):
+    """Filtering by user needs that user's session token"""
+    if user_id is not None:
+        auth_result = verify_session_token(token) if token else {"success": False}
+        if not auth_result["success"] or auth_result["user"]["id"] != user_id:
+            raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+def check_user_or_admin(user_id: Optional[int], token: Optional[str], admin_token: Optional[str]):
+    """One user's chats need that user's token; every user's chats need the admin token"""
+    if user_id is None:
+        if not is_admin(admin_token):
+            raise HTTPException(status_code=401, detail="user_id and token are required")
+    else:
+        check_user_token(user_id, token)
+
+
+def select_fields(fields: Optional[str]):
+    """Validate a ``fields`` projection and return the selected columns"""
+    if not fields:
+        return list(HISTORY_FIELDS)
+    selected = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = set(selected) - set(HISTORY_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return ["id"] + [f for f in selected if f != "id"]
+
+
 @app.get("/chat/history")
-def get_chat_history(limit: int = 50):
-    """Get recent chat history"""
+def get_chat_history(limit: int = 50, before_id: Optional[int] = None, fields: Optional[str] = None,
+                     user_id: Optional[int] = None, token: Optional[str] = None, admin_token: Optional[str] = None):
+    """Get a user's chat history (every user's with ``admin_token``), newest first.
+
+    Page with ``before_id`` (the ``next_before_id`` of the previous page);
+    ``fields`` is a comma-separated projection, e.g. ``id,created_at,model,query``.
+    """
+    check_user_or_admin(user_id, token, admin_token)
+    columns = select_fields(fields)
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
     try:
-        history = get_recent(limit)
+        history = get_recent(limit, user_id=user_id, before_id=before_id, fields=columns)
         return {
             "success": True,
             "history": history,
-            "count": len(history)
+            "count": len(history),
+            "next_before_id": history[-1]["id"] if len(history) == limit else None
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get chat history: {str(e)}")
 
 
+@app.get("/chat/history/export")
+def export_chat_history(format: str = "ndjson", fields: Optional[str] = None, user_id: Optional[int] = None,
+                        token: Optional[str] = None, admin_token: Optional[str] = None):
+    """Stream a user's full history (every user's with ``admin_token``) as NDJSON or CSV, one keyset page at a time"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    check_user_or_admin(user_id, token, admin_token)
+    columns = select_fields(fields)
+    pages = iter_history_pages(user_id=user_id, fields=columns, chunk_size=EXPORT_CHUNK_SIZE)
+
+    def ndjson():
+        for page in pages:
+            yield "".join(json.dumps(row) + "\n" for row in page)
+
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for page in pages:
+            writer.writerows([row[c] for c in columns] for row in page)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    # Sync generators run in the threadpool, so the SQLite reads stay off the event loop
+    return StreamingResponse(ndjson() if format == "ndjson" else csv_rows(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="chat_history.{format}"'})
+
+
+@app.get("/chat/search")
+def search_chat_history(q: str, limit: int = 20, offset: int = 0, user_id: Optional[int] = None,
+                        token: Optional[str] = None, admin_token: Optional[str] = None):
+    """Full-text search over a user's past queries and responses (every user's with ``admin_token``), best match first"""
+    check_user_or_admin(user_id, token, admin_token)
+    if not search_available():
+        raise HTTPException(status_code=501, detail="Full-text search is not available in this SQLite build")
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    offset = max(0, offset)
+    try:
+        results = search_chats(q, user_id=user_id, limit=limit, offset=offset)
+        return {
+            "success": True,
+            "results": results,
+            "count": len(results),
+            "next_offset": offset + limit if len(results) == limit else None
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
+
+
+# Bulk jobs: queued in SQLite and answered by background workers (jobs.py)
+JOB_MAX_ITEMS = int(os.getenv("JOB_MAX_ITEMS", "100000"))
+JOB_RESULT_COLUMNS = ("index", "query", "status", "attempts", "ok", "agent_used", "model", "response", "error")
+job_pool = JobWorkerPool(plan_query, run_batch_item)
+
+Collected("job_tasks_total", "Job tasks handled by this process's workers", ("outcome",),
+          lambda: [((outcome,), count) for outcome, count in job_pool.counts.items()], kind="counter")
+Collected("job_tasks_running", "Job tasks being answered by this process's workers", (),
+          lambda: [((), job_pool.running)])
+
+
+def job_or_404(job_id: int, token: Optional[str]):
+    """The job, if it exists and the token belongs to its owner (when it has one)"""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    check_user_token(job["user_id"], token)
+    return job
+
+
+def job_progress(job: dict) -> dict:
+    finished = job["completed"] + job["failed"]
+    return dict(job, pending=job["total"] - finished,
+                progress=finished / job["total"] if job["total"] else 1.0)
+
+
+def job_result(task: dict) -> dict:
+    return {
+        "index": task["idx"],
+        "query": task["query"],
+        "status": task["status"],
+        "attempts": task["attempts"],
+        "error": task["error"],
+        "result": json.loads(task["result"]) if task["result"] else None
+    }
+
+
+@app.post("/jobs")
+async def submit_job(request: JobRequest, user_id: Optional[int] = None, token: Optional[str] = None):
+    """Queue queries to be answered in the background.
+
+    Poll ``/jobs/{job_id}`` for progress and fetch ``/jobs/{job_id}/results``
+    once it is done. Answers are also saved to the chat history under the
+    request's ``session_id`` (default ``job-<id>``).
+    """
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="queries cannot be empty.")
+    if len(request.queries) > JOB_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {JOB_MAX_ITEMS} queries per job.")
+    await asyncio.to_thread(check_user_token, user_id, token)
+    job_id = await asyncio.to_thread(create_job, request.queries, user_id, request.session_id)
+    job_pool.notify()
+    return {"success": True, "job_id": job_id, "status": "queued", "total": len(request.queries)}
+
+
+@app.get("/jobs/stats")
+def jobs_stats():
+    """Queue depth by job status and this process's worker counters"""
+    return dict(job_queue_stats(), workers=job_pool.stats())
+
+
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: int, token: Optional[str] = None):
+    """Job status, task counts and progress (finished tasks over total)"""
+    return job_progress(job_or_404(job_id, token))
+
+
+@app.get("/jobs/{job_id}/results")
+def download_job_results(job_id: int, format: str = "ndjson", token: Optional[str] = None):
+    """Stream every task of a job in submission order as NDJSON or CSV; unfinished tasks have no result"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    job_or_404(job_id, token)
+    pages = iter_job_task_pages(job_id, chunk_size=EXPORT_CHUNK_SIZE)
+
+    def ndjson():
+        for page in pages:
+            yield "".join(json.dumps(job_result(task)) + "\n" for task in page)
+
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(JOB_RESULT_COLUMNS)
+        for page in pages:
+            for task in page:
+                item = job_result(task)
+                result = item.pop("result") or {}
+                writer.writerow([item.get(c, result.get(c)) for c in JOB_RESULT_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv"
+    return StreamingResponse(ndjson() if format == "ndjson" else csv_rows(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="job_{job_id}.{format}"'})
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job_tasks(job_id: int, token: Optional[str] = None):
+    """Cancel the job's queued tasks; ones already being answered still finish"""
+    job_or_404(job_id, token)
+    if not cancel_job(job_id):
+        raise HTTPException(status_code=409, detail="Job has already finished")
+    return job_progress(get_job(job_id))
+
+
+# Admin endpoints (profiling); disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def is_admin(admin_token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN and admin_token and secrets.compare_digest(admin_token, ADMIN_TOKEN))
+
+
+def check_admin_token(admin_token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if not is_admin(admin_token):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+@app.get("/admin/profile")
+async def admin_profile(seconds: float = 10.0, interval_ms: float = PROFILE_INTERVAL_MS, format: str = "folded",
+                        idle: bool = False, admin_token: Optional[str] = None):
+    """Sample all threads' stacks for ``seconds``.
+
+    ``format=folded`` returns collapsed stacks for flamegraph.pl or speedscope;
+    ``format=json`` returns the counts with sampling details. Waiting threads
+    are left out unless ``idle`` is set.
+    """
+    check_admin_token(admin_token)
+    if format not in ("folded", "json"):
+        raise HTTPException(status_code=400, detail="format must be folded or json")
+    try:
+        profile = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000, idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "folded":
+        return Response(folded(profile["stacks"]), media_type="text/plain")
+    return dict(profile, stacks=[{"stack": stack, "count": count}
+                                 for stack, count in profile["stacks"].most_common()])
+
+
+@app.get("/admin/slow-requests")
+def admin_slow_requests(limit: int = 20, admin_token: Optional[str] = None):
+    """Newest captured slow requests (SLOW_REQUEST_MS) with stage breakdown and SQL plans"""
+    check_admin_token(admin_token)
+    captured = list(slow_requests)[::-1][:max(1, limit)]
+    return {"requests": captured, "count": len(captured)}
+
+
 # Create static folder and mount it
 import os
 static_dir = "static"
@@ -418,6 +984,20 @@ def verify_user_session(token: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Session verification failed: {str(e)}")
 
+@app.post("/auth/logout")
+def logout_user(token: str):
+    """Revoke user session token"""
+    try:
+        revoked = revoke_session_token(token)
+        return {"success": revoked}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Logout failed: {str(e)}")
+
+@app.get("/auth/cache/stats")
+def auth_cache_stats():
+    """Session token cache hit/miss counters"""
+    return token_cache_stats()
+
 # Analytics endpoints
 @app.get("/analytics/user/{user_id}")
 def get_user_analytics_data(user_id: int, token: str):
@@ -444,12 +1024,19 @@ def generate_user_report(user_id: int, token: str, days: int = 30):
         if not auth_result["success"] or auth_result["user"]["id"] != user_id:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
-        analytics = get_user_analytics(user_id)
+        if days < 1:
+            raise HTTPException(status_code=400, detail="days must be at least 1")
+        
+        period_end = datetime.now()
+        period_start = period_end - timedelta(days=days)
+        analytics = get_user_analytics_range(user_id, period_start, period_end)
         
         # Calculate additional metrics
         report = {
             "user_info": auth_result["user"],
             "period_days": days,
+            "period_start": period_start.isoformat(),
+            "period_end": period_end.isoformat(),
             "summary": {
                 "total_conversations": analytics["stats"]["total_chats"] or 0,
                 "total_tokens_used": analytics["stats"]["total_tokens"] or 0,
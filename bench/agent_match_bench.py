@@ -0,0 +1,109 @@
+"""Benchmark detect_agent: per-keyword substring scans vs. the compiled matcher.
+
+Usage:
+    python bench/agent_match_bench.py [--sizes 200 2000 20000 200000] [--agents 4 12 48] [--json out.json]
+
+Matchers compared:
+    substring  the original detect_agent: lower() then `any(w in text ...)` per agent list
+    compiled   agent_matcher.KeywordMatcher: one word-bounded trie regex pass scoring all agents
+
+Catalogs: "4" is agents.json; larger numbers add synthetic agents with 12 keywords each.
+Queries are filler text with a single keyword at the end, the worst case for the substring scan.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_matcher import AGENTS_CONFIG, KeywordMatcher
+
+FILLER = ("the a of and to in is was for on with as by at from this that which "
+          "server data user value model table query result system network memory").split()
+
+
+def catalog(size):
+    with open(AGENTS_CONFIG) as f:
+        agents = json.load(f)["agents"]
+    rng = random.Random(size)
+    for i in range(len(agents), size):
+        keywords = {f"kw{i}x{j}{rng.choice('abcdefgh')}": 1.0 for j in range(12)}
+        agents.append({"name": f"Agent {i}", "priority": 0, "keywords": keywords})
+    return agents
+
+
+def substring_detector(agents):
+    lists = [(agent["name"], list(agent["keywords"])) for agent in
+             sorted(agents, key=lambda agent: -agent.get("priority", 0))]
+
+    def detect(text):
+        lower_text = text.lower()
+        for name, keywords in lists:
+            if any(w in lower_text for w in keywords):
+                return name
+        return "General Assistant"
+    return detect
+
+
+def query(size, keyword):
+    rng = random.Random(size)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words) + " " + keyword
+
+
+def time_call(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[200, 2000, 20000, 200000])
+    parser.add_argument("--agents", type=int, nargs="+", default=[4, 12, 48])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'agents':>7} {'keywords':>9} {'bytes':>8} {'substring ms':>13} {'compiled ms':>12} {'speedup':>8}")
+    for size in args.agents:
+        agents = catalog(size)
+        substring = substring_detector(agents)
+        compiled = KeywordMatcher(agents)
+        # A keyword of the agent scanned last, so every other list is scanned first
+        last = sorted(agents, key=lambda agent: -agent.get("priority", 0))[-1]
+        keyword = next(iter(last["keywords"]))
+        for length in args.sizes:
+            text = query(length, keyword)
+            assert substring(text) == compiled.detect(text)
+            result = {
+                "agents": len(agents),
+                "keywords": len(compiled.keywords),
+                "bytes": len(text),
+                "substring_ms": time_call(lambda: substring(text), args.repeat),
+                "compiled_ms": time_call(lambda: compiled.detect(text), args.repeat),
+            }
+            result["speedup"] = result["substring_ms"] / result["compiled_ms"]
+            results.append(result)
+            print(f"{result['agents']:>7} {result['keywords']:>9} {result['bytes']:>8} "
+                  f"{result['substring_ms']:>13.3f} {result['compiled_ms']:>12.3f} {result['speedup']:>7.1f}x")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
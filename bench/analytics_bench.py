@@ -0,0 +1,151 @@
+"""Benchmark analytics/history queries against table size across schema versions.
+
+Usage:
+    python bench/analytics_bench.py [--sizes 1000 10000 100000] [--users 50] [--json out.json]
+
+Schemas compared:
+    no-index  migration 2, analytics aggregated from raw chat_sessions rows
+    indexed   migration 3 (secondary indexes), same raw aggregation
+    rollup    latest schema, db.get_user_analytics() over chat_daily_rollups
+
+Each size is loaded into a fresh temporary database, so data.db is never touched.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+AGENTS = ["Code Assistant", "Research Assistant", "Task Helper", "General Assistant"]
+MODELS = ["gemini-1.5-flash-8b", "gemini-1.5-flash", "deepseeker-1.0"]
+
+
+def load_rows(rows, users):
+    now = datetime.now()
+    batch = []
+    for i in range(rows):
+        created_at = (now - timedelta(minutes=random.randint(0, 365 * 24 * 60))).isoformat()
+        batch.append(db.chat_row(
+            session_id=f"s{random.randint(1, users * 10)}",
+            agent_used=random.choice(AGENTS),
+            model=random.choice(MODELS),
+            query="benchmark query " * 5,
+            response="benchmark response " * 20,
+            confidence=0.85,
+            processing_time=random.random() * 3,
+            token_count=random.randint(50, 800),
+            created_at=created_at,
+            user_id=random.randint(1, users),
+        ))
+        if len(batch) == 5000:
+            insert_rows(batch)
+            batch = []
+    if batch:
+        insert_rows(batch)
+
+
+# chat_sessions columns as of migration 2/3
+LEGACY_INSERT_SQL = """
+INSERT INTO chat_sessions
+(user_id, session_id, agent_used, model, query, response, confidence, processing_time,
+ token_count, input_tokens, output_tokens, cost_estimate, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# History columns that exist at migration 2/3 (cache_hit, route_* and trace_id came later)
+LEGACY_HISTORY_FIELDS = db.HISTORY_FIELDS[:db.HISTORY_FIELDS.index("created_at") + 1]
+
+
+def insert_rows(rows):
+    if db.schema_version() >= 4:
+        db.save_chats(rows)
+        return
+    conn = db.get_conn()
+    with conn:
+        conn.executemany(LEGACY_INSERT_SQL, [row[:13] for row in rows])
+
+
+def raw_user_analytics(user_id):
+    """The analytics queries as they ran before rollup tables (migration < 4)"""
+    cur = db.get_conn().cursor()
+    cur.execute("""
+    SELECT COUNT(*), SUM(token_count), SUM(input_tokens), SUM(output_tokens),
+           AVG(processing_time), AVG(confidence), SUM(cost_estimate)
+    FROM chat_sessions WHERE user_id = ?
+    """, (user_id,))
+    cur.fetchall()
+    cur.execute("SELECT agent_used, COUNT(*) FROM chat_sessions WHERE user_id = ? GROUP BY agent_used", (user_id,))
+    cur.fetchall()
+    cur.execute("SELECT model, COUNT(*), AVG(processing_time) FROM chat_sessions WHERE user_id = ? GROUP BY model", (user_id,))
+    cur.fetchall()
+    cur.execute("""
+    SELECT DATE(created_at), COUNT(*), SUM(token_count) FROM chat_sessions
+    WHERE user_id = ? AND DATE(created_at) >= DATE('now', '-30 days')
+    GROUP BY DATE(created_at)
+    """, (user_id,))
+    cur.fetchall()
+
+
+def time_call(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run_size(rows, users, target, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        db.migrate(target=target)
+        random.seed(rows)
+        load_rows(rows, users)
+        db.get_conn().execute("ANALYZE")
+
+        user_id = 1
+        analytics = db.get_user_analytics if db.schema_version() >= 4 else raw_user_analytics
+        fields = None if db.schema_version() >= 4 else LEGACY_HISTORY_FIELDS
+        result = {
+            "rows": rows,
+            "schema_version": db.schema_version(),
+            "get_user_analytics_ms": time_call(lambda: analytics(user_id), repeat),
+            "get_recent_user_ms": time_call(lambda: db.get_recent(50, user_id=user_id, fields=fields), repeat),
+        }
+        db.close_connections()
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'rows':>10} {'schema':>9} {'analytics ms':>14} {'recent(user) ms':>16}")
+    for rows in args.sizes:
+        for label, target in (("no-index", 2), ("indexed", 3), ("rollup", None)):
+            result = run_size(rows, args.users, target, args.repeat)
+            result["label"] = label
+            results.append(result)
+            print(f"{rows:>10} {label:>9} {result['get_user_analytics_ms']:>14.2f} "
+                  f"{result['get_recent_user_ms']:>16.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
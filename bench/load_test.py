@@ -0,0 +1,289 @@
+"""Load-test the app against the local mock provider and report latency percentiles.
+
+Usage:
+    python bench/load_test.py [--concurrency 10 50] [--duration 20]
+                              [--mix chat=5,stream=3,history=1,analytics=1]
+                              [--latency-ms 300] [--jitter 0.5] [--error-rate 0.01] [--tokens-per-sec 80]
+                              [--json results.json] [--compare baseline.json]
+
+Starts bench/mock_provider.py and the app (uvicorn, temporary database) as
+subprocesses, so no provider API credits are used and data.db is never
+touched. Pass --base-url to drive an app that is already running instead.
+
+For every concurrency level and endpoint it reports throughput, errors,
+p50/p95/p99 latency and, for /chat/stream, time to first token, plus the
+SQLite write-lock waits from /db/stats. --compare prints the change in
+throughput and p95 against an earlier --json file.
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOPICS = ["python function", "database index", "research study", "setup guide", "network error",
+          "compare frameworks", "debug this bug", "how to deploy", "explain caching", "sort a list"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+def random_query():
+    # Random suffix so the response cache and single-flight do not absorb the load
+    return f"{random.choice(TOPICS)} {random.getrandbits(32):x} please"
+
+
+async def wait_ready(url, timeout=30.0):
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_servers(args, tmp):
+    mock_port, app_port = free_port(), free_port()
+    mock = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "bench", "mock_provider.py"), "--port", str(mock_port),
+        "--latency-ms", str(args.latency_ms), "--jitter", str(args.jitter),
+        "--error-rate", str(args.error_rate), "--tokens-per-sec", str(args.tokens_per_sec)])
+    env = dict(os.environ,
+               DB_PATH=os.path.join(tmp, "load.db"),
+               GEMINI_URL=f"http://127.0.0.1:{mock_port}/v1beta/models",
+               DEEPSEEK_URL=f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+               GEMINI_API_KEY="mock", DEEPSEEKER_API_KEY="mock")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--port", str(app_port),
+                               "--log-level", "warning"], cwd=ROOT, env=env)
+    return [mock, server], f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{app_port}"
+
+
+async def login(client):
+    """Register a throwaway user and return (user_id, token) for the analytics endpoints"""
+    name = f"load{random.getrandbits(32):x}"
+    await client.post("/auth/register", json={"username": name, "email": f"{name}@bench.local",
+                                              "password": "load-test-password"})
+    result = (await client.post("/auth/login", json={"username": name, "password": "load-test-password"})).json()
+    return result.get("user_id"), result.get("token")
+
+
+async def run_chat(client, sample, user):
+    response = await client.post("/chat", json={"query": random_query(), "session_id": sample["session"]})
+    return response.status_code == 200 and response.json().get("confidence", 0) > 0
+
+
+async def run_stream(client, sample, user):
+    ok = False
+    async with client.stream("POST", "/chat/stream",
+                             json={"query": random_query(), "session_id": sample["session"]}) as response:
+        async for line in response.aiter_lines():
+            if '"event": "delta"' in line and "ttft" not in sample:
+                sample["ttft"] = time.perf_counter() - sample["start"]
+            elif '"event": "complete"' in line:
+                ok = '"ok": true' in line
+    return ok
+
+
+async def run_history(client, sample, user):
+    user_id, token = user
+    response = await client.get("/chat/history", params={"user_id": user_id, "token": token, "limit": 50})
+    return response.status_code == 200
+
+
+async def run_analytics(client, sample, user):
+    user_id, token = user
+    if random.random() < 0.5:
+        response = await client.get(f"/analytics/user/{user_id}", params={"token": token})
+    else:
+        response = await client.get(f"/analytics/report/{user_id}", params={"token": token, "days": 30})
+    return response.status_code == 200
+
+
+SCENARIOS = {"chat": run_chat, "stream": run_stream, "history": run_history, "analytics": run_analytics}
+
+
+async def run_level(base_url, concurrency, duration, mix, user):
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    samples = []
+    stop_at = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0, limits=limits) as client:
+        lock_before = (await client.get("/db/stats")).json()["lock_waits"]
+
+        async def worker(index):
+            while time.perf_counter() < stop_at:
+                name = random.choices(names, weights)[0]
+                sample = {"endpoint": name, "session": f"load-{index}", "start": time.perf_counter()}
+                try:
+                    sample["ok"] = await SCENARIOS[name](client, sample, user)
+                except httpx.HTTPError:
+                    sample["ok"] = False
+                sample["latency"] = time.perf_counter() - sample["start"]
+                samples.append(sample)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        lock_after = (await client.get("/db/stats")).json()["lock_waits"]
+
+    endpoints = {}
+    for name in names:
+        done = [s for s in samples if s["endpoint"] == name]
+        if not done:
+            continue
+        latencies = [s["latency"] * 1000 for s in done]
+        ttfts = [s["ttft"] * 1000 for s in done if "ttft" in s]
+        endpoints[name] = {
+            "requests": len(done),
+            "errors": sum(1 for s in done if not s["ok"]),
+            "throughput_rps": len(done) / elapsed,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "ttft_p50_ms": percentile(ttfts, 0.50),
+            "ttft_p95_ms": percentile(ttfts, 0.95),
+        }
+    waits = lock_after["count"] - lock_before["count"]
+    return {
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "requests": len(samples),
+        "throughput_rps": len(samples) / elapsed,
+        "endpoints": endpoints,
+        "lock_waits": {
+            "transactions": waits,
+            "avg_ms": (lock_after["total"] - lock_before["total"]) / waits * 1000 if waits else 0.0,
+            "max_ms": lock_after["max"] * 1000,
+            "busy_errors": lock_after["busy_errors"] - lock_before["busy_errors"],
+        },
+    }
+
+
+def fmt(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def print_level(level):
+    print(f"\nconcurrency {level['concurrency']}: {level['requests']} requests, "
+          f"{level['throughput_rps']:.1f} req/s, lock waits avg {level['lock_waits']['avg_ms']:.2f} ms "
+          f"max {level['lock_waits']['max_ms']:.2f} ms over {level['lock_waits']['transactions']} transactions")
+    print(f"{'endpoint':>10} {'reqs':>6} {'errors':>6} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8} "
+          f"{'ttft p50':>9} {'ttft p95':>9}")
+    for name, e in level["endpoints"].items():
+        print(f"{name:>10} {e['requests']:>6} {e['errors']:>6} {e['throughput_rps']:>7.1f} {fmt(e['p50_ms']):>8} "
+              f"{fmt(e['p95_ms']):>8} {fmt(e['p99_ms']):>8} {fmt(e['ttft_p50_ms']):>9} {fmt(e['ttft_p95_ms']):>9}")
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    print(f"\nvs. {baseline_path} (positive = slower / less throughput)")
+    for level in results["levels"]:
+        old = baseline.get(level["concurrency"])
+        if old is None:
+            continue
+        for name, e in level["endpoints"].items():
+            before = old["endpoints"].get(name)
+            if before is None or not before["p95_ms"]:
+                continue
+            p95 = (e["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100
+            rps = (before["throughput_rps"] - e["throughput_rps"]) / before["throughput_rps"] * 100
+            print(f"  c={level['concurrency']:<4} {name:>10}  p95 {p95:+6.1f}%  throughput {rps:+6.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    mix = parse_mix(args.mix)
+    unknown = set(mix) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    processes = []
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            if args.base_url:
+                base_url = args.base_url
+            else:
+                processes, mock_url, base_url = start_servers(args, tmp)
+                await wait_ready(mock_url + "/stats")
+            await wait_ready(base_url + "/db/stats")
+
+            async with httpx.AsyncClient(base_url=base_url, timeout=30.0) as client:
+                user = await login(client)
+
+            results = {
+                "commit": git_commit(),
+                "config": vars(args),
+                "levels": [],
+            }
+            for concurrency in args.concurrency:
+                level = await run_level(base_url, concurrency, args.duration, mix, user)
+                results["levels"].append(level)
+                print_level(level)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per concurrency level")
+    parser.add_argument("--mix", default="chat=5,stream=3,history=1,analytics=1")
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--base-url", help="drive an already running app instead of starting one")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="earlier --json results to compare against")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Local mock of the Gemini and DeepSeek HTTP APIs for benchmarks and load tests.
+
+Usage:
+    python bench/mock_provider.py [--port 8900] [--latency-ms 300] [--jitter 0.5] [--error-rate 0.01]
+                                  [--tokens-per-sec 80] [--response-tokens 120]
+
+Point the app at it with:
+    GEMINI_URL=http://127.0.0.1:8900/v1beta/models
+    DEEPSEEK_URL=http://127.0.0.1:8900/v1/chat/completions
+
+Latency to the first token is log-normal with median --latency-ms and shape --jitter
+(0 for a fixed delay); the response then arrives at --tokens-per-sec, in chunks for
+streaming requests. --error-rate of the requests fail with HTTP 500 (or 429 with
+--rate-limit-share of those).
+"""
+import json
+import random
+import asyncio
+import argparse
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("the model answers with plain words so token counts stay predictable across runs "
+         "and every chunk carries a few of them").split()
+CHUNK_TOKENS = 5
+
+
+def create_app(latency_ms=300.0, jitter=0.5, error_rate=0.0, rate_limit_share=0.0,
+               tokens_per_sec=80.0, response_tokens=120):
+    app = FastAPI(title="Mock LLM provider")
+    app.state.requests = 0
+
+    def first_token_delay():
+        if jitter <= 0:
+            return latency_ms / 1000
+        return random.lognormvariate(0, jitter) * latency_ms / 1000
+
+    def failure():
+        if random.random() >= error_rate:
+            return None
+        if random.random() < rate_limit_share:
+            return JSONResponse({"error": {"message": "rate limited"}}, status_code=429)
+        return JSONResponse({"error": {"message": "mock provider error"}}, status_code=500)
+
+    def chunks():
+        words = [random.choice(WORDS) for _ in range(response_tokens)]
+        return [" ".join(words[i:i + CHUNK_TOKENS]) + " " for i in range(0, len(words), CHUNK_TOKENS)]
+
+    def prompt_tokens(text):
+        return len(text.split())
+
+    async def sse(events):
+        """Send SSE events, pacing them at tokens_per_sec after the first-token delay"""
+        await asyncio.sleep(first_token_delay())
+        for index, event in enumerate(events):
+            if index:
+                await asyncio.sleep(CHUNK_TOKENS / tokens_per_sec)
+            yield f"data: {json.dumps(event)}\r\n\r\n" if isinstance(event, dict) else f"data: {event}\r\n\r\n"
+
+    @app.post("/v1beta/models/{target}")
+    async def gemini(target: str, request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        text = body["contents"][-1]["parts"][0]["text"]
+        error = failure()
+        if error is not None:
+            await asyncio.sleep(first_token_delay())
+            return error
+
+        parts = chunks()
+        usage = {"promptTokenCount": prompt_tokens(text), "candidatesTokenCount": response_tokens,
+                 "totalTokenCount": prompt_tokens(text) + response_tokens}
+        if target.endswith(":streamGenerateContent"):
+            events = [{"candidates": [{"content": {"parts": [{"text": part}]}}]} for part in parts]
+            events[-1]["usageMetadata"] = usage
+            return StreamingResponse(sse(events), media_type="text/event-stream")
+
+        await asyncio.sleep(first_token_delay() + response_tokens / tokens_per_sec)
+        return {"candidates": [{"content": {"parts": [{"text": "".join(parts)}]}}], "usageMetadata": usage}
+
+    @app.post("/v1/chat/completions")
+    async def deepseek(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        text = body["messages"][-1]["content"]
+        error = failure()
+        if error is not None:
+            await asyncio.sleep(first_token_delay())
+            return error
+
+        parts = chunks()
+        usage = {"prompt_tokens": prompt_tokens(text), "completion_tokens": response_tokens,
+                 "total_tokens": prompt_tokens(text) + response_tokens}
+        if body.get("stream"):
+            events = [{"choices": [{"delta": {"content": part}}]} for part in parts]
+            events.append({"choices": [], "usage": usage})
+            events.append("[DONE]")
+            return StreamingResponse(sse(events), media_type="text/event-stream")
+
+        await asyncio.sleep(first_token_delay() + response_tokens / tokens_per_sec)
+        return {"choices": [{"message": {"content": "".join(parts)}}], "usage": usage}
+
+    @app.get("/stats")
+    def stats():
+        return {"requests": app.state.requests}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-share", type=float, default=0.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--response-tokens", type=int, default=120)
+    args = parser.parse_args()
+
+    import uvicorn
+    app = create_app(args.latency_ms, args.jitter, args.error_rate, args.rate_limit_share,
+                     args.tokens_per_sec, args.response_tokens)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry expiry time.
+
+    Entries expire ``ttl`` seconds after they are set, or earlier if an
+    explicit ``expires_at`` (epoch seconds) is given. When ``maxsize``
+    entries (or ``max_weight`` total, as measured by ``weigher``) is
+    exceeded the least recently used entries are evicted.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0, max_weight=None, weigher=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigher = weigher
+        self.weight = 0
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, weight = entry
+            if expires_at <= now:
+                del self.data[key]
+                self.weight -= weight
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None, ttl=None):
+        deadline = time.time() + (self.ttl if ttl is None else ttl)
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        weight = self.weigher(value) if self.weigher else 0
+        with self.lock:
+            old = self.data.pop(key, None)
+            if old is not None:
+                self.weight -= old[2]
+            self.data[key] = (value, deadline, weight)
+            self.weight += weight
+            while len(self.data) > self.maxsize or (
+                    self.max_weight is not None and self.weight > self.max_weight and len(self.data) > 1):
+                _, (_, _, evicted_weight) = self.data.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is not None:
+                self.weight -= entry[2]
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.weight = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "weight": self.weight,
+            "max_weight": self.max_weight,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+
+from db import chat_row, save_chats
+from tracing import current_span, span
+
+logger = logging.getLogger(__name__)
+
+CHAT_LOG_BATCH_SIZE = 200      # flush once this many rows are pending
+CHAT_LOG_FLUSH_INTERVAL = 0.5  # ...or once the oldest pending row is this old (seconds)
+CHAT_LOG_MAX_PENDING = 10000   # queue bound; log() waits when it is full
+CHAT_LOG_MAX_ATTEMPTS = 5      # writes of one batch before its rows are dropped
+CHAT_LOG_RETRY_BASE = 0.5      # seconds before the first retry, doubling after
+
+
+class ChatLogWriter:
+    """Write-behind queue for chat_sessions rows.
+
+    Requests hand rows to ``log()`` and return immediately; a background task
+    groups them and inserts each group with one ``executemany`` transaction.
+    The queue is bounded, so a stalled disk slows producers down instead of
+    growing memory without limit. A failed write (e.g. "database is locked")
+    is retried with backoff; rows are only dropped, and counted in
+    ``dropped``, after CHAT_LOG_MAX_ATTEMPTS. ``stop()`` drains everything
+    still queued.
+    """
+
+    def __init__(self, batch_size=CHAT_LOG_BATCH_SIZE, flush_interval=CHAT_LOG_FLUSH_INTERVAL,
+                 max_pending=CHAT_LOG_MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.queue = None
+        self.task = None
+        self.dropped = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush every queued row, then stop the background task"""
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    def pending(self) -> int:
+        """Rows queued but not yet written"""
+        return 0 if self.queue is None else self.queue.qsize()
+
+    async def log(self, **fields):
+        """Queue a chat row (same keyword arguments as db.save_chat)"""
+        row = chat_row(**fields)
+        if self.task is None:
+            # Not running under the app lifespan: write straight through
+            await asyncio.to_thread(save_chats, [row])
+            return
+        # The request's span is linked from the batch write that stores the row
+        await self.queue.put((row, current_span.get()))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            entry = await self.queue.get()
+            if entry is None:
+                break
+
+            batch = [entry]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        rows = [row for row, _ in batch]
+        links = [(origin.trace_id, origin.span_id) for _, origin in batch if origin is not None]
+        for attempt in range(1, CHAT_LOG_MAX_ATTEMPTS + 1):
+            try:
+                with span("save_chats", rows=len(rows), links=links, attempt=attempt):
+                    await asyncio.to_thread(save_chats, rows)
+                return
+            except Exception:
+                if attempt == CHAT_LOG_MAX_ATTEMPTS:
+                    self.dropped += len(rows)
+                    logger.exception("Dropped %d chat rows after %d failed writes", len(rows), attempt)
+                    return
+                logger.warning("Writing %d chat rows failed (attempt %d), retrying", len(rows), attempt,
+                               exc_info=True)
+                await asyncio.sleep(CHAT_LOG_RETRY_BASE * 2 ** (attempt - 1))
@@ -1,16 +1,124 @@
+import os
+import re
+import time
 import sqlite3
 from datetime import datetime
 import hashlib
 import secrets
+import threading
+import weakref
+from datetime import timedelta
 
-DB_PATH = "data.db"
+from cache import TTLCache
+from metrics import timed_query
+from profiler import SLOW_REQUEST_MS, record_statement
+
+DB_PATH = os.getenv("DB_PATH", "data.db")
 DB_TIMEOUT = 5.0  
+DB_CACHE_KB = 64000            # page cache per connection (PRAGMA cache_size, in KiB)
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_STATEMENT_CACHE = 256       # prepared statements kept per connection
 
+_local = threading.local()
+_connections = set()          # open connections of live threads
+_connections_lock = threading.Lock()
+_generation = 0                # bumped by close_connections() so threads reopen
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    cur = conn.cursor()
-    
+# Time spent waiting for the write lock on the chat write path
+_lock_waits = {"count": 0, "total": 0.0, "max": 0.0, "busy_errors": 0}
+_lock_waits_lock = threading.Lock()
+
+# Session token -> user cache. Entries live until the session's expires_at or
+# TOKEN_CACHE_TTL, whichever is first; the TTL bounds staleness for changes
+# made by other processes, explicit invalidation covers this one.
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 60.0
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+_user_versions = {}            # user_id -> version; bumping it drops that user's cached tokens
+_invalidations = 0             # total invalidations, to detect one racing a cache fill
+
+
+def _open_conn():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    if SLOW_REQUEST_MS:
+        # Statements are only kept while a request is being captured
+        conn.set_trace_callback(record_statement)
+    return conn
+
+
+class _ThreadConn:
+    """Holder for one thread's connection, kept in ``_local``.
+
+    Thread-local values are dropped when their thread exits; the finalizer
+    then closes the connection, so recycled executor threads do not leave
+    open connections (and file descriptors) behind.
+    """
+
+    __slots__ = ("conn", "key", "__weakref__")
+
+    def __init__(self, conn, key):
+        self.conn = conn
+        self.key = key
+        with _connections_lock:
+            _connections.add(conn)
+        weakref.finalize(self, _release_conn, conn)
+
+
+def _release_conn(conn):
+    with _connections_lock:
+        _connections.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def get_conn():
+    """Return this thread's connection, opening it once on first use.
+
+    Connections stay open for the life of the thread, so the PRAGMA setup
+    and the per-connection prepared statement cache are paid for once.
+    """
+    holder = getattr(_local, "holder", None)
+    if holder is None or holder.key != (DB_PATH, _generation):
+        holder = _local.holder = _ThreadConn(_open_conn(), (DB_PATH, _generation))
+    return holder.conn
+
+
+def open_connection_count() -> int:
+    """Connections currently open (at most one per live thread)"""
+    with _connections_lock:
+        return len(_connections)
+
+
+def close_connections():
+    """Close every pooled connection (called on shutdown)"""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+# Schema migrations
+#
+# Each migration runs once, in order, inside its own transaction, and the
+# schema version is tracked with PRAGMA user_version. Append new migrations
+# to MIGRATIONS; never edit one that has already shipped.
+
+def _migration_1_base_tables(cur):
     # Users table
     cur.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -56,9 +164,235 @@ def init_db():
         FOREIGN KEY (user_id) REFERENCES users (id)
     )
     """)
+
+def _add_missing_columns(cur, table, columns):
+    existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns:
+        if name not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+def _migration_2_chat_usage_columns(cur):
+    # Databases created before users/token tracking have the old chat_sessions layout
+    _add_missing_columns(cur, "chat_sessions", [
+        ("user_id", "INTEGER"),
+        ("input_tokens", "INTEGER DEFAULT 0"),
+        ("output_tokens", "INTEGER DEFAULT 0"),
+        ("cost_estimate", "REAL DEFAULT 0.0"),
+    ])
+
+def _migration_3_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_id ON chat_sessions (user_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_created ON chat_sessions (user_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_model ON chat_sessions (user_id, model)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_agent ON chat_sessions (user_id, agent_used)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_sessions (session_id, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions (user_id, expires_at)")
+    cur.execute("ANALYZE")
+
+def _migration_4_daily_rollups(cur):
+    # One row per (user, day, agent, model), kept current by save_chats()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS chat_daily_rollups (
+        user_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        agent_used TEXT NOT NULL,
+        model TEXT NOT NULL,
+        chats INTEGER DEFAULT 0,
+        tokens INTEGER DEFAULT 0,
+        input_tokens INTEGER DEFAULT 0,
+        output_tokens INTEGER DEFAULT 0,
+        processing_time_sum REAL DEFAULT 0.0,
+        confidence_sum REAL DEFAULT 0.0,
+        cost REAL DEFAULT 0.0,
+        PRIMARY KEY (user_id, day, agent_used, model)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    INSERT OR REPLACE INTO chat_daily_rollups
+    SELECT user_id, substr(created_at, 1, 10), COALESCE(agent_used, ''), COALESCE(model, ''),
+           COUNT(*), COALESCE(SUM(token_count), 0), COALESCE(SUM(input_tokens), 0),
+           COALESCE(SUM(output_tokens), 0), COALESCE(SUM(processing_time), 0.0),
+           COALESCE(SUM(confidence), 0.0), COALESCE(SUM(cost_estimate), 0.0)
+    FROM chat_sessions
+    WHERE user_id IS NOT NULL AND created_at IS NOT NULL
+    GROUP BY 1, 2, 3, 4
+    """)
+
+def _migration_5_response_cache(cur):
+    _add_missing_columns(cur, "chat_sessions", [("cache_hit", "INTEGER DEFAULT 0")])
+    # Persistent tier of the response cache (see response_cache.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS response_cache (
+        cache_key TEXT PRIMARY KEY,
+        agent_used TEXT,
+        model TEXT,
+        result TEXT,
+        created_at REAL,
+        expires_at REAL
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)")
+
+def _migration_6_route_decisions(cur):
+    # Model router decision per chat (see ModelRouter in routing.py)
+    _add_missing_columns(cur, "chat_sessions", [
+        ("routed_model", "TEXT"),
+        ("route_policy", "TEXT"),
+        ("route_reason", "TEXT"),
+        ("route_inputs", "TEXT"),
+    ])
+
+def _migration_7_conversation_memory(cur):
+    # Compacted per-session conversation state (see memory.py), read by
+    # primary key instead of scanning chat_sessions on every message
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS conversation_memory (
+        session_id TEXT PRIMARY KEY,
+        summary TEXT,
+        turns TEXT,
+        updated_at REAL
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conversation_updated ON conversation_memory (updated_at)")
+
+def _migration_8_chat_search(cur):
+    # Full-text index over chat_sessions.query/response (external content, so
+    # the text is not stored twice), kept in sync by triggers
+    try:
+        cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(
+            query, response, content='chat_sessions', content_rowid='id',
+            tokenize='porter unicode61'
+        )
+        """)
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5: search stays unavailable
+        return
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chat_search_insert AFTER INSERT ON chat_sessions BEGIN
+        INSERT INTO chat_search (rowid, query, response) VALUES (new.id, new.query, new.response);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chat_search_delete AFTER DELETE ON chat_sessions BEGIN
+        INSERT INTO chat_search (chat_search, rowid, query, response) VALUES ('delete', old.id, old.query, old.response);
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS chat_search_update AFTER UPDATE OF query, response ON chat_sessions BEGIN
+        INSERT INTO chat_search (chat_search, rowid, query, response) VALUES ('delete', old.id, old.query, old.response);
+        INSERT INTO chat_search (rowid, query, response) VALUES (new.id, new.query, new.response);
+    END
+    """)
+    cur.execute("INSERT INTO chat_search (chat_search) VALUES ('rebuild')")
+
+def _migration_9_trace_ids(cur):
+    # Trace ID of the request that produced each chat (see tracing.py)
+    _add_missing_columns(cur, "chat_sessions", [("trace_id", "TEXT")])
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_chat_sessions_trace ON chat_sessions (trace_id) "
+                "WHERE trace_id IS NOT NULL")
+
+def _migration_10_job_queue(cur):
+    # Durable bulk job queue (see jobs.py): one jobs row per submission, one
+    # job_tasks row per query. available_at is when a pending task becomes
+    # due, or when a leased task's lease runs out and it may be claimed again.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        session_id TEXT,
+        status TEXT NOT NULL,
+        total INTEGER NOT NULL,
+        completed INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at REAL,
+        updated_at REAL,
+        finished_at REAL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS job_tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_id INTEGER NOT NULL,
+        idx INTEGER NOT NULL,
+        query TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at REAL NOT NULL,
+        worker TEXT,
+        result TEXT,
+        error TEXT,
+        updated_at REAL,
+        FOREIGN KEY (job_id) REFERENCES jobs (id)
+    )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_job_tasks_job ON job_tasks (job_id, idx)")
+    # Only claimable tasks are indexed, so finished ones cost the claim query nothing
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_job_tasks_due ON job_tasks (available_at) "
+                "WHERE status IN ('pending', 'leased')")
+
+def _migration_11_job_rate_limits(cur):
+    # Token buckets for job provider calls (see jobs.RateLimiter), shared by
+    # every worker process using this database
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS job_rate_limits (
+        provider TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+
+MIGRATIONS = [
+    _migration_1_base_tables,
+    _migration_2_chat_usage_columns,
+    _migration_3_indexes,
+    _migration_4_daily_rollups,
+    _migration_5_response_cache,
+    _migration_6_route_decisions,
+    _migration_7_conversation_memory,
+    _migration_8_chat_search,
+    _migration_9_trace_ids,
+    _migration_10_job_queue,
+    _migration_11_job_rate_limits,
+]
+
+def schema_version(conn=None):
+    conn = conn or get_conn()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn=None, target=None):
+    """Apply pending migrations up to ``target`` (default: latest)"""
+    conn = conn or get_conn()
+    target = len(MIGRATIONS) if target is None else target
+    version = schema_version(conn)
     
-    conn.commit()
-    conn.close()
+    for number in range(version + 1, target + 1):
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            # Another process may have migrated while we waited for the lock
+            if schema_version(conn) >= number:
+                conn.rollback()
+                continue
+            MIGRATIONS[number - 1](cur)
+            cur.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+def init_db():
+    migrate()
+
+def explain_query_plan(sql: str):
+    """EXPLAIN QUERY PLAN lines for ``sql`` (placeholders bound to NULL), or None if it cannot be planned"""
+    try:
+        rows = get_conn().execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+    except sqlite3.Error:
+        return None
+    return [row["detail"] for row in rows]
 
 # User Authentication Functions
 def hash_password(password: str) -> str:
@@ -75,100 +409,132 @@ def verify_password(password: str, password_hash: str) -> bool:
     except:
         return False
 
+@timed_query
 def create_user(username: str, email: str, password: str):
     """Create new user"""
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    cur = conn.cursor()
+    conn = get_conn()
     
     password_hash = hash_password(password)
     created_at = datetime.now().isoformat()
     
     try:
-        cur.execute("""
-        INSERT INTO users (username, email, password_hash, created_at)
-        VALUES (?, ?, ?, ?)
-        """, (username, email, password_hash, created_at))
+        with conn:
+            cur = conn.execute("""
+            INSERT INTO users (username, email, password_hash, created_at)
+            VALUES (?, ?, ?, ?)
+            """, (username, email, password_hash, created_at))
         
-        user_id = cur.lastrowid
-        conn.commit()
-        return {"success": True, "user_id": user_id}
+        return {"success": True, "user_id": cur.lastrowid}
     except sqlite3.IntegrityError as e:
         return {"success": False, "error": "Username or email already exists"}
-    finally:
-        conn.close()
 
+@timed_query
 def authenticate_user(username: str, password: str):
     """Authenticate user login"""
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    conn = get_conn()
     
-    cur.execute("SELECT * FROM users WHERE username = ? AND is_active = 1", (username,))
-    user = cur.fetchone()
+    user = conn.execute("SELECT * FROM users WHERE username = ? AND is_active = 1", (username,)).fetchone()
     
     if user and verify_password(password, user["password_hash"]):
         # Update last login
-        cur.execute("UPDATE users SET last_login = ? WHERE id = ?", 
-                   (datetime.now().isoformat(), user["id"]))
-        conn.commit()
-        conn.close()
+        with conn:
+            conn.execute("UPDATE users SET last_login = ? WHERE id = ?", 
+                         (datetime.now().isoformat(), user["id"]))
         return {"success": True, "user": dict(user)}
     
-    conn.close()
     return {"success": False, "error": "Invalid username or password"}
 
+def invalidate_user_tokens(user_id: int):
+    """Drop every cached session of a user (profile, login or status change)"""
+    global _invalidations
+    _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+    _invalidations += 1
+
+@timed_query
 def create_session_token(user_id: int):
     """Create session token for user"""
     token = secrets.token_urlsafe(32)
     expires_at = datetime.now().replace(hour=23, minute=59, second=59).isoformat()
     created_at = datetime.now().isoformat()
     
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    cur = conn.cursor()
-    
-    cur.execute("""
-    INSERT INTO user_sessions (user_id, session_token, expires_at, created_at)
-    VALUES (?, ?, ?, ?)
-    """, (user_id, token, expires_at, created_at))
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+        INSERT INTO user_sessions (user_id, session_token, expires_at, created_at)
+        VALUES (?, ?, ?, ?)
+        """, (user_id, token, expires_at, created_at))
     
-    conn.commit()
-    conn.close()
+    # Login just updated last_login, so cached copies of this user are stale
+    invalidate_user_tokens(user_id)
     return token
 
+@timed_query
 def verify_session_token(token: str):
     """Verify session token and return user"""
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    cached = token_cache.get(token)
+    if cached is not None:
+        user, version = cached
+        if _user_versions.get(user["id"], 0) == version:
+            return {"success": True, "user": dict(user)}
+        token_cache.pop(token)
     
-    cur.execute("""
-    SELECT u.* FROM users u 
+    conn = get_conn()
+    invalidations = _invalidations
+    
+    user = conn.execute("""
+    SELECT u.*, s.expires_at AS session_expires_at FROM users u 
     JOIN user_sessions s ON u.id = s.user_id 
     WHERE s.session_token = ? AND s.expires_at > ? AND u.is_active = 1
-    """, (token, datetime.now().isoformat()))
-    
-    user = cur.fetchone()
-    conn.close()
+    """, (token, datetime.now().isoformat())).fetchone()
     
     if user:
+        user = dict(user)
+        session_expires_at = datetime.fromisoformat(user.pop("session_expires_at")).timestamp()
+        # Skip caching if an invalidation ran while we were querying
+        if invalidations == _invalidations:
+            version = _user_versions.get(user["id"], 0)
+            token_cache.set(token, (user, version), expires_at=session_expires_at)
         return {"success": True, "user": dict(user)}
     return {"success": False, "error": "Invalid or expired session"}
 
-def save_chat(session_id, agent_used, model, query, response,
-              confidence, processing_time, token_count, created_at=None, 
-              user_id=None, input_tokens=0, output_tokens=0, cost_estimate=0.0):
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    cur = conn.cursor()
+@timed_query
+def revoke_session_token(token: str):
+    """Log out: delete the session and drop it from the token cache"""
+    conn = get_conn()
+    with conn:
+        cur = conn.execute("DELETE FROM user_sessions WHERE session_token = ?", (token,))
+    token_cache.pop(token)
+    return cur.rowcount > 0
+
+@timed_query
+def set_user_active(user_id: int, is_active: bool):
+    """Activate or deactivate a user; deactivation takes effect on cached sessions immediately"""
+    conn = get_conn()
+    with conn:
+        conn.execute("UPDATE users SET is_active = ? WHERE id = ?", (1 if is_active else 0, user_id))
+    invalidate_user_tokens(user_id)
+
+def token_cache_stats():
+    return token_cache.stats()
+
+INSERT_CHAT_SQL = """
+INSERT INTO chat_sessions
+(user_id, session_id, agent_used, model, query, response,
+ confidence, processing_time, token_count, input_tokens, 
+ output_tokens, cost_estimate, created_at, cache_hit,
+ routed_model, route_policy, route_reason, route_inputs, trace_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def chat_row(session_id, agent_used, model, query, response,
+             confidence, processing_time, token_count, created_at=None, 
+             user_id=None, input_tokens=0, output_tokens=0, cost_estimate=0.0,
+             cache_hit=False, routed_model=None, route_policy=None, route_reason=None,
+             route_inputs=None, trace_id=None):
+    """Build the chat_sessions parameter tuple for INSERT_CHAT_SQL"""
     if created_at is None:
         created_at = datetime.now().isoformat()
-    
-    cur.execute("""
-    INSERT INTO chat_sessions
-    (user_id, session_id, agent_used, model, query, response,
-     confidence, processing_time, token_count, input_tokens, 
-     output_tokens, cost_estimate, created_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    return (
         user_id,
         session_id,
         agent_used,
@@ -181,42 +547,184 @@ def save_chat(session_id, agent_used, model, query, response,
         input_tokens,
         output_tokens,
         cost_estimate,
-        created_at
-    ))
-    conn.commit()   
-    conn.close()    
+        created_at,
+        1 if cache_hit else 0,
+        routed_model,
+        route_policy,
+        route_reason,
+        route_inputs,
+        trace_id
+    )
 
-def get_recent(limit=100, user_id=None):
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    
+@timed_query
+def save_chat(session_id, agent_used, model, query, response,
+              confidence, processing_time, token_count, **fields):
+    """Insert one chat row (optional chat_row() fields as keywords)"""
+    save_chats([chat_row(session_id, agent_used, model, query, response,
+                         confidence, processing_time, token_count, **fields)])
+
+UPSERT_ROLLUP_SQL = """
+INSERT INTO chat_daily_rollups
+(user_id, day, agent_used, model, chats, tokens, input_tokens, output_tokens,
+ processing_time_sum, confidence_sum, cost)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id, day, agent_used, model) DO UPDATE SET
+    chats = chats + excluded.chats,
+    tokens = tokens + excluded.tokens,
+    input_tokens = input_tokens + excluded.input_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    processing_time_sum = processing_time_sum + excluded.processing_time_sum,
+    confidence_sum = confidence_sum + excluded.confidence_sum,
+    cost = cost + excluded.cost
+"""
+
+def rollup_rows(rows):
+    """Aggregate chat_row() tuples into chat_daily_rollups parameter tuples"""
+    totals = {}
+    for row in rows:
+        (user_id, _session_id, agent_used, model, _query, _response, confidence,
+         processing_time, token_count, input_tokens, output_tokens, cost_estimate,
+         created_at) = row[:13]
+        if user_id is None or not created_at:
+            continue
+        key = (user_id, created_at[:10], agent_used or "", model or "")
+        total = totals.setdefault(key, [0, 0, 0, 0, 0.0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += token_count or 0
+        total[2] += input_tokens or 0
+        total[3] += output_tokens or 0
+        total[4] += processing_time or 0.0
+        total[5] += confidence or 0.0
+        total[6] += cost_estimate or 0.0
+    return [key + tuple(total) for key, total in totals.items()]
+
+def _begin_immediate(conn):
+    """Take the write lock up front, recording how long it took"""
+    start = time.perf_counter()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+    except sqlite3.OperationalError:
+        with _lock_waits_lock:
+            _lock_waits["busy_errors"] += 1
+        raise
+    waited = time.perf_counter() - start
+    with _lock_waits_lock:
+        _lock_waits["count"] += 1
+        _lock_waits["total"] += waited
+        _lock_waits["max"] = max(_lock_waits["max"], waited)
+
+def lock_wait_stats():
+    with _lock_waits_lock:
+        stats = dict(_lock_waits)
+    stats["avg"] = stats["total"] / stats["count"] if stats["count"] else 0.0
+    return stats
+
+@timed_query
+def save_chats(rows):
+    """Insert many chat_row() tuples and update their daily rollups in one transaction"""
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        conn.executemany(INSERT_CHAT_SQL, rows)
+        conn.executemany(UPSERT_ROLLUP_SQL, rollup_rows(rows))
+
+# Columns callers may project from chat_sessions
+HISTORY_FIELDS = (
+    "id", "user_id", "session_id", "agent_used", "model", "query", "response", "confidence",
+    "processing_time", "token_count", "input_tokens", "output_tokens", "cost_estimate",
+    "created_at", "cache_hit", "routed_model", "route_policy", "route_reason", "route_inputs",
+    "trace_id",
+)
+
+def _history_sql(user_id=None, before_id=None, fields=None):
+    """Keyset-paginated history query, newest first; ``id`` is always selected"""
+    fields = HISTORY_FIELDS if not fields else ["id"] + [f for f in fields if f != "id"]
+    unknown = set(fields) - set(HISTORY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown history fields: {', '.join(sorted(unknown))}")
+    where, params = [], []
     if user_id:
-        cur.execute("SELECT * FROM chat_sessions WHERE user_id = ? ORDER BY id DESC LIMIT ?", (user_id, limit))
-    else:
-        cur.execute("SELECT * FROM chat_sessions ORDER BY id DESC LIMIT ?", (limit,))
-        
-    rows = cur.fetchall()
-    conn.close()
+        where.append("user_id = ?")
+        params.append(user_id)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    sql = f"SELECT {', '.join(fields)} FROM chat_sessions"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + " ORDER BY id DESC LIMIT ?", params
+
+@timed_query
+def get_recent(limit=100, user_id=None, before_id=None, fields=None):
+    """Newest chats first; pass the last row's id as ``before_id`` for the next page"""
+    sql, params = _history_sql(user_id, before_id, fields)
+    rows = get_conn().execute(sql, params + [limit]).fetchall()
     return [dict(r) for r in rows]
 
+def iter_history_pages(user_id=None, fields=None, chunk_size=1000):
+    """Yield every matching chat, newest first, as lists of one keyset page each.
+
+    Each page is its own short query, so memory stays flat however many
+    rows there are and no read transaction is held across pages.
+    """
+    before_id = None
+    while True:
+        rows = get_recent(chunk_size, user_id=user_id, before_id=before_id, fields=fields)
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        before_id = rows[-1]["id"]
+
+_SEARCH_TERMS = re.compile(r"\w+")
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query: every word must match, as a quoted term"""
+    return " ".join(f'"{term}"' for term in _SEARCH_TERMS.findall(text))
+
+@timed_query
+def search_available() -> bool:
+    row = get_conn().execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_search'").fetchone()
+    return row is not None
+
+@timed_query
+def search_chats(text: str, user_id=None, limit=20, offset=0):
+    """bm25-ranked chats matching ``text`` (query matches weigh double), with highlighted snippets"""
+    match = fts_query(text)
+    if not match:
+        return []
+    sql = """
+    SELECT c.id, c.user_id, c.session_id, c.agent_used, c.model, c.created_at,
+           snippet(chat_search, 0, '<mark>', '</mark>', '...', 16) AS query_snippet,
+           snippet(chat_search, 1, '<mark>', '</mark>', '...', 32) AS response_snippet,
+           bm25(chat_search, 2.0, 1.0) AS rank
+    FROM chat_search JOIN chat_sessions c ON c.id = chat_search.rowid
+    WHERE chat_search MATCH ?
+    """
+    params = [match]
+    if user_id:
+        sql += " AND c.user_id = ?"
+        params.append(user_id)
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    rows = get_conn().execute(sql, params + [limit, offset]).fetchall()
+    return [dict(r) for r in rows]
+
+@timed_query
 def get_user_analytics(user_id: int):
-    """Get user analytics data"""
-    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    """Get user analytics data (read from chat_daily_rollups)"""
+    cur = get_conn().cursor()
     
     # Basic stats
     cur.execute("""
     SELECT 
-        COUNT(*) as total_chats,
-        SUM(token_count) as total_tokens,
+        COALESCE(SUM(chats), 0) as total_chats,
+        SUM(tokens) as total_tokens,
         SUM(input_tokens) as total_input_tokens,
         SUM(output_tokens) as total_output_tokens,
-        AVG(processing_time) as avg_response_time,
-        AVG(confidence) as avg_confidence,
-        SUM(cost_estimate) as total_cost
-    FROM chat_sessions 
+        SUM(processing_time_sum) / SUM(chats) as avg_response_time,
+        SUM(confidence_sum) / SUM(chats) as avg_confidence,
+        SUM(cost) as total_cost
+    FROM chat_daily_rollups 
     WHERE user_id = ?
     """, (user_id,))
     
@@ -224,8 +732,8 @@ def get_user_analytics(user_id: int):
     
     # Agent usage
     cur.execute("""
-    SELECT agent_used, COUNT(*) as count 
-    FROM chat_sessions 
+    SELECT agent_used, SUM(chats) as count 
+    FROM chat_daily_rollups 
     WHERE user_id = ? 
     GROUP BY agent_used
     """, (user_id,))
@@ -234,8 +742,8 @@ def get_user_analytics(user_id: int):
     
     # Model usage
     cur.execute("""
-    SELECT model, COUNT(*) as count, AVG(processing_time) as avg_time
-    FROM chat_sessions 
+    SELECT model, SUM(chats) as count, SUM(processing_time_sum) / SUM(chats) as avg_time
+    FROM chat_daily_rollups 
     WHERE user_id = ? 
     GROUP BY model
     """, (user_id,))
@@ -244,20 +752,367 @@ def get_user_analytics(user_id: int):
     
     # Daily usage (last 30 days)
     cur.execute("""
-    SELECT DATE(created_at) as date, COUNT(*) as count, SUM(token_count) as tokens
-    FROM chat_sessions 
-    WHERE user_id = ? AND DATE(created_at) >= DATE('now', '-30 days')
-    GROUP BY DATE(created_at)
-    ORDER BY date
+    SELECT day as date, SUM(chats) as count, SUM(tokens) as tokens
+    FROM chat_daily_rollups 
+    WHERE user_id = ? AND day >= DATE('now', '-30 days')
+    GROUP BY day
+    ORDER BY day
     """, (user_id,))
     
     daily_usage = [dict(row) for row in cur.fetchall()]
     
-    conn.close()
-    
     return {
         "stats": stats,
         "agent_usage": agent_usage,
         "model_usage": model_usage,
         "daily_usage": daily_usage
     }
+
+WINDOW_SQL = """
+SELECT day, agent_used, model, SUM(chats) AS chats, SUM(tokens) AS tokens,
+       SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,
+       SUM(processing_time_sum) AS processing_time_sum,
+       SUM(confidence_sum) AS confidence_sum, SUM(cost) AS cost
+FROM (
+    SELECT day, agent_used, model, chats, tokens, input_tokens, output_tokens,
+           processing_time_sum, confidence_sum, cost
+    FROM chat_daily_rollups
+    WHERE user_id = ? AND day >= ? AND day < ?
+    UNION ALL
+    SELECT substr(created_at, 1, 10), COALESCE(agent_used, ''), COALESCE(model, ''), 1,
+           COALESCE(token_count, 0), COALESCE(input_tokens, 0), COALESCE(output_tokens, 0),
+           COALESCE(processing_time, 0.0), COALESCE(confidence, 0.0), COALESCE(cost_estimate, 0.0)
+    FROM chat_sessions
+    WHERE user_id = ? AND created_at >= ? AND created_at < ?
+    UNION ALL
+    SELECT substr(created_at, 1, 10), COALESCE(agent_used, ''), COALESCE(model, ''), 1,
+           COALESCE(token_count, 0), COALESCE(input_tokens, 0), COALESCE(output_tokens, 0),
+           COALESCE(processing_time, 0.0), COALESCE(confidence, 0.0), COALESCE(cost_estimate, 0.0)
+    FROM chat_sessions
+    WHERE user_id = ? AND created_at >= ? AND created_at < ?
+)
+GROUP BY day, agent_used, model
+"""
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+def _window_bounds(start, end):
+    """Split [start, end) into whole days (rollups) and partial edge ranges (raw rows).
+
+    Bounds are plain ISO strings compared against created_at as-is, so the
+    raw-row ranges are (user_id, created_at) index range scans.
+    """
+    start, end = _as_datetime(start), _as_datetime(end)
+    first_day = start.date() if start.time() == datetime.min.time() else start.date() + timedelta(days=1)
+    last_day = end.date()
+    
+    if first_day >= last_day:
+        # Window inside a single day (or less): raw rows only
+        return (first_day.isoformat(), first_day.isoformat()), (start.isoformat(), end.isoformat()), ("", "")
+    
+    return (
+        (first_day.isoformat(), last_day.isoformat()),
+        (start.isoformat(), first_day.isoformat()),
+        (last_day.isoformat(), end.isoformat()),
+    )
+
+@timed_query
+def get_user_analytics_range(user_id: int, start, end):
+    """Get user analytics for the half-open window [start, end).
+
+    ``start``/``end`` are datetimes or ISO strings in the same local time as
+    created_at. Whole days come from chat_daily_rollups and the partial days
+    at either edge from chat_sessions, so totals are exact for any window.
+    """
+    days, head, tail = _window_bounds(start, end)
+    rows = get_conn().execute(WINDOW_SQL, (user_id, *days, user_id, *head, user_id, *tail)).fetchall()
+    
+    stats = {
+        "total_chats": 0,
+        "total_tokens": 0,
+        "total_input_tokens": 0,
+        "total_output_tokens": 0,
+        "avg_response_time": None,
+        "avg_confidence": None,
+        "total_cost": 0.0
+    }
+    agents, models, daily = {}, {}, {}
+    processing_time = confidence = 0.0
+    
+    for row in rows:
+        stats["total_chats"] += row["chats"]
+        stats["total_tokens"] += row["tokens"]
+        stats["total_input_tokens"] += row["input_tokens"]
+        stats["total_output_tokens"] += row["output_tokens"]
+        stats["total_cost"] += row["cost"]
+        processing_time += row["processing_time_sum"]
+        confidence += row["confidence_sum"]
+        
+        agents[row["agent_used"]] = agents.get(row["agent_used"], 0) + row["chats"]
+        
+        model = models.setdefault(row["model"], [0, 0.0])
+        model[0] += row["chats"]
+        model[1] += row["processing_time_sum"]
+        
+        day = daily.setdefault(row["day"], [0, 0])
+        day[0] += row["chats"]
+        day[1] += row["tokens"]
+    
+    if stats["total_chats"]:
+        stats["avg_response_time"] = processing_time / stats["total_chats"]
+        stats["avg_confidence"] = confidence / stats["total_chats"]
+    
+    return {
+        "stats": stats,
+        "agent_usage": [{"agent_used": agent, "count": count} for agent, count in agents.items()],
+        "model_usage": [{"model": model, "count": count, "avg_time": total / count}
+                        for model, (count, total) in models.items()],
+        "daily_usage": [{"date": date, "count": count, "tokens": tokens}
+                        for date, (count, tokens) in sorted(daily.items())]
+    }
+
+# Response cache (persistent tier)
+
+@timed_query
+def get_cached_response(cache_key: str, now: float):
+    row = get_conn().execute(
+        "SELECT result FROM response_cache WHERE cache_key = ? AND expires_at > ?",
+        (cache_key, now)).fetchone()
+    return row["result"] if row else None
+
+@timed_query
+def put_cached_response(cache_key: str, agent_used: str, model: str, result: str, now: float, expires_at: float):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+        INSERT OR REPLACE INTO response_cache (cache_key, agent_used, model, result, created_at, expires_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (cache_key, agent_used, model, result, now, expires_at))
+
+@timed_query
+def purge_cached_responses(now: float):
+    """Delete expired response_cache rows"""
+    conn = get_conn()
+    with conn:
+        return conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,)).rowcount
+
+# Conversation memory
+
+@timed_query
+def load_conversation(session_id: str):
+    """(summary, turns JSON) for a session, or None"""
+    row = get_conn().execute(
+        "SELECT summary, turns FROM conversation_memory WHERE session_id = ?", (session_id,)).fetchone()
+    return (row["summary"], row["turns"]) if row else None
+
+@timed_query
+def save_conversation(session_id: str, summary: str, turns: str, now: float):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+        INSERT OR REPLACE INTO conversation_memory (session_id, summary, turns, updated_at)
+        VALUES (?, ?, ?, ?)
+        """, (session_id, summary, turns, now))
+
+@timed_query
+def purge_conversations(before: float):
+    """Delete conversations idle since ``before``"""
+    conn = get_conn()
+    with conn:
+        return conn.execute("DELETE FROM conversation_memory WHERE updated_at < ?", (before,)).rowcount
+
+
+# Job queue
+
+@timed_query
+def create_job(queries, user_id=None, session_id=None, now=None):
+    """Store a job and one pending task per query in one transaction; returns the job id"""
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        job_id = conn.execute("""
+        INSERT INTO jobs (user_id, session_id, status, total, created_at, updated_at)
+        VALUES (?, ?, 'queued', ?, ?, ?)
+        """, (user_id, session_id, len(queries), now, now)).lastrowid
+        conn.executemany("""
+        INSERT INTO job_tasks (job_id, idx, query, status, available_at, updated_at)
+        VALUES (?, ?, ?, 'pending', ?, ?)
+        """, [(job_id, index, query, now, now) for index, query in enumerate(queries)])
+    return job_id
+
+@timed_query
+def get_job(job_id: int):
+    """The jobs row plus task counts by status, or None"""
+    conn = get_conn()
+    row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job["tasks"] = {r["status"]: r["count"] for r in conn.execute(
+        "SELECT status, COUNT(*) AS count FROM job_tasks WHERE job_id = ? GROUP BY status", (job_id,))}
+    return job
+
+_DUE_TASKS_SQL = """
+SELECT t.id, t.job_id, t.idx, t.query, t.attempts, j.session_id, j.user_id
+FROM job_tasks t JOIN jobs j ON j.id = t.job_id
+WHERE t.status IN ('pending', 'leased') AND t.available_at <= ?
+ORDER BY t.available_at LIMIT ?
+"""
+
+@timed_query
+def claim_job_tasks(worker: str, limit: int, lease_seconds: float, now: float):
+    """Lease up to ``limit`` due tasks to ``worker``.
+
+    Due means pending and past its backoff, or leased to a worker whose
+    lease has run out. Each claim counts as an attempt; the lease is held
+    until ``now + lease_seconds`` unless the task is finished first.
+    """
+    conn = get_conn()
+    # Check without the write lock first, so idle workers polling an empty queue never take it
+    if conn.execute(_DUE_TASKS_SQL, (now, 1)).fetchone() is None:
+        return []
+    with conn:
+        _begin_immediate(conn)
+        rows = conn.execute(_DUE_TASKS_SQL, (now, limit)).fetchall()
+        conn.executemany("""
+        UPDATE job_tasks SET status = 'leased', worker = ?, attempts = attempts + 1,
+            available_at = ?, updated_at = ?
+        WHERE id = ?
+        """, [(worker, now + lease_seconds, now, row["id"]) for row in rows])
+        conn.executemany("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ? AND status = 'queued'",
+                         [(now, job_id) for job_id in {row["job_id"] for row in rows}])
+    return [dict(row, attempts=row["attempts"] + 1) for row in rows]
+
+_JOB_PROGRESS_SQL = """
+UPDATE jobs SET completed = completed + ?, failed = failed + ?, updated_at = ?,
+    status = CASE WHEN status = 'cancelled' THEN status
+                  WHEN completed + failed + 1 >= total THEN 'completed' ELSE 'running' END,
+    finished_at = CASE WHEN status != 'cancelled' AND completed + failed + 1 >= total THEN ? ELSE finished_at END
+WHERE id = ?
+"""
+
+def _finish_job_task(conn, task, worker, status, result, error, now):
+    """Mark a leased task done or failed; False if the lease was lost to another worker"""
+    updated = conn.execute("""
+    UPDATE job_tasks SET status = ?, result = ?, error = ?, worker = NULL, updated_at = ?
+    WHERE id = ? AND worker = ? AND status = 'leased'
+    """, (status, result, error, now, task["id"], worker)).rowcount
+    if updated:
+        done = status == "done"
+        conn.execute(_JOB_PROGRESS_SQL, (int(done), int(not done), now, now, task["job_id"]))
+    return bool(updated)
+
+@timed_query
+def complete_job_task(task, worker: str, result: str, row=None, now=None):
+    """Store a task's result and its chat_row() (with daily rollup) in one transaction"""
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        if not _finish_job_task(conn, task, worker, "done", result, None, now):
+            return False
+        if row is not None:
+            conn.execute(INSERT_CHAT_SQL, row)
+            conn.executemany(UPSERT_ROLLUP_SQL, rollup_rows([row]))
+    return True
+
+@timed_query
+def fail_job_task(task, worker: str, error: str, result=None, now=None):
+    """Give up on a task for good"""
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        return _finish_job_task(conn, task, worker, "failed", result, error, now)
+
+@timed_query
+def retry_job_task(task, worker: str, available_at: float, error=None, attempted=True, now=None):
+    """Hand a leased task back to the queue, due again at ``available_at``.
+
+    With ``attempted=False`` (the worker never called the provider, e.g.
+    on shutdown) the claim is not counted against the task's attempts.
+    """
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        return conn.execute("""
+        UPDATE job_tasks SET worker = NULL, available_at = ?,
+            status = CASE WHEN (SELECT status FROM jobs WHERE id = job_tasks.job_id) = 'cancelled'
+                          THEN 'cancelled' ELSE 'pending' END,
+            attempts = attempts - ?, error = COALESCE(?, error), updated_at = ?
+        WHERE id = ? AND worker = ? AND status = 'leased'
+        """, (available_at, 0 if attempted else 1, error, now, task["id"], worker)).rowcount > 0
+
+@timed_query
+def cancel_job(job_id: int, now=None):
+    """Cancel a job's unfinished tasks; leased ones still running are left to finish"""
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        updated = conn.execute("""
+        UPDATE jobs SET status = 'cancelled', updated_at = ?, finished_at = ?
+        WHERE id = ? AND status IN ('queued', 'running')
+        """, (now, now, job_id)).rowcount
+        if updated:
+            conn.execute("""
+            UPDATE job_tasks SET status = 'cancelled', updated_at = ?
+            WHERE job_id = ? AND status = 'pending'
+            """, (now, job_id))
+    return updated > 0
+
+@timed_query
+def get_job_tasks(job_id: int, after_idx=-1, limit=1000):
+    """Tasks of a job in submission order, starting after ``after_idx``"""
+    rows = get_conn().execute("""
+    SELECT idx, query, status, attempts, result, error FROM job_tasks
+    WHERE job_id = ? AND idx > ? ORDER BY idx LIMIT ?
+    """, (job_id, after_idx, limit)).fetchall()
+    return [dict(r) for r in rows]
+
+def iter_job_task_pages(job_id: int, chunk_size=1000):
+    """Yield every task of a job in submission order, one keyset page at a time"""
+    after_idx = -1
+    while True:
+        rows = get_job_tasks(job_id, after_idx=after_idx, limit=chunk_size)
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after_idx = rows[-1]["idx"]
+
+@timed_query
+def take_rate_token(provider: str, per_minute: float, burst: float, now: float) -> float:
+    """Take one token from ``provider``'s shared bucket.
+
+    Returns 0 if a token was taken, otherwise the seconds until one is due.
+    The bucket refills at ``per_minute`` tokens a minute up to ``burst``.
+    """
+    rate = per_minute / 60.0
+    conn = get_conn()
+    with conn:
+        _begin_immediate(conn)
+        row = conn.execute("SELECT tokens, updated_at FROM job_rate_limits WHERE provider = ?",
+                           (provider,)).fetchone()
+        tokens = burst if row is None else min(burst, row["tokens"] + max(0.0, now - row["updated_at"]) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        if not wait:
+            tokens -= 1
+        conn.execute("INSERT OR REPLACE INTO job_rate_limits (provider, tokens, updated_at) VALUES (?, ?, ?)",
+                     (provider, tokens, now))
+    return wait
+
+@timed_query
+def job_queue_stats(now=None):
+    """Jobs and their task totals by job status, plus how many tasks are due right now"""
+    now = time.time() if now is None else now
+    conn = get_conn()
+    jobs = {r["status"]: dict(r) for r in conn.execute("""
+    SELECT status, COUNT(*) AS jobs, SUM(total) AS tasks, SUM(completed) AS completed, SUM(failed) AS failed
+    FROM jobs GROUP BY status
+    """)}
+    due = conn.execute("SELECT COUNT(*) FROM job_tasks WHERE status IN ('pending', 'leased') "
+                       "AND available_at <= ?", (now,)).fetchone()[0]
+    return {"jobs": jobs, "due_tasks": due}
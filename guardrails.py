@@ -0,0 +1,117 @@
+import os
+import asyncio
+
+from resilience import guard_for
+from providers import provider_for
+from routing import call_with_fallback, model_available
+from usage import MODEL_CONTEXT_WINDOWS, count_tokens, estimate_tokens, fits, prompt_budget
+
+# Queries longer than this are rejected before any tokenizing
+PROMPT_MAX_CHARS = int(os.getenv("PROMPT_MAX_CHARS", "2000000"))
+# What to do when the prompt does not fit the chosen model:
+#   reject     fail with 413
+#   route      use a larger-context model, else reject
+#   summarize  use a larger-context model, else map-reduce summarize the query
+#   truncate   use a larger-context model, else keep the head and tail of the query
+PROMPT_OVERFLOW = os.getenv("PROMPT_OVERFLOW", "route")
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gemini-1.5-flash-8b")
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "8000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+SUMMARY_MAX_ROUNDS = 3
+SUMMARY_PROMPT = ("Summarize the following part of a longer user message. Keep every question, "
+                  "instruction, name, number and code identifier.\n\n")
+SUMMARIZED_PREFIX = "(The original message was too long and has been summarized.)\n\n"
+TRUNCATION_MARK = "\n\n[... truncated ...]\n\n"
+
+
+class PromptTooLarge(Exception):
+    """The query does not fit any usable model"""
+
+
+def larger_model(prompt: str, prompt_tokens: int):
+    """Smallest-context usable model that fits ``prompt``, or None"""
+    candidates = [m for m in MODEL_CONTEXT_WINDOWS
+                  if model_available(m) and not guard_for(provider_for(m)).breaker.is_open()
+                  and fits(m, prompt, prompt_tokens)]
+    return min(candidates, key=prompt_budget, default=None)
+
+
+def split_chunks(text: str, chunk_tokens: int):
+    """Split ``text`` at whitespace into pieces of about ``chunk_tokens`` tokens"""
+    size = chunk_tokens * 4
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            space = text.rfind(" ", start + size // 2, end)
+            end = space if space > 0 else end
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+async def summarize(text: str, budget: int) -> str:
+    """Map-reduce: summarize chunks in parallel until the text fits ``budget`` tokens"""
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+    async def summarize_chunk(chunk):
+        async with semaphore:
+            result = await call_with_fallback("Summarizer", SUMMARY_MODEL, SUMMARY_PROMPT + chunk)
+        if not result.get("ok"):
+            raise PromptTooLarge(f"Query too large and summarization failed: {result.get('error')}")
+        return result["text"]
+
+    for _ in range(SUMMARY_MAX_ROUNDS):
+        if await count_tokens(text) <= budget:
+            return text
+        summaries = await asyncio.gather(*(summarize_chunk(c) for c in split_chunks(text, SUMMARY_CHUNK_TOKENS)))
+        text = "\n\n".join(summaries)
+    if await count_tokens(text) > budget:
+        raise PromptTooLarge("Query too large to summarize into the model context")
+    return text
+
+
+def truncate(text: str, budget: int, tokens: int) -> str:
+    """Keep the head and tail of ``text`` within ``budget`` tokens"""
+    while tokens > budget:
+        keep = int(len(text) * budget / tokens * 0.95)
+        head = keep * 2 // 3
+        text = text[:head] + TRUNCATION_MARK + text[len(text) - (keep - head):]
+        tokens = estimate_tokens(text)
+    return text
+
+
+async def preflight(model_name: str, prefix: str, user_text: str, overflow: str = PROMPT_OVERFLOW) -> dict:
+    """Check the prompt against ``model_name``'s context window before calling it.
+
+    Returns ``{"model", "text", "action", "prompt_tokens"}`` where ``action``
+    is "ok", "routed", "summarized" or "truncated", ``text`` is the query to
+    send and ``prompt_tokens`` the estimated size of ``prefix + text`` (None
+    when the prompt is too short to need counting), for the fallback chain
+    to reuse. Raises PromptTooLarge when the request must be rejected.
+    """
+    if len(user_text) > PROMPT_MAX_CHARS:
+        raise PromptTooLarge(f"Query is longer than {PROMPT_MAX_CHARS} characters")
+
+    prompt = prefix + user_text
+    # Prompts no longer than the budget in characters fit without counting
+    tokens = await count_tokens(prompt) if len(prompt) > prompt_budget(model_name) else None
+    if fits(model_name, prompt, tokens):
+        return {"model": model_name, "text": user_text, "action": "ok", "prompt_tokens": tokens}
+    if overflow != "reject":
+        larger = larger_model(prompt, tokens)
+        if larger is not None:
+            return {"model": larger, "text": user_text, "action": "routed", "prompt_tokens": tokens}
+
+    budget = prompt_budget(model_name) - estimate_tokens(prefix) - estimate_tokens(SUMMARIZED_PREFIX)
+    if overflow == "summarize":
+        text = SUMMARIZED_PREFIX + await summarize(user_text, budget)
+        return {"model": model_name, "text": text, "action": "summarized",
+                "prompt_tokens": await count_tokens(prefix + text)}
+    if overflow == "truncate":
+        text = await asyncio.to_thread(truncate, user_text, budget, tokens)
+        return {"model": model_name, "text": text, "action": "truncated",
+                "prompt_tokens": await count_tokens(prefix + text)}
+    raise PromptTooLarge(f"Query has about {tokens} tokens; {model_name} accepts {prompt_budget(model_name)}")
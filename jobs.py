@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+
+from db import claim_job_tasks, complete_job_task, fail_job_task, retry_job_task, take_rate_token
+from providers import provider_for
+from resilience import guard_for
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Worker tasks pulling from the queue inside the web server; 0 leaves the
+# queue to separate `python jobs.py` processes, off the request event loop
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE = float(os.getenv("JOB_RETRY_BASE", "2"))      # first retry delay (seconds), doubling after
+JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", "300"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+# Provider calls per minute made for jobs, per provider, across every worker
+# process sharing the database; 0 = unlimited
+JOB_RATE_PER_MINUTE = float(os.getenv("JOB_RATE_PER_MINUTE", "60"))
+JOB_RATE_BURST = float(os.getenv("JOB_RATE_BURST", "5"))
+# Jobs only call a provider while its in-flight calls are below this share of
+# its adaptive concurrency limit, leaving the rest to interactive requests
+JOB_PROVIDER_SHARE = float(os.getenv("JOB_PROVIDER_SHARE", "0.5"))
+JOB_HEADROOM_WAIT = 30.0       # hand the task back (attempt not counted) after waiting this long
+JOB_HEADROOM_POLL = 0.25
+
+
+class RateLimiter:
+    """Token bucket for one provider's job calls, kept in SQLite.
+
+    Every worker process draws from the same bucket, so the limit holds
+    however many `python jobs.py` processes share the database.
+    """
+
+    def __init__(self, provider, per_minute, burst=JOB_RATE_BURST):
+        self.provider = provider
+        self.per_minute = per_minute
+        self.burst = max(1.0, float(burst))
+        self.waits = 0
+
+    async def acquire(self):
+        if self.per_minute <= 0:
+            return
+        while True:
+            wait = await asyncio.to_thread(take_rate_token, self.provider, self.per_minute, self.burst, time.time())
+            if not wait:
+                return
+            self.waits += 1
+            # Jitter, so workers of several processes do not all retry at the same instant
+            await asyncio.sleep(wait * random.uniform(1.0, 1.2))
+
+
+class JobWorkerPool:
+    """Background workers answering queued job_tasks.
+
+    Each worker leases one due task at a time from SQLite, so any number of
+    processes can share the queue; a task whose worker dies is claimed again
+    once its lease runs out. ``plan(text)`` returns (agent, decision) and
+    ``run(index, text, agent, decision, session_id, user_id=...)`` returns
+    (result event, chat_sessions row or None), as app.run_batch_item does.
+    Failed provider calls are retried with exponential backoff up to
+    ``max_attempts``; a missing row means the query itself cannot be
+    answered, so it fails at once.
+    """
+
+    def __init__(self, plan, run, workers=JOB_WORKERS, lease_seconds=JOB_LEASE_SECONDS,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_base=JOB_RETRY_BASE, retry_max=JOB_RETRY_MAX,
+                 poll_interval=JOB_POLL_INTERVAL, rate_per_minute=JOB_RATE_PER_MINUTE,
+                 provider_share=JOB_PROVIDER_SHARE):
+        self.plan = plan
+        self.run = run
+        self.workers = workers
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.poll_interval = poll_interval
+        self.rate_per_minute = rate_per_minute
+        self.provider_share = provider_share
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.rates = {}
+        self.tasks = []
+        self.wakeup = None
+        self.running = 0
+        self.counts = {"claimed": 0, "completed": 0, "retried": 0, "failed": 0, "released": 0, "lost_leases": 0}
+
+    async def start(self):
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._run(f"{self.name}:{n}")) for n in range(self.workers)]
+
+    async def stop(self):
+        """Cancel the workers; tasks they hold go straight back to the queue"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        """Tasks were queued: wake idle workers now instead of at their next poll"""
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def backoff(self, attempts: int) -> float:
+        """Seconds before retry number ``attempts``, with jitter so failed tasks do not return in step"""
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def rate_limiter(self, provider: str) -> RateLimiter:
+        limiter = self.rates.get(provider)
+        if limiter is None:
+            limiter = self.rates[provider] = RateLimiter(provider, self.rate_per_minute)
+        return limiter
+
+    def stats(self):
+        return dict(self.counts, workers=len(self.tasks), running=self.running,
+                    rate_waits={provider: limiter.waits for provider, limiter in self.rates.items()})
+
+    async def _run(self, worker: str):
+        while True:
+            self.wakeup.clear()
+            try:
+                claimed = await asyncio.to_thread(claim_job_tasks, worker, 1, self.lease_seconds, time.time())
+            except Exception:
+                logger.exception("Failed to claim job tasks")
+                claimed = []
+            if not claimed:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for task in claimed:
+                await self._execute(worker, task)
+
+    async def _execute(self, worker: str, task: dict):
+        self.counts["claimed"] += 1
+        self.running += 1
+        try:
+            with span("job_task", job_id=task["job_id"], index=task["idx"], attempt=task["attempts"]):
+                outcome = await self._answer(worker, task)
+            if outcome is None:
+                self.counts["lost_leases"] += 1
+            else:
+                self.counts[outcome] += 1
+        except asyncio.CancelledError:
+            # Shutting down: give the task back now rather than after its lease
+            await asyncio.to_thread(retry_job_task, task, worker, time.time(), attempted=False)
+            raise
+        except Exception as e:
+            logger.exception("Job task %s failed", task["id"])
+            await asyncio.to_thread(retry_job_task, task, worker, time.time() + self.backoff(task["attempts"]),
+                                    error=str(e))
+            self.counts["retried"] += 1
+        finally:
+            self.running -= 1
+
+    async def _answer(self, worker: str, task: dict):
+        """Run one claimed task; returns the counter to bump, or None if the lease was lost meanwhile"""
+        if task["attempts"] > self.max_attempts:
+            # Every earlier lease ran out: whatever runs it keeps dying
+            stored = await asyncio.to_thread(fail_job_task, task, worker, "Task lease expired too many times")
+            return "failed" if stored else None
+
+        agent, decision = self.plan(task["query"])
+        if not await self._wait_for_turn(provider_for(decision["model"])):
+            stored = await asyncio.to_thread(retry_job_task, task, worker, time.time() + self.retry_base,
+                                             attempted=False)
+            return "released" if stored else None
+
+        session_id = task["session_id"] or f"job-{task['job_id']}"
+        event, row = await self.run(task["idx"], task["query"], agent, decision, session_id,
+                                    user_id=task["user_id"])
+        result = json.dumps({key: value for key, value in event.items() if key not in ("event", "index")})
+        error = event.get("error") or event.get("response")
+        if event["ok"]:
+            stored = await asyncio.to_thread(complete_job_task, task, worker, result, row)
+            outcome = "completed"
+        elif row is None or task["attempts"] >= self.max_attempts:
+            stored = await asyncio.to_thread(fail_job_task, task, worker, error, result)
+            outcome = "failed"
+        else:
+            stored = await asyncio.to_thread(retry_job_task, task, worker,
+                                             time.time() + self.backoff(task["attempts"]), error=error)
+            outcome = "retried"
+        return outcome if stored else None
+
+    async def _wait_for_turn(self, provider: str) -> bool:
+        """Wait for interactive headroom, then for the job rate limit; False if headroom never came.
+
+        Headroom comes first so a task handed back does not use up a rate
+        token. An open breaker is waited out only for its open period; after
+        that the job's call may be the half-open probe.
+        """
+        guard = guard_for(provider)
+        deadline = time.monotonic() + JOB_HEADROOM_WAIT
+        while guard.breaker.is_open() or not guard.has_headroom(self.provider_share):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(JOB_HEADROOM_POLL)
+        await self.rate_limiter(provider).acquire()
+        return True
+
+
+async def serve(workers: int):
+    # Same planning and answering as the API, so results match /chat/batch
+    import app
+
+    pool = JobWorkerPool(app.plan_query, app.run_batch_item, workers=workers)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await pool.start()
+    logger.info("Job workers started: %d as %s", workers, pool.name)
+    await stop.wait()
+    await pool.stop()
+    await app.close_client()
+    app.close_connections()
+    app.close_tracing()
+
+
+def main():
+    """Run job workers outside the web server: ``python jobs.py [--workers N]``"""
+    parser = argparse.ArgumentParser(description="Answer queued bulk jobs")
+    parser.add_argument("--workers", type=int, default=max(1, JOB_WORKERS))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(serve(args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from cache import TTLCache
+from db import load_conversation, save_conversation, purge_conversations
+from guardrails import SUMMARY_MODEL
+from routing import call_with_fallback
+from usage import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+# Tokens of history (summary plus recent turns) sent with each message
+MEMORY_CONTEXT_TOKENS = int(os.getenv("MEMORY_CONTEXT_TOKENS", "3000"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "600"))
+# In-process cap: sessions and total characters held; the LRU ones are evicted
+MEMORY_MAX_SESSIONS = int(os.getenv("MEMORY_MAX_SESSIONS", "5000"))
+MEMORY_MAX_CHARS = int(os.getenv("MEMORY_MAX_CHARS", str(32 * 1024 * 1024)))
+MEMORY_IDLE_SECONDS = float(os.getenv("MEMORY_IDLE_SECONDS", "1800"))
+MEMORY_RETENTION_DAYS = float(os.getenv("MEMORY_RETENTION_DAYS", "30"))
+
+PURGE_EVERY = 1000             # persisted turns between purges of old conversations
+ANONYMOUS_SESSIONS = {None, "", "anon"}
+SUMMARY_PROMPT = ("Update the running summary of a conversation with the new turns below. Keep facts, "
+                  "decisions, names, numbers, code identifiers and open questions. Answer with the "
+                  "summary only, at most {words} words.\n\nCurrent summary:\n{summary}\n\nNew turns:\n{turns}")
+
+
+class Conversation:
+    """Rolling summary plus the recent (query, response, tokens) turns of one session"""
+
+    def __init__(self, summary="", turns=None):
+        self.summary = summary or ""
+        self.turns = turns or []
+        self.compacting = False
+
+    def size(self) -> int:
+        return len(self.summary) + sum(len(q) + len(r) for q, r, _ in self.turns)
+
+    def turn_budget(self) -> int:
+        return MEMORY_CONTEXT_TOKENS - estimate_tokens(self.summary)
+
+    def overflow(self, budget=None) -> int:
+        """Number of oldest turns that do not fit ``budget`` (default: the context budget)"""
+        budget = self.turn_budget() if budget is None else budget
+        used = 0
+        for index in range(len(self.turns) - 1, -1, -1):
+            used += self.turns[index][2]
+            if used > budget:
+                return index + 1
+        return 0
+
+
+def render_turns(turns) -> str:
+    return "\n".join(f"User: {q}\nAssistant: {r}" for q, r, _ in turns)
+
+
+def clip_tokens(text: str, budget: int) -> str:
+    """Drop the oldest part of ``text`` until it fits ``budget`` tokens"""
+    tokens = estimate_tokens(text)
+    while tokens > budget and text:
+        text = text[len(text) - int(len(text) * budget / tokens * 0.95):]
+        tokens = estimate_tokens(text)
+    return text
+
+
+class ConversationMemory:
+    """Per-session conversation context for multi-turn chats.
+
+    Recent sessions live in an LRU capped by session count and characters;
+    the compacted state of every session is also kept in the
+    conversation_memory table (one row per session), so a cold session is
+    restored with a single primary-key read. Turns that fall outside the
+    context budget are folded into a rolling summary in the background.
+    """
+
+    def __init__(self, enabled=MEMORY_ENABLED):
+        self.enabled = enabled
+        self.sessions = TTLCache(maxsize=MEMORY_MAX_SESSIONS, ttl=MEMORY_IDLE_SECONDS,
+                                 max_weight=MEMORY_MAX_CHARS, weigher=Conversation.size)
+        self.tasks = set()
+        self.loads = 0
+        self.writes = 0
+        self.compactions = 0
+
+    async def _get(self, session_id):
+        conversation = self.sessions.get(session_id)
+        if conversation is None:
+            self.loads += 1
+            stored = await asyncio.to_thread(load_conversation, session_id)
+            if stored is None:
+                conversation = Conversation()
+            else:
+                summary, turns = stored
+                conversation = Conversation(summary, [tuple(turn) for turn in json.loads(turns or "[]")])
+            self.sessions.set(session_id, conversation)
+        return conversation
+
+    async def _save(self, session_id, conversation):
+        # Re-set so the LRU sees the new size
+        self.sessions.set(session_id, conversation)
+        now = time.time()
+        await asyncio.to_thread(save_conversation, session_id, conversation.summary,
+                                json.dumps(conversation.turns), now)
+        self.writes += 1
+        if self.writes % PURGE_EVERY == 0:
+            await asyncio.to_thread(purge_conversations, now - MEMORY_RETENTION_DAYS * 86400)
+
+    async def context(self, session_id):
+        """(context, history) for the new message, within MEMORY_CONTEXT_TOKENS.
+
+        ``history`` is the recent (query, response) turns, sent to the
+        provider as role-tagged messages; ``context`` is the rolling summary
+        of older turns, to put before the new message.
+        """
+        if not self.enabled or session_id in ANONYMOUS_SESSIONS:
+            return "", ()
+        conversation = await self._get(session_id)
+        # Turns waiting for compaction are left out rather than over-running the budget
+        history = tuple((q, r) for q, r, _ in conversation.turns[conversation.overflow():])
+        context = f"Summary of earlier turns: {conversation.summary}\n\n" if conversation.summary else ""
+        return context, history
+
+    async def append(self, session_id, query: str, response: str):
+        """Record a finished turn and compact older turns if over budget"""
+        if not self.enabled or session_id in ANONYMOUS_SESSIONS:
+            return
+        conversation = await self._get(session_id)
+        conversation.turns.append((query, response, estimate_tokens(query) + estimate_tokens(response)))
+        await self._save(session_id, conversation)
+
+        if conversation.overflow() and not conversation.compacting:
+            conversation.compacting = True
+            task = asyncio.create_task(self._compact(session_id, conversation))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _compact(self, session_id, conversation):
+        try:
+            # Compact down to half the budget so summaries are not rewritten every turn
+            count = conversation.overflow(conversation.turn_budget() // 2)
+            old = conversation.turns[:count]
+            prompt = SUMMARY_PROMPT.format(words=MEMORY_SUMMARY_TOKENS * 3 // 4,
+                                           summary=conversation.summary or "(none)",
+                                           turns=render_turns(old))
+            result = await call_with_fallback("Summarizer", SUMMARY_MODEL, prompt)
+            if result.get("ok"):
+                summary = result["text"].strip()
+            else:
+                # Extractive fallback: keep the user's side of the old turns
+                logger.warning("conversation summary failed: %s", result.get("error"))
+                summary = " ".join([conversation.summary] + [f"User asked: {q}" for q, _, _ in old])
+            conversation.summary = clip_tokens(summary, MEMORY_SUMMARY_TOKENS)
+            # Turns appended meanwhile went to the end, so the old ones are still first
+            del conversation.turns[:count]
+            self.compactions += 1
+            await self._save(session_id, conversation)
+        finally:
+            conversation.compacting = False
+
+    async def close(self):
+        """Wait for in-flight compactions"""
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self):
+        return dict(self.sessions.stats(), loads=self.loads, writes=self.writes,
+                    compactions=self.compactions, compacting=len(self.tasks))
@@ -0,0 +1,216 @@
+import time
+import threading
+import weakref
+from bisect import bisect_left
+from functools import wraps
+
+from profiler import request_capture
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+class _ThreadArray:
+    """Holder for one thread's value array, kept in a thread-local"""
+
+    __slots__ = ("array", "__weakref__")
+
+    def __init__(self, array):
+        self.array = array
+
+
+class _Shards:
+    """One value array per writing thread.
+
+    Writers only touch their own thread's array, so recording needs no lock;
+    a scrape sums the arrays. When a thread exits, its values are folded
+    into ``base`` and its array is dropped, so counts never go backwards
+    and thread churn does not grow memory or scrape time.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.arrays = {}           # id(array) -> array, for live threads
+        self.base = [0] * size     # totals of threads that have exited
+        self.lock = threading.Lock()   # taken on thread start/exit and scrapes, never when recording
+
+    def mine(self):
+        try:
+            return self.local.holder.array
+        except AttributeError:
+            array = [0] * self.size
+            holder = self.local.holder = _ThreadArray(array)
+            with self.lock:
+                self.arrays[id(array)] = array
+            # Runs when the thread's locals are freed at thread exit
+            weakref.finalize(holder, self._retire, array)
+            return array
+
+    def _retire(self, array):
+        with self.lock:
+            for index, value in enumerate(array):
+                self.base[index] += value
+            self.arrays.pop(id(array), None)
+
+    def total(self):
+        with self.lock:
+            totals = list(self.base)
+            for array in self.arrays.values():
+                for index, value in enumerate(array):
+                    totals[index] += value
+        return totals
+
+
+class _CounterChild:
+    def __init__(self):
+        self.shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self.shards.mine()[0] += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.shards.total()[0]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One slot per bucket, one for +Inf, then the sum
+        self.shards = _Shards(len(buckets) + 2)
+
+    def observe(self, value):
+        array = self.shards.mine()
+        array[bisect_left(self.buckets, value)] += 1
+        array[-1] += value
+
+    def samples(self, name, labels):
+        totals = self.shards.total()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), totals):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+        yield f"{name}_sum", labels, totals[-1]
+        yield f"{name}_count", labels, cumulative
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self._child())
+        return child
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield from child.samples(self.name, tuple(zip(self.labelnames, values)))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Collected(_Metric):
+    """Gauge or counter read at scrape time from ``collect()``, which yields (label values, value)"""
+
+    def __init__(self, name, help, labelnames, collect, kind="gauge"):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        for values, value in self.collect():
+            yield self.name, tuple(zip(self.labelnames, values)), value
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join(f'{key}="{_escape(v)}"' for key, v in labels)
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Shared metrics
+
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Time spent in each stage of the chat pipeline",
+                          ("endpoint", "stage"))
+CHAT_REQUESTS = Counter("chat_requests_total", "Chat requests by outcome (ok, cache_hit, error)",
+                        ("endpoint", "outcome"))
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "SQLite time per db.py function", ("function",),
+                             buckets=DB_BUCKETS)
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "db.py calls that raised", ("function",))
+
+
+def lap(endpoint: str, stage: str, since: float) -> float:
+    """Record the time since ``since`` as ``stage`` and return now, for timing the next stage"""
+    now = time.perf_counter()
+    STAGE_SECONDS.labels(endpoint, stage).observe(now - since)
+    return now
+
+
+def timed_query(fn):
+    """Record every call of a db.py function in db_query_seconds (and in an active slow-request capture)"""
+    seconds = DB_QUERY_SECONDS.labels(fn.__name__)
+    errors = DB_QUERY_ERRORS.labels(fn.__name__)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            seconds.observe(elapsed)
+            capture = request_capture.get()
+            if capture is not None:
+                capture.queries.append((fn.__name__, elapsed))
+    return wrapper
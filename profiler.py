@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Requests slower than this (ms) are captured with their stage breakdown and
+# SQL plans; 0 turns capture off, leaving no per-request or per-query hooks.
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_KEEP = int(os.getenv("SLOW_REQUEST_KEEP", "50"))
+SLOW_REQUEST_MAX_SQL = 200     # statements remembered per request
+
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Leaf frames of threads that are just waiting; left out of profiles unless asked for
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get"),
+               ("thread.py", "_worker"), ("tracing.py", "_run")}
+
+
+class ProfilerBusy(Exception):
+    """Another profile is already running"""
+
+
+_profile_lock = threading.Lock()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(frame) -> bool:
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def sample_stacks(seconds: float, interval: float = PROFILE_INTERVAL_MS / 1000, idle: bool = False) -> dict:
+    """Sample every thread's Python stack for ``seconds``; blocks the calling thread.
+
+    Returns ``{"seconds", "interval_ms", "samples", "stacks"}`` where ``stacks``
+    maps folded stacks (``thread;outer;...;inner``, root first) to sample counts.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+        interval = max(0.001, interval)
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (not idle and _is_idle(frame)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        return {"seconds": seconds, "interval_ms": interval * 1000, "samples": samples, "stacks": stacks}
+    finally:
+        _profile_lock.release()
+
+
+def folded(stacks: Counter) -> str:
+    """Collapsed-stack text (one ``stack count`` line each) for flamegraph.pl or speedscope"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+# Slow-request capture
+
+class RequestCapture:
+    """Spans, db.py calls and SQL statements of one in-flight request"""
+
+    __slots__ = ("spans", "queries", "statements")
+
+    def __init__(self):
+        self.spans = []
+        self.queries = []
+        self.statements = []
+
+
+request_capture = ContextVar("request_capture", default=None)
+slow_requests = deque(maxlen=SLOW_REQUEST_KEEP)
+
+_SQL_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def record_statement(sql: str):
+    """sqlite3 trace callback: remember statements run on behalf of a captured request"""
+    capture = request_capture.get()
+    if capture is not None and len(capture.statements) < SLOW_REQUEST_MAX_SQL:
+        capture.statements.append(sql)
+
+
+def normalize_sql(sql: str) -> str:
+    """Replace literals with ``?``, so plans group by statement shape and values are not kept"""
+    return _SQL_NUMBERS.sub("?", _SQL_STRINGS.sub("?", " ".join(sql.split())))
+
+
+def _stage(span, origin: int) -> dict:
+    return {
+        "name": span.name,
+        "span_id": span.span_id,
+        "parent_id": span.parent_id,
+        "offset_ms": (span.start_ns - origin) / 1e6,
+        "duration_ms": (span.end_ns - span.start_ns) / 1e6,
+        "attributes": span.attributes,
+        "error": span.message or None
+    }
+
+
+class SlowRequestMiddleware:
+    """ASGI middleware recording requests slower than SLOW_REQUEST_MS.
+
+    Each capture holds the request's spans as a stage breakdown, the time
+    of every db.py call and EXPLAIN QUERY PLAN output for each distinct
+    SQL statement; the newest SLOW_REQUEST_KEEP are kept in
+    ``slow_requests``. ``explain(sql)`` returns plan lines for a
+    normalized statement. With a zero threshold requests pass straight through.
+    """
+
+    def __init__(self, app, explain=None, threshold_ms=SLOW_REQUEST_MS):
+        self.app = app
+        self.explain = explain
+        self.threshold_ms = threshold_ms
+        self.tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if not self.threshold_ms or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        capture = RequestCapture()
+        token = request_capture.set(capture)
+        status = {}
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            request_capture.reset(token)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms >= self.threshold_ms:
+                # Plans are worked out after the response, off the request path
+                task = asyncio.create_task(self._record(scope, status.get("code"), elapsed_ms, capture))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def _record(self, scope, status, elapsed_ms, capture):
+        spans = sorted(capture.spans, key=lambda s: s.start_ns)
+        origin = spans[0].start_ns if spans else 0
+        statements = list(dict.fromkeys(normalize_sql(sql) for sql in capture.statements))
+        plans = []
+        if self.explain is not None:
+            explainable = [sql for sql in statements if sql.split(" ", 1)[0].upper() in _EXPLAINABLE]
+            plans = await asyncio.to_thread(lambda: [{"sql": sql, "plan": self.explain(sql)} for sql in explainable])
+
+        slow_requests.append({
+            "time": datetime.now().isoformat(),
+            "method": scope["method"],
+            "path": scope["path"],
+            "status": status,
+            "duration_ms": elapsed_ms,
+            # The server span ends last
+            "trace_id": capture.spans[-1].trace_id if capture.spans else None,
+            "stages": [_stage(s, origin) for s in spans],
+            "queries": [{"function": name, "ms": seconds * 1000} for name, seconds in capture.queries],
+            "sql": plans or [{"sql": sql, "plan": None} for sql in statements]
+        })
+        logger.warning("Slow request %s %s took %.0f ms", scope["method"], scope["path"], elapsed_ms)
@@ -0,0 +1,302 @@
+import os
+import time
+import json
+
+from dotenv import load_dotenv
+
+import httpx
+
+from usage import MODEL_MAX_OUTPUT, account, gemini_usage, deepseek_usage
+from tracing import CLIENT, inject, span, start_span
+
+load_dotenv()
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+DEEPSEEKER_API_KEY = os.getenv("DEEPSEEKER_API_KEY")
+
+# Overridable to point at a local mock provider (bench/mock_provider.py)
+GEMINI_URL = os.getenv("GEMINI_URL", "https://generativelanguage.googleapis.com/v1beta/models")
+DEEPSEEK_URL = os.getenv("DEEPSEEK_URL", "https://api.deepseek.com/v1/chat/completions")
+DEEPSEEK_MODEL = "deepseek-chat"
+
+# Connection pool shared by every provider call (keep-alive, HTTP/2 when h2 is installed)
+POOL_MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", "200"))
+POOL_MAX_KEEPALIVE = int(os.getenv("PROVIDER_MAX_KEEPALIVE", "50"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", "30"))
+
+# Per-provider timeouts: (connect, read) in seconds. For streams the read
+# timeout applies between chunks, not to the whole response.
+PROVIDER_TIMEOUTS = {
+    "gemini": httpx.Timeout(float(os.getenv("GEMINI_READ_TIMEOUT", "30")),
+                            connect=float(os.getenv("GEMINI_CONNECT_TIMEOUT", "3"))),
+    "deepseek": httpx.Timeout(float(os.getenv("DEEPSEEK_READ_TIMEOUT", "5")),
+                              connect=float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "3"))),
+}
+
+try:
+    import h2  # noqa: F401
+    HTTP2_ENABLED = True
+except ImportError:
+    HTTP2_ENABLED = False
+
+_client = None
+
+
+class ProviderError(Exception):
+    """Raised when a provider stream fails"""
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared provider HTTP client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=HTTP2_ENABLED,
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
+    return _client
+
+
+async def close_client():
+    """Close the shared client and its pooled connections"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def provider_for(model_name: str) -> str:
+    return "gemini" if model_name.startswith("gemini") else "deepseek"
+
+
+def history_text(history) -> str:
+    """Earlier (query, response) turns as plain text, for token estimates and cache keys"""
+    return "".join(f"User: {query}\nAssistant: {response}\n\n" for query, response in history)
+
+
+def gemini_request(model_name: str, prompt: str, stream: bool = False, trace=None, history=()) -> dict:
+    method = "streamGenerateContent" if stream else "generateContent"
+    contents = []
+    for query, response in history:
+        contents.append({"role": "user", "parts": [{"text": query}]})
+        contents.append({"role": "model", "parts": [{"text": response}]})
+    contents.append({"role": "user", "parts": [{"text": prompt}]})
+    return {
+        "url": f"{GEMINI_URL}/{model_name}:{method}",
+        "params": {"alt": "sse"} if stream else None,
+        "headers": inject({"x-goog-api-key": GEMINI_API_KEY, "Content-Type": "application/json"}, trace),
+        "json": {"contents": contents},
+        "timeout": PROVIDER_TIMEOUTS["gemini"],
+    }
+
+
+def deepseek_request(prompt: str, stream: bool = False, trace=None, history=()) -> dict:
+    messages = []
+    for query, response in history:
+        messages.append({"role": "user", "content": query})
+        messages.append({"role": "assistant", "content": response})
+    messages.append({"role": "user", "content": prompt})
+    body = {
+        "model": DEEPSEEK_MODEL,
+        "messages": messages,
+        "max_tokens": MODEL_MAX_OUTPUT["deepseeker-1.0"],
+        "stream": stream
+    }
+    if stream:
+        # Ask for a final chunk carrying token usage
+        body["stream_options"] = {"include_usage": True}
+    return {
+        "url": DEEPSEEK_URL,
+        "headers": inject({
+            "Authorization": f"Bearer {DEEPSEEKER_API_KEY}",
+            "Content-Type": "application/json"
+        }, trace),
+        "json": body,
+        "timeout": PROVIDER_TIMEOUTS["deepseek"],
+    }
+
+
+def gemini_text(payload: dict) -> str:
+    candidates = payload.get("candidates") or [{}]
+    parts = candidates[0].get("content", {}).get("parts", [])
+    return "".join(part.get("text", "") for part in parts)
+
+
+async def call_gemini(prompt: str, model_name: str, history=()) -> dict:
+    if not GEMINI_API_KEY:
+        return {
+            "ok": False,
+            "error": "Gemini API key missing",
+            "text": "",
+            "time": 0.0,
+            "tokens": 0
+        }
+
+    start = time.time()
+    try:
+        response = await get_client().post(**gemini_request(model_name, prompt, history=history))
+        response.raise_for_status()
+
+        payload = response.json()
+        text = gemini_text(payload)
+        if not text:
+            text = "(No text from Gemini)"
+
+        end = time.time()
+        return dict(account(model_name, history_text(history) + prompt, text, *gemini_usage(payload)),
+                    ok=True, text=text, time=end - start)
+    except Exception as e:
+        end = time.time()
+        return {
+            "ok": False,
+            "error": str(e),
+            "text": "",
+            "time": end - start,
+            "tokens": 0
+        }
+
+async def call_deepseeker(prompt: str, history=()) -> dict:
+    if not DEEPSEEKER_API_KEY:
+        return {
+            "ok": False,
+            "error": "DeepSeeker API key missing",
+            "text": "",
+            "time": 0.0,
+            "tokens": 0,
+            "input_tokens": 0,
+            "output_tokens": 0
+        }
+
+    start = time.time()
+    try:
+        response = await get_client().post(**deepseek_request(prompt, history=history))
+        response.raise_for_status()
+        json_output = response.json()
+
+
+        message_obj = json_output.get("choices", [{}])[0].get("message", {})
+        if "content" in message_obj and message_obj["content"]:
+            text = message_obj["content"]
+        else:
+            text = "(No text from DeepSeeker)"
+
+        end = time.time()
+        return dict(account("deepseeker-1.0", history_text(history) + prompt, text, *deepseek_usage(json_output)),
+                    ok=True, text=text, time=end - start)
+
+    except Exception as e:
+        end = time.time()
+        return {
+            "ok": False,
+            "error": str(e),
+            "text": "",
+            "time": end - start,
+            "tokens": 0
+        }
+
+
+async def call_model(model_name: str, prompt: str, history=()) -> dict:
+    """Answer ``prompt``; ``history`` holds earlier (query, response) turns, sent as role-tagged messages"""
+    provider = provider_for(model_name)
+    # Client span; its traceparent goes out with the provider request
+    with span(f"call_{provider}", CLIENT, model=model_name) as current:
+        if provider == "gemini":
+            result = await call_gemini(prompt, model_name, history)
+        else:
+            result = await call_deepseeker(prompt, history)
+        current.set_attribute("tokens", result.get("tokens", 0))
+        if not result.get("ok"):
+            current.set_error(result.get("error"))
+        return result
+
+
+# Streaming
+
+async def sse_payloads(response: httpx.Response):
+    """Yield decoded JSON payloads from a provider SSE response"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            break
+        if payload:
+            yield json.loads(payload)
+
+
+def _set_usage(usage: dict, input_tokens, output_tokens):
+    if input_tokens is not None:
+        usage["input_tokens"] = input_tokens
+    if output_tokens is not None:
+        usage["output_tokens"] = output_tokens
+
+
+async def stream_gemini(prompt: str, model_name: str, usage: dict, trace=None, history=()):
+    """Yield Gemini text chunks from streamGenerateContent"""
+    if not GEMINI_API_KEY:
+        raise ProviderError("Gemini API key missing")
+
+    request = gemini_request(model_name, prompt, stream=True, trace=trace, history=history)
+    async with get_client().stream("POST", **request) as response:
+        response.raise_for_status()
+        async for payload in sse_payloads(response):
+            # Every chunk carries cumulative usage; the last one wins
+            _set_usage(usage, *gemini_usage(payload))
+            text = gemini_text(payload)
+            if text:
+                yield text
+
+
+async def stream_deepseeker(prompt: str, usage: dict, trace=None, history=()):
+    """Yield DeepSeek content deltas from its SSE stream"""
+    if not DEEPSEEKER_API_KEY:
+        raise ProviderError("DeepSeeker API key missing")
+
+    async with get_client().stream("POST", **deepseek_request(prompt, stream=True, trace=trace, history=history)) as response:
+        response.raise_for_status()
+        async for payload in sse_payloads(response):
+            _set_usage(usage, *deepseek_usage(payload))
+            choices = payload.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+
+
+async def stream_model(model_name: str, prompt: str, usage=None, history=()):
+    """Relay provider chunks to the caller as soon as they arrive.
+
+    Closing this generator (for example when the SSE client disconnects)
+    exits the upstream ``client.stream()`` block, which cancels the
+    in-flight request and returns the connection to the pool. ``usage``
+    (a dict) receives ``input_tokens``/``output_tokens`` if the provider
+    reports them; ``history`` is as for call_model().
+    """
+    usage = {} if usage is None else usage
+    provider = provider_for(model_name)
+    # Iterated from more than one task (hedging), so the span is never made current
+    trace = start_span(f"stream_{provider}", CLIENT, model=model_name)
+    if provider == "gemini":
+        chunks = stream_gemini(prompt, model_name, usage, trace, history)
+    else:
+        chunks = stream_deepseeker(prompt, usage, trace, history)
+
+    count = 0
+    try:
+        async for chunk in chunks:
+            if not count:
+                trace.set_attribute("first_token_ms", (time.time_ns() - trace.start_ns) / 1e6)
+            count += 1
+            yield chunk
+    except httpx.HTTPError as e:
+        trace.set_error(e)
+        raise ProviderError(str(e)) from e
+    except Exception as e:
+        trace.set_error(e)
+        raise
+    finally:
+        trace.set_attribute("chunks", count)
+        trace.end()
+        await chunks.aclose()
@@ -0,0 +1,209 @@
+import os
+import time
+from collections import deque
+
+# Circuit breaker: rolling window of call outcomes per provider
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "8"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "2"))
+
+# Adaptive (AIMD) concurrency limit per provider
+LIMIT_INITIAL = float(os.getenv("PROVIDER_LIMIT_INITIAL", "20"))
+LIMIT_MIN = float(os.getenv("PROVIDER_LIMIT_MIN", "2"))
+LIMIT_MAX = float(os.getenv("PROVIDER_LIMIT_MAX", "200"))
+LIMIT_BACKOFF = 0.9            # multiplicative decrease on error or slow call
+LIMIT_LATENCY_TARGET = float(os.getenv("PROVIDER_LIMIT_LATENCY_TARGET", "4"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a rolling time window.
+
+    Opens when, with at least BREAKER_MIN_CALLS in the window, the error
+    rate or the slow-call rate crosses its threshold. After
+    BREAKER_OPEN_SECONDS it lets BREAKER_HALF_OPEN_PROBES calls through:
+    a successful probe closes it again, a failed one reopens it.
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.calls = deque()           # (timestamp, ok, slow)
+        self.errors = 0
+        self.slow = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.times_opened = 0
+
+    def _trim(self, now):
+        while self.calls and self.calls[0][0] < now - BREAKER_WINDOW_SECONDS:
+            _, ok, slow = self.calls.popleft()
+            self.errors -= not ok
+            self.slow -= slow
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.times_opened += 1
+
+    def is_open(self, now=None) -> bool:
+        """Whether calls are refused outright; once BREAKER_OPEN_SECONDS have passed, probes may go through"""
+        now = time.time() if now is None else now
+        return self.state == OPEN and now - self.opened_at < BREAKER_OPEN_SECONDS
+
+    def allow(self) -> bool:
+        now = time.time()
+        if self.state == OPEN:
+            if self.is_open(now):
+                return False
+            self.state = HALF_OPEN
+            self.probes = 0
+        if self.state == HALF_OPEN:
+            if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                return False
+            self.probes += 1
+        return True
+
+    def record(self, ok, latency: float):
+        """Record a call outcome; ``ok=None`` (cancelled) only releases a probe slot"""
+        now = time.time()
+        if self.state == HALF_OPEN:
+            self.probes = max(0, self.probes - 1)
+            if ok is None:
+                return
+            if ok and latency < BREAKER_SLOW_CALL_SECONDS:
+                self.state = CLOSED
+                self.calls.clear()
+                self.errors = self.slow = 0
+            else:
+                self._open(now)
+            return
+        if ok is None:
+            return
+
+        slow = latency >= BREAKER_SLOW_CALL_SECONDS
+        self.calls.append((now, ok, slow))
+        self.errors += not ok
+        self.slow += slow
+        self._trim(now)
+
+        total = len(self.calls)
+        if self.state == CLOSED and total >= BREAKER_MIN_CALLS:
+            if self.errors / total >= BREAKER_ERROR_RATE or self.slow / total >= BREAKER_SLOW_RATE:
+                self._open(now)
+
+    def status(self):
+        now = time.time()
+        self._trim(now)
+        total = len(self.calls)
+        return {
+            # An expired open period is reported as half-open: the next call is a probe
+            "state": HALF_OPEN if self.state == OPEN and not self.is_open(now) else self.state,
+            "window_calls": total,
+            "error_rate": self.errors / total if total else 0.0,
+            "slow_rate": self.slow / total if total else 0.0,
+            "times_opened": self.times_opened
+        }
+
+
+class AdaptiveLimiter:
+    """AIMD cap on in-flight calls.
+
+    The limit grows by about one for every ``limit`` fast successful calls
+    and shrinks by LIMIT_BACKOFF on an error or a call slower than the
+    latency target, so it settles near the concurrency the provider can
+    actually serve.
+    """
+
+    def __init__(self):
+        self.limit = LIMIT_INITIAL
+        self.in_flight = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            self.rejected += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, ok, latency: float):
+        self.in_flight = max(0, self.in_flight - 1)
+        if ok is None:
+            return
+        if ok and latency <= LIMIT_LATENCY_TARGET:
+            self.limit = min(LIMIT_MAX, self.limit + 1.0 / self.limit)
+        else:
+            self.limit = max(LIMIT_MIN, self.limit * LIMIT_BACKOFF)
+
+    def status(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "rejected": self.rejected
+        }
+
+
+class ProviderGuard:
+    """Breaker plus concurrency limiter for one provider"""
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker()
+        self.limiter = AdaptiveLimiter()
+
+    def acquire(self):
+        """Take a call slot; returns None, or the reason the call is refused"""
+        if not self.limiter.try_acquire():
+            return "concurrency limit reached"
+        if not self.breaker.allow():
+            self.limiter.release(None, 0.0)
+            return "circuit open"
+        return None
+
+    def has_headroom(self, share: float = 1.0) -> bool:
+        """Whether a call could start now within ``share`` of the adaptive limit"""
+        return self.limiter.in_flight < max(1, int(self.limiter.limit * share))
+
+    def release(self, ok, latency: float):
+        self.breaker.record(ok, latency)
+        self.limiter.release(ok, latency)
+
+    def status(self):
+        return {
+            "circuit": self.breaker.status(),
+            "concurrency": self.limiter.status()
+        }
+
+
+def response_latency(elapsed: float, output_tokens: int, tokens_per_sec=None) -> float:
+    """Latency of a whole (non-streamed) response for slow-call checks.
+
+    ``elapsed`` less the time the model usually takes to produce
+    ``output_tokens`` at its measured ``tokens_per_sec``, so a long but
+    healthy answer is not mistaken for a slow provider. Until the rate is
+    known, the whole ``elapsed`` counts.
+    """
+    if not output_tokens or not tokens_per_sec:
+        return elapsed
+    return max(0.0, elapsed - output_tokens / tokens_per_sec)
+
+
+guards = {}
+
+
+def guard_for(provider: str) -> ProviderGuard:
+    guard = guards.get(provider)
+    if guard is None:
+        guard = guards[provider] = ProviderGuard(provider)
+    return guard
+
+
+def guard_status():
+    return {name: guard.status() for name, guard in guards.items()}
@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+from cache import TTLCache
+from db import get_cached_response, put_cached_response, purge_cached_responses
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Persistent tier in data.db (survives restarts, shared by workers on one host)
+RESPONSE_CACHE_PERSIST = os.getenv("RESPONSE_CACHE_PERSIST", "0") == "1"
+# Near-duplicate (paraphrase) matching with MinHash over word shingles
+RESPONSE_CACHE_NEAR_DUPLICATES = os.getenv("RESPONSE_CACHE_NEAR_DUPLICATES", "0") == "1"
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.8"))
+
+# Seconds a cached answer stays valid, per agent
+RESPONSE_CACHE_TTLS = {
+    "Code Assistant": 6 * 3600,
+    "Research Assistant": 3600,
+    "Task Helper": 24 * 3600,
+    "General Assistant": 3600,
+}
+DEFAULT_TTL = 3600
+
+PURGE_EVERY = 500              # persistent writes between expired-row purges
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16             # LSH bands; rows per band = permutations / bands
+MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % MINHASH_PRIME | 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % MINHASH_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+_SPACES = re.compile(r"\s+")
+_WORDS = re.compile(r"\w+")
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return _SPACES.sub(" ", query.strip().lower()).rstrip(" ?!.")
+
+
+def cache_key(prefix: str, model: str, query: str) -> str:
+    raw = f"{prefix}\x00{model}\x00{normalize_query(query)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def minhash(text: str):
+    """MinHash signature of the word 2-shingles (single words for one-word queries)"""
+    words = _WORDS.findall(text.lower())
+    shingles = {" ".join(words[i:i + 2]) for i in range(max(len(words) - 1, 1))} or {""}
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    return tuple(min((a * h + b) % MINHASH_PRIME for h in hashes) for a, b in _MINHASH_SEEDS)
+
+
+def similarity(sig_a, sig_b) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures"""
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+
+class MinHashIndex:
+    """Bounded LSH index from MinHash signatures to exact-cache keys"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        self.entries = OrderedDict()   # key -> (namespace, signature)
+        self.buckets = {}              # (namespace, band, band hash) -> set of keys
+        self.lock = threading.Lock()
+
+    def _bands(self, namespace, signature):
+        for band in range(MINHASH_BANDS):
+            yield (namespace, band, hash(signature[band * self.rows:(band + 1) * self.rows]))
+
+    def add(self, key, namespace, signature):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (namespace, signature)
+            for bucket in self._bands(namespace, signature):
+                self.buckets.setdefault(bucket, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                old_key, (old_namespace, old_signature) = self.entries.popitem(last=False)
+                for bucket in self._bands(old_namespace, old_signature):
+                    keys = self.buckets.get(bucket)
+                    if keys is not None:
+                        keys.discard(old_key)
+                        if not keys:
+                            del self.buckets[bucket]
+
+    def nearest(self, namespace, signature, threshold):
+        """Candidate keys sharing an LSH band, best match first, at or above threshold"""
+        with self.lock:
+            candidates = set()
+            for bucket in self._bands(namespace, signature):
+                candidates.update(self.buckets.get(bucket, ()))
+            scored = [(similarity(signature, self.entries[key][1]), key) for key in candidates]
+        return [key for score, key in sorted(scored, reverse=True) if score >= threshold]
+
+
+class ResponseCache:
+    """Two-tier cache of successful provider results keyed on (agent prefix, model, query).
+
+    The memory tier is an LRU bounded by entry count and total response
+    bytes; the optional persistent tier is the response_cache table. With
+    near-duplicate mode on, a miss on the exact key falls back to the most
+    similar cached query for the same prefix and model.
+    """
+
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, persist=RESPONSE_CACHE_PERSIST,
+                 near_duplicates=RESPONSE_CACHE_NEAR_DUPLICATES, ttls=None):
+        self.enabled = enabled
+        self.persist = persist
+        self.near_duplicates = near_duplicates
+        self.ttls = dict(RESPONSE_CACHE_TTLS if ttls is None else ttls)
+        self.memory = TTLCache(maxsize=RESPONSE_CACHE_MAX_ENTRIES, ttl=DEFAULT_TTL,
+                               max_weight=RESPONSE_CACHE_MAX_BYTES,
+                               weigher=lambda result: len(result.get("text", "")))
+        self.index = MinHashIndex(RESPONSE_CACHE_MAX_ENTRIES)
+        self.persistent_hits = 0
+        self.near_hits = 0
+        self.writes = 0
+
+    def ttl_for(self, agent: str) -> float:
+        return self.ttls.get(agent, DEFAULT_TTL)
+
+    async def get(self, agent: str, prefix: str, model: str, query: str):
+        """Return a cached result dict, or None"""
+        if not self.enabled:
+            return None
+        key = cache_key(prefix, model, query)
+
+        result = self.memory.get(key)
+        if result is not None:
+            return result
+
+        if self.persist:
+            stored = await asyncio.to_thread(get_cached_response, key, time.time())
+            if stored is not None:
+                result = json.loads(stored)
+                self.persistent_hits += 1
+                self.memory.set(key, result, ttl=self.ttl_for(agent))
+                return result
+
+        if self.near_duplicates:
+            signature = minhash(normalize_query(query))
+            for candidate in self.index.nearest((prefix, model), signature, RESPONSE_CACHE_SIMILARITY):
+                result = self.memory.get(candidate)
+                if result is not None:
+                    self.near_hits += 1
+                    return result
+        return None
+
+    async def set(self, agent: str, prefix: str, model: str, query: str, result: dict):
+        """Store a successful provider result"""
+        if not self.enabled or not result.get("ok"):
+            return
+        key = cache_key(prefix, model, query)
+        ttl = self.ttl_for(agent)
+        self.memory.set(key, result, ttl=ttl)
+        if self.near_duplicates:
+            self.index.add(key, (prefix, model), minhash(normalize_query(query)))
+
+        if self.persist:
+            now = time.time()
+            await asyncio.to_thread(put_cached_response, key, agent, model, json.dumps(result), now, now + ttl)
+            self.writes += 1
+            if self.writes % PURGE_EVERY == 0:
+                await asyncio.to_thread(purge_cached_responses, now)
+
+    def stats(self):
+        return dict(self.memory.stats(), persistent_hits=self.persistent_hits,
+                    near_duplicate_hits=self.near_hits, persist=self.persist,
+                    near_duplicates=self.near_duplicates)
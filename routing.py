@@ -0,0 +1,460 @@
+import os
+import time
+import json
+import random
+import asyncio
+from collections import deque
+
+from providers import GEMINI_API_KEY, DEEPSEEKER_API_KEY, ProviderError, call_model, history_text, stream_model, provider_for
+from resilience import guard_for, response_latency
+from usage import MODEL_PRICES, estimate_tokens, fits, prompt_budget
+from metrics import Counter, Histogram
+
+# Ordered fallback chains per model class. The first entry is the model
+# choose_model() picked; the rest are tried in order when it fails.
+FALLBACK_CHAINS = {
+    "gemini-1.5-flash-8b": ["gemini-1.5-flash-8b", "gemini-1.5-flash", "deepseeker-1.0"],
+    "gemini-1.5-flash": ["gemini-1.5-flash", "deepseeker-1.0", "gemini-1.5-flash-8b"],
+    "deepseeker-1.0": ["deepseeker-1.0", "gemini-1.5-flash"],
+}
+# Per-agent overrides, keyed by (agent, model class)
+AGENT_FALLBACK_CHAINS = {}
+
+# Hedging: if the primary has not answered (first token, for streams) within
+# the hedge deadline, also start the next model in the chain and keep
+# whichever answers first.
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "2.0"))  # until enough samples
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.25"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "10.0"))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+PROVIDER_SECONDS = Histogram("provider_request_seconds", "Provider call time (first token, for streams)",
+                             ("provider", "model", "kind", "outcome"))
+PROVIDER_SHED = Counter("provider_shed_total", "Calls refused by a provider's breaker or concurrency limit",
+                        ("provider",))
+
+# Live model router: picks the model for each request from online per-model
+# statistics under ROUTER_POLICY, and falls back to the word-count heuristic
+# until some model has ROUTER_MIN_SAMPLES calls behind it.
+ROUTER_POLICY = os.getenv("ROUTER_POLICY", "cheapest_under_latency")
+ROUTER_MAX_P95_MS = float(os.getenv("ROUTER_MAX_P95_MS", "3000"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.2"))
+ROUTER_MAX_COST_PER_1K = float(os.getenv("ROUTER_MAX_COST_PER_1K", "0.0005"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "10"))
+# Share of requests sent to a model without enough samples, so it can warm up
+ROUTER_EXPLORE_RATE = float(os.getenv("ROUTER_EXPLORE_RATE", "0.05"))
+EWMA_ALPHA = 0.1
+
+
+class LatencyWindow:
+    """Rolling window of recent latencies for one model and call kind"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.samples = deque(maxlen=size)
+        self.ordered = None            # sorted copy, rebuilt lazily after an add
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.ordered = None
+
+    def percentile(self, q: float):
+        if not self.samples:
+            return None
+        if self.ordered is None:
+            self.ordered = sorted(self.samples)
+        return self.ordered[min(len(self.ordered) - 1, int(q * len(self.ordered)))]
+
+
+latencies = {}   # (model, "response" | "first_token") -> LatencyWindow
+
+
+def record_latency(model_name: str, kind: str, seconds: float):
+    window = latencies.get((model_name, kind))
+    if window is None:
+        window = latencies[(model_name, kind)] = LatencyWindow()
+    window.add(seconds)
+
+
+def hedge_delay(model_name: str, kind: str) -> float:
+    """Seconds to wait on ``model_name`` before hedging, from its recent p95"""
+    window = latencies.get((model_name, kind))
+    if window is None or len(window.samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, window.percentile(HEDGE_PERCENTILE)))
+
+
+def _ewma(current, sample):
+    return sample if current is None else current + EWMA_ALPHA * (sample - current)
+
+
+class ModelStats:
+    """Online statistics for one model: EWMA latency, error rate, tokens/s and $ per 1K tokens"""
+
+    def __init__(self, model_name: str):
+        self.model = model_name
+        self.latency = None
+        self.error_rate = 0.0
+        self.tokens_per_sec = None
+        # List-price blend until real token counts come in
+        self.cost_per_1k = sum(MODEL_PRICES.get(model_name, (0.0, 0.0))) / 2
+        self.samples = 0
+
+    def record(self, ok: bool, seconds=None, input_tokens=0, output_tokens=0):
+        """Record one call; ``seconds=None`` updates the error rate only"""
+        self.samples += 1
+        self.error_rate = _ewma(self.error_rate, 0.0 if ok else 1.0)
+        if not ok or seconds is None:
+            return
+        self.latency = _ewma(self.latency, seconds)
+        if output_tokens and seconds > 0:
+            self.tokens_per_sec = _ewma(self.tokens_per_sec, output_tokens / seconds)
+        if input_tokens + output_tokens:
+            price_in, price_out = MODEL_PRICES.get(self.model, (0.0, 0.0))
+            cost = (input_tokens * price_in + output_tokens * price_out) / (input_tokens + output_tokens)
+            self.cost_per_1k = _ewma(self.cost_per_1k, cost)
+
+    def p95(self):
+        window = latencies.get((self.model, "response"))
+        return None if window is None else window.percentile(0.95)
+
+    def snapshot(self):
+        p95 = self.p95()
+        return {
+            "latency_ms": None if self.latency is None else round(self.latency * 1000, 1),
+            "p95_ms": None if p95 is None else round(p95 * 1000, 1),
+            "error_rate": round(self.error_rate, 4),
+            "tokens_per_sec": None if self.tokens_per_sec is None else round(self.tokens_per_sec, 1),
+            "cost_per_1k": self.cost_per_1k,
+            "samples": self.samples
+        }
+
+
+model_stats = {}   # model -> ModelStats
+
+
+def stats_for(model_name: str) -> ModelStats:
+    stats = model_stats.get(model_name)
+    if stats is None:
+        stats = model_stats[model_name] = ModelStats(model_name)
+    return stats
+
+
+def cheapest_under_latency(candidates):
+    """Cheapest model whose p95 is under ROUTER_MAX_P95_MS"""
+    eligible = [s for s in candidates if s.error_rate <= ROUTER_MAX_ERROR_RATE
+                and s.p95() is not None and s.p95() * 1000 <= ROUTER_MAX_P95_MS]
+    return min(eligible, key=lambda s: s.cost_per_1k, default=None)
+
+
+def fastest_under_budget(candidates):
+    """Fastest model costing at most ROUTER_MAX_COST_PER_1K"""
+    eligible = [s for s in candidates if s.error_rate <= ROUTER_MAX_ERROR_RATE
+                and s.latency is not None and s.cost_per_1k <= ROUTER_MAX_COST_PER_1K]
+    return min(eligible, key=lambda s: s.latency, default=None)
+
+
+ROUTER_POLICIES = {
+    "cheapest_under_latency": cheapest_under_latency,
+    "fastest_under_budget": fastest_under_budget,
+    "heuristic": None,
+}
+
+
+class ModelRouter:
+    """Choose a model per request from live statistics.
+
+    ``heuristic(text)`` is the static choice used on cold start, when no
+    model satisfies the policy, or when the policy is ``heuristic``.
+    Models without a key or with an open circuit breaker are skipped.
+    """
+
+    def __init__(self, heuristic, policy=ROUTER_POLICY):
+        if policy not in ROUTER_POLICIES:
+            raise ValueError(f"Unknown router policy: {policy}")
+        self.heuristic = heuristic
+        self.policy = policy
+
+    def choose(self, text: str) -> dict:
+        """Returns ``{"model", "policy", "reason", "inputs"}``"""
+        policy = ROUTER_POLICIES[self.policy]
+        if policy is None:
+            return self._decision(self.heuristic(text), "heuristic", {})
+
+        candidates = [stats_for(m) for m in MODEL_PRICES
+                      if model_available(m) and not guard_for(provider_for(m)).breaker.is_open()]
+        inputs = {s.model: s.snapshot() for s in candidates}
+        warm = [s for s in candidates if s.samples >= ROUTER_MIN_SAMPLES]
+        cold = [s for s in candidates if s.samples < ROUTER_MIN_SAMPLES]
+
+        if cold and warm and random.random() < ROUTER_EXPLORE_RATE:
+            return self._decision(random.choice(cold).model, "explore", inputs)
+        if not warm:
+            return self._decision(self.heuristic(text), "cold_start", inputs)
+        chosen = policy(warm)
+        if chosen is None:
+            return self._decision(self.heuristic(text), "no_eligible_model", inputs)
+        return self._decision(chosen.model, "policy", inputs)
+
+    def _decision(self, model_name, reason, inputs):
+        return {"model": model_name, "policy": self.policy, "reason": reason, "inputs": inputs}
+
+
+def decision_fields(decision: dict) -> dict:
+    """chat_sessions columns recording a router decision"""
+    return {
+        "routed_model": decision["model"],
+        "route_policy": decision["policy"],
+        "route_reason": decision["reason"],
+        "route_inputs": json.dumps(decision["inputs"])
+    }
+
+
+def model_available(model_name: str) -> bool:
+    if provider_for(model_name) == "gemini":
+        return bool(GEMINI_API_KEY)
+    return bool(DEEPSEEKER_API_KEY)
+
+
+def fallback_chain(agent: str, model_name: str, prompt=None, prompt_tokens=None):
+    chain = AGENT_FALLBACK_CHAINS.get((agent, model_name)) or FALLBACK_CHAINS.get(model_name) or [model_name]
+    available = [m for m in chain if model_available(m)]
+    if prompt is not None:
+        # Skip models whose context window cannot hold the prompt, tokenizing
+        # it at most once (pre-flight usually has already)
+        if prompt_tokens is None and any(len(prompt) > prompt_budget(m) for m in available):
+            prompt_tokens = estimate_tokens(prompt)
+        available = [m for m in available if fits(m, prompt, prompt_tokens)]
+    # Keep the requested model even without a key so the caller sees its error
+    return available or [model_name]
+
+
+async def _timed_call(model_name: str, prompt: str, history=()) -> dict:
+    guard = guard_for(provider_for(model_name))
+    refused = guard.acquire()
+    if refused:
+        PROVIDER_SHED.labels(guard.name).inc()
+        # Fail fast so the fallback chain moves on to another provider
+        return {"ok": False, "error": f"{guard.name} unavailable: {refused}", "text": "",
+                "time": 0.0, "tokens": 0, "model": model_name, "shed": True}
+
+    start = time.time()
+    ok = None
+    output_tokens = 0
+    try:
+        result = await call_model(model_name, prompt, history)
+        ok = bool(result.get("ok"))
+        output_tokens = result.get("output_tokens", result.get("tokens", 0)) if ok else 0
+    finally:
+        elapsed = time.time() - start
+        # Judged against the model's measured output rate, not on how long the answer is
+        guard.release(ok, response_latency(elapsed, output_tokens, stats_for(model_name).tokens_per_sec))
+        PROVIDER_SECONDS.labels(guard.name, model_name, "response",
+                                {True: "ok", False: "error"}.get(ok, "cancelled")).observe(elapsed)
+    result["model"] = model_name
+    stats_for(model_name).record(ok, result.get("time", 0.0), result.get("input_tokens", 0),
+                                 result.get("output_tokens", result.get("tokens", 0)))
+    if ok:
+        record_latency(model_name, "response", result.get("time", 0.0))
+    return result
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def call_with_fallback(agent: str, model_name: str, prompt: str, hedging: bool = HEDGING_ENABLED,
+                             history=(), prompt_tokens=None) -> dict:
+    """Call the fallback chain for ``model_name`` until one model succeeds.
+
+    Returns the provider result dict with ``model`` set to the model that
+    answered, ``attempts`` to the models tried and ``hedged`` when a hedge
+    request was started. If every model fails, the last error result is
+    returned. ``history`` is passed to call_model(); ``prompt_tokens`` is
+    pre-flight's count for the history plus ``prompt``, if it made one.
+    """
+    chain = fallback_chain(agent, model_name, history_text(history) + prompt, prompt_tokens)
+    pending = {asyncio.create_task(_timed_call(chain[0], prompt, history))}
+    attempts = [chain[0]]
+    next_index = 1
+    hedged = False
+    last = None
+
+    try:
+        while pending:
+            timeout = None
+            if hedging and len(pending) == 1 and next_index < len(chain):
+                timeout = hedge_delay(attempts[-1], "response")
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Primary is slower than its p95: race the next model
+                hedged = True
+                pending.add(asyncio.create_task(_timed_call(chain[next_index], prompt, history)))
+                attempts.append(chain[next_index])
+                next_index += 1
+                continue
+
+            for task in done:
+                result = task.result()
+                if result.get("ok"):
+                    return dict(result, attempts=attempts, hedged=hedged)
+                last = result
+
+            if not pending and next_index < len(chain):
+                pending.add(asyncio.create_task(_timed_call(chain[next_index], prompt, history)))
+                attempts.append(chain[next_index])
+                next_index += 1
+    finally:
+        # Cancel the losing hedge (or everything, if our caller was cancelled)
+        await _cancel(pending)
+
+    return dict(last, attempts=attempts, hedged=hedged)
+
+
+class _Guarded:
+    """Pass a stream through, holding the provider's concurrency slot until it is closed.
+
+    A class rather than an async generator so that ``aclose()`` releases
+    the slot even when the stream was never iterated (a losing hedge).
+    """
+
+    def __init__(self, stream, guard, first_token: float, usage: dict):
+        self.stream = stream
+        self.guard = guard
+        self.first_token = first_token
+        self.usage = usage
+        self.released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except StopAsyncIteration:
+            await self._release(True)
+            raise
+        except Exception:
+            await self._release(False)
+            raise
+
+    async def _release(self, ok):
+        if not self.released:
+            self.released = True
+            self.guard.limiter.release(ok, self.first_token)
+        await self.stream.aclose()
+
+    async def aclose(self):
+        await self._release(None)
+
+
+async def _first_chunk(model_name: str, prompt: str, history=()):
+    """Open a stream and wait for its first chunk; returns (model, stream, first chunk)"""
+    guard = guard_for(provider_for(model_name))
+    refused = guard.acquire()
+    if refused:
+        PROVIDER_SHED.labels(guard.name).inc()
+        raise ProviderError(f"{guard.name} unavailable: {refused}")
+
+    start = time.time()
+    usage = {}
+    stream = stream_model(model_name, prompt, usage, history)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = ""
+    except BaseException as e:
+        await stream.aclose()
+        failed = isinstance(e, Exception)
+        elapsed = time.time() - start
+        guard.release(False if failed else None, elapsed)
+        PROVIDER_SECONDS.labels(guard.name, model_name, "first_token",
+                                "error" if failed else "cancelled").observe(elapsed)
+        if failed:
+            stats_for(model_name).record(False)
+        raise
+    elapsed = time.time() - start
+    PROVIDER_SECONDS.labels(guard.name, model_name, "first_token", "ok").observe(elapsed)
+    stats_for(model_name).record(True)
+    # The breaker judges streams on time to first token; the slot stays
+    # taken until the stream is closed
+    guard.breaker.record(True, elapsed)
+    record_latency(model_name, "first_token", elapsed)
+    return model_name, _Guarded(stream, guard, elapsed, usage), first
+
+
+async def stream_with_fallback(agent: str, model_name: str, prompt: str, route=None,
+                               hedging: bool = HEDGING_ENABLED, history=(), prompt_tokens=None):
+    """Stream from the fallback chain for ``model_name``.
+
+    Until a model produces its first chunk, failures move on to the next
+    model and (with hedging) a slow first token starts the next model in
+    parallel; the first to produce a chunk wins and the other is closed.
+    Once a chunk has been sent the stream is committed to that model.
+    ``route`` (a dict) receives the winning model, attempts, hedge flag and
+    provider token usage. ``history`` and ``prompt_tokens`` are as for
+    call_with_fallback().
+    """
+    route = {} if route is None else route
+    chain = fallback_chain(agent, model_name, history_text(history) + prompt, prompt_tokens)
+    pending = {asyncio.create_task(_first_chunk(chain[0], prompt, history))}
+    attempts = [chain[0]]
+    next_index = 1
+    hedged = False
+    winner = None
+    last_error = None
+
+    try:
+        while pending and winner is None:
+            timeout = None
+            if hedging and len(pending) == 1 and next_index < len(chain):
+                timeout = hedge_delay(attempts[-1], "first_token")
+
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                pending.add(asyncio.create_task(_first_chunk(chain[next_index], prompt, history)))
+                attempts.append(chain[next_index])
+                next_index += 1
+                continue
+
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    # Two first tokens in the same tick: close the extra stream
+                    await task.result()[1].aclose()
+
+            if winner is None and not pending and next_index < len(chain):
+                pending.add(asyncio.create_task(_first_chunk(chain[next_index], prompt, history)))
+                attempts.append(chain[next_index])
+                next_index += 1
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, tuple):
+                await result[1].aclose()
+
+    route.update(attempts=attempts, hedged=hedged)
+    if winner is None:
+        raise last_error or ProviderError("No model available")
+
+    winning_model, stream, first = winner
+    route["model"] = winning_model
+    # Filled in by the provider as the stream goes, when it reports usage
+    route["usage"] = stream.usage
+    try:
+        if first:
+            yield first
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
@@ -0,0 +1,129 @@
+import asyncio
+
+
+class _Broadcast:
+    """One upstream async iterator fanned out to any number of subscribers.
+
+    Chunks are kept until the upstream finishes, so a subscriber that joins
+    late replays the chunks it missed and sees exactly the same response.
+    When the last subscriber leaves before the upstream is done, the
+    upstream task is cancelled.
+    """
+
+    def __init__(self, source, meta, on_done=None, on_complete=None):
+        self.meta = meta
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.on_done = on_done
+        self.on_complete = on_complete
+        self.task = asyncio.create_task(self._pump(source))
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError("upstream cancelled")
+        except Exception as e:
+            self.error = e
+        finally:
+            await source.aclose()
+            self.done = True
+            self.on_done()
+            self._notify()
+
+        if self.error is None and self.on_complete is not None:
+            await self.on_complete("".join(self.chunks))
+
+    def subscribe(self):
+        # Count the subscriber now, not on its first iteration, so a
+        # subscriber that has not started reading keeps the upstream alive
+        self.subscribers += 1
+        return self._iterate()
+
+    async def _iterate(self):
+        position = 0
+        try:
+            while True:
+                if position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                changed = self.changed
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class SingleFlight:
+    """Coalesce concurrent identical upstream calls.
+
+    ``do()`` shares one in-flight coroutine between every caller with the same
+    key; ``stream()`` does the same for async iterators, fanning chunks out
+    to each subscriber. Keys are released as soon as the upstream call
+    finishes, so only truly concurrent requests are merged.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.streams = {}
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        task = self.calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.create_task(fn())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            self.shared += 1
+        # shield: a caller that goes away must not cancel the shared call
+        return await asyncio.shield(task)
+
+    def stream(self, key, factory, on_complete=None):
+        """Subscribe to the shared stream for ``key``, starting it with ``factory(meta)`` if needed.
+
+        Returns ``(chunks, meta)``: an async iterator over the chunks and a
+        dict shared by every subscriber that the upstream may fill in (for
+        example with the model that actually answered). ``on_complete(text)``
+        runs once, when the upstream finishes successfully.
+        """
+        broadcast = self.streams.get(key)
+        if broadcast is None or broadcast.done:
+            self.leaders += 1
+            meta = {}
+            broadcast = _Broadcast(factory(meta), meta, on_done=lambda: self._release(key),
+                                   on_complete=on_complete)
+            self.streams[key] = broadcast
+        else:
+            self.shared += 1
+        return broadcast.subscribe(), broadcast.meta
+
+    def _release(self, key):
+        broadcast = self.streams.get(key)
+        if broadcast is not None and broadcast.done:
+            del self.streams[key]
+
+    def stats(self):
+        return {
+            "in_flight_calls": len(self.calls),
+            "in_flight_streams": len(self.streams),
+            "leaders": self.leaders,
+            "shared": self.shared
+        }
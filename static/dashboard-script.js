@@ -434,7 +434,7 @@ class Dashboard {
     
     async loadUsageHistory() {
         try {
-            const response = await fetch(`/chat/history?limit=50`);
+            const response = await fetch(`/chat/history?user_id=${this.userId}&token=${this.token}&limit=50&fields=created_at,agent_used,model,query,token_count,processing_time,confidence,cost_estimate`);
             const result = await response.json();
             
             if (result.success) {
@@ -778,6 +778,9 @@ class Dashboard {
     }
     
     logout() {
+        if (this.token) {
+            fetch(`/auth/logout?token=${this.token}`, { method: 'POST' }).catch(() => {});
+        }
         localStorage.removeItem('auth_token');
         localStorage.removeItem('user_id');
         window.location.href = '/';
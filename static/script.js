@@ -193,7 +193,7 @@ class VMNebulaApp {
                             break;
                             
                         case 'delta':
-                            fullResponse += data.content + ' ';
+                            fullResponse += data.content;
                             contentElement.textContent = fullResponse;
                             this.scrollToBottom();
                             break;
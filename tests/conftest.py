@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A freshly migrated SQLite database in a temporary directory"""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "test.db"))
+    db.close_connections()
+    db.init_db()
+    yield db
+    db.close_connections()
@@ -0,0 +1,72 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def chat(database, user_id, created_at, tokens=10, processing_time=1.0):
+    return database.chat_row("s", "General Assistant", "gemini-1.5-flash", "q", "r", 0.85,
+                             processing_time, tokens, created_at=created_at.isoformat(), user_id=user_id,
+                             input_tokens=tokens // 2, output_tokens=tokens - tokens // 2, cost_estimate=0.001)
+
+
+def expected(database, user_id, start, end):
+    """Count and token total straight from chat_sessions"""
+    row = database.get_conn().execute("""
+    SELECT COUNT(*), COALESCE(SUM(token_count), 0) FROM chat_sessions
+    WHERE user_id = ? AND created_at >= ? AND created_at < ?
+    """, (user_id, start.isoformat(), end.isoformat())).fetchone()
+    return row[0], row[1]
+
+
+@pytest.fixture
+def user(database):
+    return database.create_user("alice", "alice@example.com", "secret")["user_id"]
+
+
+def test_window_is_half_open(database, user):
+    start, end = datetime(2026, 1, 1), datetime(2026, 1, 3, 6)
+    database.save_chats([
+        chat(database, user, start - timedelta(seconds=1), tokens=1000),
+        chat(database, user, start, tokens=1),
+        chat(database, user, datetime(2026, 1, 1, 12), tokens=2),
+        chat(database, user, datetime(2026, 1, 2, 10), tokens=4),
+        chat(database, user, end - timedelta(seconds=1), tokens=8),
+        chat(database, user, end, tokens=1000),
+    ])
+
+    result = database.get_user_analytics_range(user, start, end)
+    assert result["stats"]["total_chats"] == 4
+    assert result["stats"]["total_tokens"] == 15
+    assert sorted(day["date"] for day in result["daily_usage"]) == ["2026-01-01", "2026-01-02", "2026-01-03"]
+
+
+def test_partial_first_day_and_single_day_windows(database, user):
+    database.save_chats([chat(database, user, datetime(2026, 1, 1, hour), tokens=hour + 1) for hour in range(24)])
+
+    # Starts mid-day: the head of the first day comes from raw rows, not the rollup
+    assert database.get_user_analytics_range(user, datetime(2026, 1, 1, 12), datetime(2026, 1, 2))["stats"][
+        "total_chats"] == 12
+    # Inside one day
+    result = database.get_user_analytics_range(user, datetime(2026, 1, 1, 6), datetime(2026, 1, 1, 9))
+    assert (result["stats"]["total_chats"], result["stats"]["total_tokens"]) == (3, 7 + 8 + 9)
+    # Empty window
+    assert database.get_user_analytics_range(user, datetime(2026, 1, 1, 6), datetime(2026, 1, 1, 6))["stats"][
+        "total_chats"] == 0
+
+
+def test_random_windows_match_raw_rows(database, user):
+    rng = random.Random(7)
+    base = datetime(2026, 3, 1)
+    rows = [chat(database, user, base + timedelta(minutes=rng.randrange(10 * 24 * 60)), tokens=rng.randrange(1, 50))
+            for _ in range(500)]
+    # Another user's chats must not leak into the window
+    other = database.create_user("bob", "bob@example.com", "secret")["user_id"]
+    rows += [chat(database, other, base + timedelta(hours=n)) for n in range(100)]
+    database.save_chats(rows)
+
+    for _ in range(50):
+        start = base + timedelta(minutes=rng.randrange(-24 * 60, 11 * 24 * 60))
+        end = start + timedelta(minutes=rng.randrange(0, 6 * 24 * 60))
+        stats = database.get_user_analytics_range(user, start, end)["stats"]
+        assert (stats["total_chats"], stats["total_tokens"]) == expected(database, user, start, end)
@@ -0,0 +1,30 @@
+import asyncio
+
+import guardrails
+import routing
+import usage
+
+
+def test_giant_prompt_is_counted_once(monkeypatch):
+    monkeypatch.setattr(routing, "GEMINI_API_KEY", "test")
+    monkeypatch.setattr(routing, "DEEPSEEKER_API_KEY", "test")
+    text = " ".join(f"word{i} lorem, ipsum." for i in range(20000))
+
+    plan = asyncio.run(guardrails.preflight("deepseeker-1.0", "prefix\n\n", text))
+    assert plan["action"] == "routed"
+    assert plan["prompt_tokens"] == usage.estimate_tokens("prefix\n\n" + text)
+
+    def tokenize(_):
+        raise AssertionError("prompt tokenized again")
+
+    # The fallback chain reuses pre-flight's count instead of tokenizing per model
+    monkeypatch.setattr(routing, "estimate_tokens", tokenize)
+    monkeypatch.setattr(usage, "estimate_tokens", tokenize)
+    chain = routing.fallback_chain("General Assistant", plan["model"], "prefix\n\n" + text, plan["prompt_tokens"])
+    assert "deepseeker-1.0" not in chain
+    assert plan["model"] in chain
+
+
+def test_count_tokens_in_slices_is_exact():
+    text = ("x" * 70000 + " ab, c.\n") * 5 + "tail"
+    assert asyncio.run(usage.count_tokens(text)) == usage.estimate_tokens(text)
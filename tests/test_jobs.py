@@ -0,0 +1,150 @@
+import time
+import asyncio
+import random
+
+from jobs import JobWorkerPool
+
+
+def task_rows(database, job_id):
+    return [dict(row) for row in database.get_conn().execute(
+        "SELECT idx, status, attempts, worker, available_at, error FROM job_tasks WHERE job_id = ? ORDER BY idx",
+        (job_id,))]
+
+
+def test_expired_lease_is_claimed_by_another_worker(database):
+    job_id = database.create_job(["q"], now=100.0)
+    [task] = database.claim_job_tasks("w1", 1, lease_seconds=10, now=100.0)
+    assert task["attempts"] == 1
+
+    # Leased: nobody else gets it until the lease runs out
+    assert database.claim_job_tasks("w2", 1, lease_seconds=10, now=109.9) == []
+    [again] = database.claim_job_tasks("w2", 1, lease_seconds=10, now=110.0)
+    assert (again["id"], again["attempts"]) == (task["id"], 2)
+
+    # The first worker lost its lease, so its late answer is dropped
+    assert not database.complete_job_task(task, "w1", "{}", now=111.0)
+    assert database.complete_job_task(again, "w2", "{}", now=111.0)
+    assert database.get_job(job_id)["status"] == "completed"
+
+
+def test_retry_waits_for_its_backoff(database):
+    job_id = database.create_job(["q"], now=100.0)
+    [task] = database.claim_job_tasks("w1", 1, lease_seconds=10, now=100.0)
+    assert database.retry_job_task(task, "w1", available_at=130.0, error="boom", now=101.0)
+    assert task_rows(database, job_id)[0]["status"] == "pending"
+
+    assert database.claim_job_tasks("w1", 1, lease_seconds=10, now=129.0) == []
+    [task] = database.claim_job_tasks("w1", 1, lease_seconds=10, now=130.0)
+    assert task["attempts"] == 2
+
+    # A task handed back without calling the provider keeps its attempt count
+    assert database.retry_job_task(task, "w1", available_at=131.0, attempted=False, now=130.0)
+    assert task_rows(database, job_id)[0]["attempts"] == 1
+
+
+def test_backoff_doubles_with_jitter_up_to_the_cap():
+    pool = JobWorkerPool(None, None, retry_base=2, retry_max=20)
+    random.seed(1)
+    for attempts, delay in ((1, 2), (2, 4), (3, 8), (4, 16), (5, 20), (9, 20)):
+        for _ in range(20):
+            assert delay * 0.5 <= pool.backoff(attempts) <= delay
+
+
+def make_pool(database, outcomes, calls, **options):
+    """A pool whose answers come from ``outcomes`` (True = ok) instead of a provider"""
+    def plan(text):
+        return "General Assistant", {"model": "gemini-1.5-flash"}
+
+    async def run(index, text, agent, decision, session_id, user_id=None):
+        calls.append((index, text, session_id, user_id))
+        if outcomes.pop(0):
+            row = database.chat_row(session_id, agent, decision["model"], text, "answer", 0.85, 0.1, 10,
+                                    user_id=user_id)
+            return {"event": "result", "index": index, "ok": True, "response": "answer"}, row
+        return {"event": "result", "index": index, "ok": False, "error": "provider down"}, ()
+
+    return JobWorkerPool(plan, run, workers=0, rate_per_minute=0, **options)
+
+
+def test_failed_calls_are_retried_with_backoff_then_given_up(database):
+    user = database.create_user("alice", "alice@example.com", "secret")["user_id"]
+    job_id = database.create_job(["q"], user_id=user, now=100.0)
+    calls = []
+    pool = make_pool(database, [False, False, False], calls, max_attempts=3, retry_base=60, retry_max=600)
+
+    async def attempt(now):
+        [task] = database.claim_job_tasks("w", 1, 300, now)
+        return await pool._answer("w", task), task_rows(database, job_id)[0]
+
+    before = time.time()
+    outcome, row = asyncio.run(attempt(100.0))
+    assert (outcome, row["status"], row["error"]) == ("retried", "pending", "provider down")
+    # Due again after its backoff: between half and all of retry_base
+    assert before + 30 <= row["available_at"] <= time.time() + 60
+    assert database.claim_job_tasks("w", 1, 300, row["available_at"] - 1) == []
+
+    outcome, row = asyncio.run(attempt(row["available_at"]))
+    assert outcome == "retried"
+    outcome, row = asyncio.run(attempt(row["available_at"]))
+    assert (outcome, row["status"], row["attempts"]) == ("failed", "failed", 3)
+    assert calls == [(0, "q", f"job-{job_id}", user)] * 3
+    assert database.get_job(job_id)["status"] == "completed"
+    assert database.get_job(job_id)["failed"] == 1
+
+
+def test_success_stores_the_chat_under_the_job_owner(database):
+    user = database.create_user("alice", "alice@example.com", "secret")["user_id"]
+    job_id = database.create_job(["q1", "q2"], user_id=user, session_id="s", now=100.0)
+    pool = make_pool(database, [True, True], [])
+
+    async def drain():
+        outcomes = []
+        for task in database.claim_job_tasks("w", 2, 300, 100.0):
+            outcomes.append(await pool._answer("w", task))
+        return outcomes
+
+    assert asyncio.run(drain()) == ["completed", "completed"]
+    assert database.get_job(job_id)["completed"] == 2
+    rows = database.get_conn().execute("SELECT user_id, session_id FROM chat_sessions").fetchall()
+    assert [tuple(row) for row in rows] == [(user, "s"), (user, "s")]
+
+
+def test_task_whose_leases_keep_expiring_is_failed(database):
+    job_id = database.create_job(["q"], now=100.0)
+    calls = []
+    pool = make_pool(database, [], calls, max_attempts=2)
+    now = 100.0
+    for _ in range(3):
+        [task] = database.claim_job_tasks("w", 1, 10, now)
+        now += 10
+    # Third claim: the worker holding each earlier lease died without answering
+    assert asyncio.run(pool._answer("w", task)) == "failed"
+    assert calls == []
+    assert task_rows(database, job_id)[0]["error"] == "Task lease expired too many times"
+
+
+def test_jobs_wait_out_an_open_breaker_then_probe(monkeypatch):
+    import jobs
+    import resilience
+
+    monkeypatch.setattr(resilience, "guards", {})
+    monkeypatch.setattr(jobs, "JOB_HEADROOM_WAIT", 0.05)
+    monkeypatch.setattr(jobs, "JOB_HEADROOM_POLL", 0.01)
+    pool = JobWorkerPool(None, None, rate_per_minute=60)
+    tokens = []
+
+    async def acquire():
+        tokens.append(1)
+
+    monkeypatch.setattr(pool.rate_limiter("gemini"), "acquire", acquire)
+    breaker = resilience.guard_for("gemini").breaker
+    breaker._open(time.time())
+
+    # Handed back while open, without spending a rate token
+    assert not asyncio.run(pool._wait_for_turn("gemini"))
+    assert tokens == []
+
+    # Open period over: nothing has called allow(), but the job may probe
+    breaker.opened_at -= resilience.BREAKER_OPEN_SECONDS
+    assert asyncio.run(pool._wait_for_turn("gemini"))
+    assert tokens == [1]
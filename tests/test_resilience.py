@@ -0,0 +1,151 @@
+import pytest
+
+import resilience
+from resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, ProviderGuard, response_latency
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(resilience, "time", clock)
+    monkeypatch.setattr(resilience, "BREAKER_MIN_CALLS", 4)
+    monkeypatch.setattr(resilience, "BREAKER_ERROR_RATE", 0.5)
+    monkeypatch.setattr(resilience, "BREAKER_SLOW_RATE", 0.8)
+    monkeypatch.setattr(resilience, "BREAKER_SLOW_CALL_SECONDS", 5.0)
+    monkeypatch.setattr(resilience, "BREAKER_WINDOW_SECONDS", 30.0)
+    monkeypatch.setattr(resilience, "BREAKER_OPEN_SECONDS", 10.0)
+    monkeypatch.setattr(resilience, "BREAKER_HALF_OPEN_PROBES", 2)
+    return clock
+
+
+def open_breaker(breaker):
+    for ok in (True, True, False, False):
+        breaker.record(ok, 0.1)
+    assert breaker.state == OPEN
+
+
+def test_opens_on_error_rate_once_enough_calls(clock):
+    breaker = CircuitBreaker()
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    # Below BREAKER_MIN_CALLS nothing trips
+    assert breaker.state == CLOSED
+    breaker.record(True, 0.1)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.status()["times_opened"] == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = CircuitBreaker()
+    for latency in (6.0, 6.0, 6.0, 1.0):
+        breaker.record(True, latency)
+    assert breaker.state == CLOSED
+    breaker.record(True, 6.0)
+    assert breaker.state == OPEN
+
+
+def test_old_calls_leave_the_window(clock):
+    breaker = CircuitBreaker()
+    for _ in range(3):
+        breaker.record(False, 0.1)
+    clock.now += 31
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.status()["window_calls"] == 1
+
+
+def test_half_open_after_open_seconds_then_closes_on_good_probe(clock):
+    breaker = CircuitBreaker()
+    open_breaker(breaker)
+    clock.now += 9.9
+    assert not breaker.allow()
+    clock.now += 0.2
+    # Only BREAKER_HALF_OPEN_PROBES calls get through
+    assert breaker.allow() and breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.status()["window_calls"] == 0
+    assert breaker.allow()
+
+
+@pytest.mark.parametrize("ok, latency", [(False, 0.1), (True, 6.0)])
+def test_failed_or_slow_probe_reopens(clock, ok, latency):
+    breaker = CircuitBreaker()
+    open_breaker(breaker)
+    clock.now += 11
+    assert breaker.allow()
+    breaker.record(ok, latency)
+    assert breaker.state == OPEN
+    assert breaker.status()["times_opened"] == 2
+    # The open period starts again from the failed probe
+    clock.now += 9.9
+    assert not breaker.allow()
+
+
+def test_cancelled_probe_frees_its_slot(clock):
+    breaker = CircuitBreaker()
+    open_breaker(breaker)
+    clock.now += 11
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()
+    breaker.record(None, 0.0)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_guard_sheds_while_open_without_leaking_slots(clock):
+    guard = ProviderGuard("test")
+    open_breaker(guard.breaker)
+    assert guard.acquire() == "circuit open"
+    assert guard.limiter.in_flight == 0
+    clock.now += 11
+    assert guard.acquire() is None
+    guard.release(True, 0.1)
+    assert guard.breaker.state == CLOSED
+    assert guard.limiter.in_flight == 0
+
+
+def test_long_answers_are_judged_on_the_measured_output_rate():
+    # 300 tokens at a measured 100 tok/s take 3 s, so a 20 s answer is still slow
+    assert response_latency(20.0, 300, 100.0) == pytest.approx(17.0)
+    assert response_latency(2.5, 300, 100.0) == 0.0
+    # Until the model's rate is measured, the whole time counts
+    assert response_latency(20.0, 300, None) == 20.0
+    assert response_latency(3.0, 0, 100.0) == 3.0
+
+
+def test_expired_open_period_is_not_open(clock):
+    breaker = CircuitBreaker()
+    open_breaker(breaker)
+    assert breaker.is_open()
+    assert breaker.status()["state"] == OPEN
+    clock.now += 11
+    # Nothing has called allow() yet, but the next call would be a probe
+    assert breaker.state == OPEN
+    assert not breaker.is_open()
+    assert breaker.status()["state"] == HALF_OPEN
+
+
+def test_router_uses_provider_again_after_open_period(clock, monkeypatch):
+    import routing
+
+    monkeypatch.setattr(routing, "GEMINI_API_KEY", "test")
+    monkeypatch.setattr(routing, "DEEPSEEKER_API_KEY", "test")
+    monkeypatch.setattr(resilience, "guards", {})
+    breaker = resilience.guard_for("gemini").breaker
+    open_breaker(breaker)
+    router = routing.ModelRouter(lambda text: "gemini-1.5-flash", policy="cheapest_under_latency")
+    assert "gemini-1.5-flash" not in router.choose("hi")["inputs"]
+    clock.now += 11
+    assert "gemini-1.5-flash" in router.choose("hi")["inputs"]
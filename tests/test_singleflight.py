@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def main():
+        flights = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"text": "answer"}
+
+        results = await asyncio.gather(*[flights.do("key", fetch) for _ in range(10)])
+        assert len(calls) == 1
+        assert all(result is results[0] for result in results)
+        assert flights.stats() == {"in_flight_calls": 0, "in_flight_streams": 0, "leaders": 1, "shared": 9}
+
+        # Different keys are not merged, and a finished key is released
+        await asyncio.gather(flights.do("other", fetch), flights.do("key", fetch))
+        assert len(calls) == 3
+
+    asyncio.run(main())
+
+
+def test_errors_reach_every_caller():
+    async def main():
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(*[flights.do("key", fail) for _ in range(3)], return_exceptions=True)
+        assert [str(result) for result in results] == ["upstream down"] * 3
+        assert flights.stats()["in_flight_calls"] == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_caller_does_not_cancel_shared_call():
+    async def main():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "answer"
+
+        first = asyncio.create_task(flights.do("key", fetch))
+        second = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        release.set()
+        assert await second == "answer"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+    asyncio.run(main())
+
+
+def test_stream_subscribers_share_one_upstream_stream():
+    async def main():
+        flights = SingleFlight()
+        started = []
+        completed = []
+
+        async def upstream(meta):
+            started.append(1)
+            meta["model"] = "gemini-1.5-flash"
+            for chunk in ("a", "b", "c"):
+                await asyncio.sleep(0.01)
+                yield chunk
+
+        async def on_complete(text):
+            completed.append(text)
+
+        async def read():
+            chunks, meta = flights.stream("key", upstream, on_complete=on_complete)
+            text = "".join([chunk async for chunk in chunks])
+            return text, meta
+
+        first = asyncio.create_task(read())
+        await asyncio.sleep(0.015)
+        # Joins after the first chunk: replays it, then follows the same stream
+        late = await read()
+        assert await first == late == ("abc", {"model": "gemini-1.5-flash"})
+        assert started == [1]
+        assert completed == ["abc"]
+        assert flights.stats()["in_flight_streams"] == 0
+
+    asyncio.run(main())
+
+
+def test_stream_is_cancelled_when_every_subscriber_leaves():
+    async def main():
+        flights = SingleFlight()
+        closed = asyncio.Event()
+
+        async def upstream(meta):
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield "chunk"
+            finally:
+                closed.set()
+
+        chunks, _ = flights.stream("key", upstream)
+        assert await chunks.__anext__() == "chunk"
+        await chunks.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+
+    asyncio.run(main())
+
+
+def test_identical_chats_make_one_provider_request(database, monkeypatch):
+    httpx = pytest.importorskip("httpx")
+    app = pytest.importorskip("app")
+    import providers
+    import routing
+
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "answer"}]}}]})
+
+    for module in (providers, routing):
+        monkeypatch.setattr(module, "GEMINI_API_KEY", "test")
+
+    async def main():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(providers, "get_client", lambda: client)
+        try:
+            return await asyncio.gather(*[
+                app.cached_call_model("General Assistant", "gemini-1.5-flash", "single-flight test query")
+                for _ in range(5)])
+        finally:
+            await client.aclose()
+
+    results = asyncio.run(main())
+    assert len(requests) == 1
+    assert [result["text"] for result, _ in results] == ["answer"] * 5
@@ -0,0 +1,387 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import importlib
+import threading
+from queue import Empty, SimpleQueue
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+
+from profiler import request_capture
+
+logger = logging.getLogger(__name__)
+
+# Where finished spans go: none, stdout, file, otlp, or "module:attribute" naming
+# a class or factory that returns an exporter (an object with export(spans)
+# and shutdown()). Trace IDs are generated and propagated either way.
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "xtarz-agents")
+
+TRACE_BATCH_SIZE = 512         # spans per export
+TRACE_EXPORT_INTERVAL = 2.0    # ...or once the oldest pending span is this old (seconds)
+TRACE_MAX_PENDING = 10000      # spans beyond this are dropped instead of held in memory
+
+# OTLP span kinds and status codes
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+current_span = ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits) or 1:0{bits // 4}x}"
+
+
+def parse_traceparent(value: str):
+    """(trace_id, parent span_id, sampled) from a W3C traceparent header, or None if malformed"""
+    parts = value.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        if int(parts[1], 16) == 0 or int(parts[2], 16) == 0:
+            return None
+    except ValueError:
+        return None
+    return parts[1].lower(), parts[2].lower(), bool(flags & 1)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+class Span:
+    """One timed operation in a trace, in OpenTelemetry's data model"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "sampled", "kind", "attributes",
+                 "links", "status", "message", "start_ns", "end_ns")
+
+    def __init__(self, name, trace_id, parent_id, sampled, kind=INTERNAL, attributes=None, links=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.links = links or []
+        self.status = STATUS_UNSET
+        self.message = ""
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = STATUS_ERROR
+        self.message = str(message)
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            if self.sampled:
+                processor.submit(self)
+            capture = request_capture.get()
+            if capture is not None:
+                capture.spans.append(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": self.status, "message": self.message} if self.message else {"code": self.status},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.links:
+            span["links"] = [{"traceId": trace_id, "spanId": span_id} for trace_id, span_id in self.links]
+        return span
+
+
+def start_span(name: str, kind=INTERNAL, parent=None, traceparent=None, links=None, **attributes) -> Span:
+    """Start a span under ``parent`` (default: the current span) without making it current.
+
+    Without a parent, ``traceparent`` (an incoming W3C header) continues a
+    remote trace; otherwise a new trace starts, sampled at TRACE_SAMPLE_RATE.
+    Call ``end()`` when done.
+    """
+    if parent is None:
+        parent = current_span.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes, links)
+
+    remote = parse_traceparent(traceparent) if traceparent else None
+    if remote is not None:
+        trace_id, parent_id, sampled = remote
+    else:
+        trace_id, parent_id = _new_id(128), None
+        sampled = processor.exporter is not None and random.random() < TRACE_SAMPLE_RATE
+    return Span(name, trace_id, parent_id, sampled, kind, attributes, links)
+
+
+@contextmanager
+def span(name: str, kind=INTERNAL, traceparent=None, links=None, **attributes):
+    """Run the block inside a new current span; exceptions mark it as failed.
+
+    Not for blocks containing a ``yield`` of an async generator, which may
+    resume in another task; use start_span() and end() there.
+    """
+    current = start_span(name, kind, traceparent=traceparent, links=links, **attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.set_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        current.end()
+
+
+def current_trace_id():
+    current = current_span.get()
+    return current.trace_id if current is not None else None
+
+
+def inject(headers: dict, trace=None) -> dict:
+    """Add a traceparent header for ``trace`` (default: the current span) to outgoing ``headers``"""
+    trace = trace or current_span.get()
+    if trace is not None:
+        headers["traceparent"] = trace.traceparent()
+    return headers
+
+
+# Exporters
+
+def otlp_request(spans) -> dict:
+    """An OTLP/JSON ExportTraceServiceRequest for ``spans``"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes({"service.name": TRACE_SERVICE_NAME})},
+        "scopeSpans": [{"scope": {"name": "xtarz.tracing"}, "spans": [s.to_otlp() for s in spans]}],
+    }]}
+
+
+class StdoutExporter:
+    """One readable line per span"""
+
+    def export(self, spans):
+        for s in spans:
+            status = "ERROR " + s.message if s.status == STATUS_ERROR else "ok"
+            sys.stdout.write(f"trace={s.trace_id} span={s.span_id} parent={s.parent_id or '-'} {s.name} "
+                             f"{(s.end_ns - s.start_ns) / 1e6:.2f}ms {status} {json.dumps(s.attributes, default=str)}\n")
+        sys.stdout.flush()
+
+    def shutdown(self):
+        pass
+
+
+class FileExporter:
+    """OTLP/JSON export requests, one per line (the OpenTelemetry Collector file format)"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, spans):
+        self.file.write(json.dumps(otlp_request(spans)) + "\n")
+        self.file.flush()
+
+    def shutdown(self):
+        self.file.close()
+
+
+class OtlpHttpExporter:
+    """POST OTLP/JSON to a collector (for example an OpenTelemetry Collector on :4318)"""
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT):
+        self.endpoint = endpoint
+        self.client = httpx.Client(timeout=5.0)
+
+    def export(self, spans):
+        self.client.post(self.endpoint, json=otlp_request(spans)).raise_for_status()
+
+    def shutdown(self):
+        self.client.close()
+
+
+EXPORTERS = {"stdout": StdoutExporter, "file": FileExporter, "otlp": OtlpHttpExporter}
+
+
+def load_exporter(name: str = TRACE_EXPORTER):
+    """Exporter for a TRACE_EXPORTER value, or None for "none" """
+    if not name or name == "none":
+        return None
+    if name in EXPORTERS:
+        return EXPORTERS[name]()
+    module, _, attribute = name.partition(":")
+    if not attribute:
+        raise ValueError(f"Unknown TRACE_EXPORTER {name!r}; use {', '.join(EXPORTERS)} or module:attribute")
+    return getattr(importlib.import_module(module), attribute)()
+
+
+class BatchProcessor:
+    """Hands finished spans to the exporter in batches from a background thread.
+
+    ``submit()`` only enqueues, so exporting (file or network I/O) never runs
+    on the request path; when the exporter falls behind, spans over
+    TRACE_MAX_PENDING are dropped and counted.
+    """
+
+    def __init__(self, exporter):
+        self.exporter = exporter
+        self.queue = SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+
+    def submit(self, span):
+        if self.exporter is None:
+            return
+        if self.queue.qsize() >= TRACE_MAX_PENDING:
+            self.dropped += 1
+            return
+        if self.thread is None:
+            self._start()
+        self.queue.put(span)
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            span = self.queue.get()
+            if span is None:
+                break
+
+            batch = [span]
+            deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+            while len(batch) < TRACE_BATCH_SIZE:
+                try:
+                    span = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                batch.append(span)
+
+            try:
+                self.exporter.export(batch)
+                self.exported += len(batch)
+            except Exception:
+                self.dropped += len(batch)
+                logger.exception("Failed to export %d spans", len(batch))
+
+    def shutdown(self):
+        """Export every pending span, then close the exporter"""
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+    def stats(self):
+        return {
+            "exporter": type(self.exporter).__name__ if self.exporter is not None else None,
+            "pending": self.queue.qsize(),
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "sample_rate": TRACE_SAMPLE_RATE
+        }
+
+
+processor = BatchProcessor(load_exporter())
+
+
+def set_exporter(exporter):
+    """Swap the exporter at runtime (flushes the current one first)"""
+    global processor
+    processor.shutdown()
+    processor = BatchProcessor(exporter)
+
+
+def close_tracing():
+    """Flush pending spans and close the exporter"""
+    processor.shutdown()
+
+
+def trace_stats():
+    return processor.stats()
+
+
+class TracingMiddleware:
+    """ASGI middleware: one server span per HTTP request.
+
+    Continues an incoming ``traceparent`` header, makes the span current
+    for the whole request (including streamed bodies) and returns the
+    trace ID in an ``X-Trace-Id`` response header.
+    """
+
+    def __init__(self, app, skip_prefixes=("/static",)):
+        self.app = app
+        self.skip_prefixes = tuple(skip_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        method = scope["method"]
+        with span(f"{method} {scope['path']}", SERVER, traceparent, method=method, path=scope["path"]) as server:
+            async def send_traced(message):
+                if message["type"] == "http.response.start":
+                    server.set_attribute("status_code", message["status"])
+                    if message["status"] >= 500:
+                        server.set_error(f"HTTP {message['status']}")
+                    message = dict(message, headers=list(message.get("headers", []))
+                                   + [(b"x-trace-id", server.trace_id.encode())])
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                # Name the span after the route template rather than the raw path
+                route = scope.get("route")
+                if route is not None and hasattr(route, "path"):
+                    server.name = f"{method} {route.path}"
@@ -0,0 +1,107 @@
+import re
+import asyncio
+
+# List prices in USD per 1K tokens: (input, output)
+MODEL_PRICES = {
+    "gemini-1.5-flash-8b": (0.0000375, 0.00015),
+    "gemini-1.5-flash": (0.000075, 0.0003),
+    "deepseeker-1.0": (0.00027, 0.0011),
+}
+
+# Context window and reserved output tokens per model
+MODEL_CONTEXT_WINDOWS = {
+    "gemini-1.5-flash-8b": 1_000_000,
+    "gemini-1.5-flash": 1_000_000,
+    "deepseeker-1.0": 64_000,
+}
+MODEL_MAX_OUTPUT = {
+    "gemini-1.5-flash-8b": 8192,
+    "gemini-1.5-flash": 8192,
+    "deepseeker-1.0": 600,
+}
+DEFAULT_CONTEXT_WINDOW = 32_000
+
+# Word runs and single punctuation marks; BPE tokenizers split long words
+# into roughly one token per 4-5 characters
+_PIECES = re.compile(r"\w+|[^\w\s]")
+_SPACE = re.compile(r"\s")
+CHARS_PER_TOKEN = 5
+# Longer texts are tokenized in a worker thread rather than on the event loop
+TOKENIZE_IN_THREAD_CHARS = 64 * 1024
+
+
+def estimate_tokens(text: str) -> int:
+    """Local approximation of a BPE token count, for when a provider reports no usage"""
+    if not text:
+        return 0
+    return sum(1 + (len(piece) - 1) // CHARS_PER_TOKEN for piece in _PIECES.findall(text))
+
+
+def _estimate_tokens_in_slices(text: str) -> int:
+    """estimate_tokens() over slices cut at whitespace, so the thread gives up the GIL between them"""
+    # No piece spans whitespace, so the total is exact
+    total = start = 0
+    while start < len(text):
+        end = start + TOKENIZE_IN_THREAD_CHARS
+        if end < len(text):
+            space = _SPACE.search(text, end)
+            end = space.start() if space else len(text)
+        total += estimate_tokens(text[start:end])
+        start = end
+    return total
+
+
+async def count_tokens(text: str) -> int:
+    """estimate_tokens() that keeps long texts (a giant paste) off the event loop"""
+    if len(text or "") > TOKENIZE_IN_THREAD_CHARS:
+        return await asyncio.to_thread(_estimate_tokens_in_slices, text)
+    return estimate_tokens(text)
+
+
+def prompt_budget(model_name: str) -> int:
+    """Most prompt tokens ``model_name`` accepts, leaving room for its output"""
+    return MODEL_CONTEXT_WINDOWS.get(model_name, DEFAULT_CONTEXT_WINDOW) - MODEL_MAX_OUTPUT.get(model_name, 0)
+
+
+def fits(model_name: str, prompt: str, prompt_tokens=None) -> bool:
+    """Whether ``prompt`` fits the model's context window"""
+    budget = prompt_budget(model_name)
+    # No piece is shorter than one character, so short prompts skip tokenizing
+    if len(prompt) <= budget:
+        return True
+    if prompt_tokens is None:
+        prompt_tokens = estimate_tokens(prompt)
+    return prompt_tokens <= budget
+
+
+def gemini_usage(payload: dict):
+    """(input, output) token counts from a Gemini response, or Nones"""
+    usage = payload.get("usageMetadata") or payload.get("usage_metadata") or {}
+    return usage.get("promptTokenCount"), usage.get("candidatesTokenCount")
+
+
+def deepseek_usage(payload: dict):
+    """(input, output) token counts from a DeepSeek response, or Nones"""
+    usage = payload.get("usage") or {}
+    return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+def cost_estimate(model_name: str, input_tokens: int, output_tokens: int) -> float:
+    price_in, price_out = MODEL_PRICES.get(model_name, (0.0, 0.0))
+    return (input_tokens * price_in + output_tokens * price_out) / 1000
+
+
+def account(model_name: str, prompt: str, text: str, input_tokens=None, output_tokens=None) -> dict:
+    """Token counts and cost for one call, estimating whatever the provider did not report"""
+    estimated = input_tokens is None or output_tokens is None
+    if input_tokens is None:
+        input_tokens = estimate_tokens(prompt)
+    if output_tokens is None:
+        output_tokens = estimate_tokens(text)
+    return {
+        "tokens": input_tokens + output_tokens,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cost_estimate": cost_estimate(model_name, input_tokens, output_tokens),
+        "tokens_estimated": estimated
+    }